@@ -676,9 +676,40 @@ Public License instead of this License.  But first, please read
 """
 
 from __future__ import print_function
-from subprocess import call
-from datetime import datetime
-import sys, traceback, time, os, re, argparse, shlex, logging
+from subprocess import Popen, PIPE
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import sys, traceback, time, os, re, argparse, shlex, logging, tempfile, shutil, json, csv, hashlib, threading, uuid, struct, zlib, bisect, errno, signal, atexit, io, codecs, itertools, contextlib
+
+try:
+    import numpy
+except ImportError:
+    # Optional, used only by the in process palette engines
+    numpy = None
+
+try:
+    from subprocess import SubprocessError
+except ImportError:
+    # Python 2, where the errors of the child process setup are raised as they are
+    SubprocessError = OSError
+
+try:
+    import resource
+except ImportError:
+    # Windows, where the memory limit of the child processes is not supported
+    resource = None
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+    import queue
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+    import Queue as queue
 
 __title__           = 'video2gif'
 __version__         = '0.1'
@@ -710,32 +741,266 @@ LOG_FORMAT = logging.Formatter('[%(asctime)s] %(levelname)8s - %(name)s: %(messa
 
 IS_WIN = sys.platform.startswith('win32') | sys.platform.startswith('cygwin')
 
-TIMESTAMP = datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H-%M-%S')
+# Python 2 compatibility
+try:
+    STRING_TYPES = (basestring,)
+except NameError:
+    STRING_TYPES = (str,)
 
 CURRENT_DIR = os.path.dirname( os.path.abspath(__file__) )
-PALETTE_MKV = os.path.join(CURRENT_DIR, TIMESTAMP+'_palette.mkv')
-PALETTE_PNG = os.path.join(CURRENT_DIR, TIMESTAMP+'_palette.png')
-SUB_EXTRACTED = os.path.join(CURRENT_DIR, TIMESTAMP+'_subtitle.ass')
+
+# Temp files are created in a private work directory for each job, so concurrent jobs never collide; its name has the
+# PID of the process, so the directories left by a killed process are found and removed by the next ones
+TEMP_PREFIX = __title__ + '_'
+WORKDIR_NAME = re.compile(r'^' + re.escape(TEMP_PREFIX) + r'(\d+)_')
+TMP_DIR_ENV = 'VIDEO2GIF_TMPDIR'
+RAM_TMP_DIR = '/dev/shm'
+RAM_TMP_MIN_FREE = 1024**3 # A RAM-backed directory is used only if it has this free space (e.g. it is 64 MiB in Docker)
+ORPHAN_MIN_AGE = 60 # Work directories of dead processes are removed after this age (in seconds)
+ORPHAN_MAX_AGE = 24 * 3600 # and all of them after this one (the PIDs are not checked on Windows)
+NOT_OPT_GIF = 'not_opt_%02d.gif'
+PALETTE_MKV = 'palette.mkv'
+PALETTE_PNG = 'palette.png'
+SUB_EXTRACTED = 'subtitle.ass'
+SUB_TRACK = 'subtitle_track_%02d.ass'
+PROXY_MKV = 'proxy.mkv'
+SOURCE_SPOOL = 'source'
+SOURCE_PROBE = 'probe.json'
+KEYFRAME_INDEX = 'keyframes.json'
+SEGMENT_GIF = 'segment_%03d.gif'
+BUDGET_SAMPLE_MKV = 'budget_sample.mkv'
+BUDGET_TRIAL_GIF = 'budget_trial_%02d.gif'
+STITCHED_GIF = 'stitched.gif'
 
 RESIZE_FILTERS = ['lanczos', 'bicubic', 'spline16', 'spline36', 'point', 'bilinear']
 DITHER_MODES = ['bayer', 'floyd_steinberg', 'sierra2', 'sierra2_4a', 'none']
 BAYER_SCALES = [0, 1, 2, 3, 4, 5]
 GENERATION_MODES = ['full', 'diff', 'single']
+PALETTE_ENGINES = ['ffmpeg', 'median_cut', 'kmeans']
+OPTIMIZERS = ['gifsicle', 'builtin']
+GIFSICLE_LEVELS = [1, 2, 3]
+PALETTE_SAMPLES = ['fps:N', 'keyframes', 'count:K']
 LOG_MODES = ['quiet', 'fatal', 'error', 'warning', 'info', 'verbose', 'debug', 'trace']
 LOG_DEBUG = LOG_MODES[4:]
+MAX_NICE = 19 # The child processes can only get a lower priority than the one of the process
+THREAD_BUDGET_POLICIES = ['off', 'throughput', 'latency']
+THREAD_BUDGET_WIDTH = 8 # Threads of each FFmpeg command with the 'latency' policy (the stages scale little over them)
+THREAD_BUDGET_POLL = 0.1 # Seconds between the checks of the free threads, when they are waited without blocking
 
 SUBS_FILTER  = 'subtitles={subtitles}:charenc={charenc},'
-BASE_FILTERS = 'fps={fps},scale={size}:flags={resize_mode}'
+SCALE_FILTER = 'scale={size}:flags={resize_mode}'
+BASE_FILTERS = 'fps={fps},' + SCALE_FILTER
+PALETTEGEN   = 'palettegen=stats_mode={mode}:max_colors={palette_colors}'
 PALETTEUSE   = 'paletteuse=diff_mode={diff_mode}:dither={dither}:bayer_scale={bayer_scale}:new={new}'
 COMMANDS = {
-    'subextract'        : 'ffmpeg -v {log} -y -sub_charenc "{charenc}" {cutting} -i "{sourceVideo}" -map 0:s:{burn_track} "{subtitles_unescaped}"', 
-    'subcut'            : 'ffmpeg -v {log} -y -sub_charenc "{charenc}" {cutting} -i "{burn_file}" "{subtitles_unescaped}"', 
-    'palettegen'        : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -vf "{sub_filters}{filters},palettegen=stats_mode={mode}" "{palette}"', 
-    'gifcreate'         : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -i "{palette}" -lavfi "{sub_filters}{filters}[x];[x][1:v]{paletteuse}" -f gif "{destinationGif}"', 
-    'gifcreate_onestep' : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -vf "{sub_filters}{filters}" -f gif "{destinationGif}"', 
-    'gifsicle'          : 'gifsicle -b -O3 "{destinationGif}" -o "{destinationGifOpt}"', 
+    'subextract'           : 'ffmpeg -v {log} -y -sub_charenc "{charenc}" {sub_cutting} -i "{sourceVideo}" -map 0:s:{burn_track} "{subtitles_unescaped}"', 
+    'subcut'               : 'ffmpeg -v {log} -y -sub_charenc "{charenc}" {sub_cutting} -i "{burn_file}" "{subtitles_unescaped}"', 
+    'subextractall'        : 'ffmpeg -v {log} -y -sub_charenc "{charenc}" -i "{sourceVideo}" {subtitle_maps}', 
+    'palettegen'           : 'ffmpeg -v {log} -y {palette_source} -lavfi "{palette_graph}{palettegen}" {palette_opts} "{palette}"', 
+    'palettegen_numpy'     : 'ffmpeg -v {log} -y {palette_source} -lavfi "{palette_graph}format=rgb24" -an -sn -f image2pipe -c:v ppm -', 
+    'gifcreate'            : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -i "{palette}" -lavfi "{cut_filters}{sub_filters}{filters}[x];[x][1:v]{paletteuse}" -f gif "{destinationGif}"', 
+    'gifcreate_fused'      : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -lavfi "{cut_filters}{sub_filters}{filters},split[x][y];[x]{palette_sampling}{palettegen}[p];[y][p]{paletteuse}" -f gif "{destinationGif}"', 
+    'gifcreate_fused_save' : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -lavfi "{cut_filters}{sub_filters}{filters},split[x][y];[x]{palette_sampling}{palettegen},split[p][s];[y][p]{paletteuse}[g]" -map "[g]" -f gif "{destinationGif}" -map "[s]" {palette_opts} "{palette}"', 
+    'gifcreate_variants'   : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -filter_complex "{variants_graph}" {variants_outputs}', 
+    'gifcreate_onestep'    : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -vf "{cut_filters}{sub_filters}{filters}" -f gif "{destinationGif}"', 
+    'proxycreate'          : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -vf "{cut_filters}{sub_filters}{filters}" -an -sn -c:v ffv1 -level 3 -slices 4 -pix_fmt bgr0 "{proxy}"', 
+    'budgetsample'         : 'ffmpeg -v {log} -y {cutting} -i "{sourceVideo}" -vf "{cut_filters}{sub_filters}fps={fps},{budget_windows}{scale_filter}" -an -sn -c:v ffv1 -level 3 -slices 4 -pix_fmt bgr0 "{budget_sample}"', 
+    'probe'                : 'ffprobe -v error -show_entries format=start_time,duration:stream=codec_type,codec_name,width,height,avg_frame_rate,duration:stream_tags=DURATION,language,title:stream_side_data=rotation -of json "{sourceVideo}"', 
+    'keyindex'             : 'ffprobe -v error -select_streams v:0 -show_entries format=start_time:packet=pts_time,flags -of csv=p=0 "{sourceVideo}"', 
+    'gifsicle'             : 'gifsicle -b {gifsicle_opts} "{destinationGif}" -o "{destinationGifOpt}"', 
+    'gifsicle_pipe'        : 'gifsicle {gifsicle_opts}', 
+}
+
+DEFAULTS = {
+    'fps'                    : 15,
+    'size'                   : '640:0',
+    'resize_mode'            : RESIZE_FILTERS[0],
+    'start'                  : -1,
+    'end'                    : -1,
+    'dither'                 : DITHER_MODES[0],
+    'bayer_scale'            : 2,
+    'mode'                   : GENERATION_MODES[0],
+    'log'                    : LOG_MODES[0],
+    'charenc'                : 'UTF-8',
+    'onestep'                : False,
+    'twopass'                : False,
+    'optimize'               : False,
+    'optimizer'              : OPTIMIZERS[0],
+    'gifsicle_level'         : GIFSICLE_LEVELS[-1],
+    'lossy'                  : 0,
+    'gifsicle_colors'        : None,
+    'gifsicle_threads'       : 1,
+    'burn_track'             : -1,
+    'burn_file'              : None,
+    'cache_dir'              : None,
+    'palette_cache'          : False,
+    'palette_cache_size'     : 64 * 1024**2,
+    'palette_cache_entries'  : 10000,
+    'proxy_cache'            : False,
+    'proxy_cache_size'       : 4 * 1024**3,
+    'proxy_cache_entries'    : 1000,
+    'variants'               : None,
+    'segments'               : 1,
+    'palette_engine'         : PALETTE_ENGINES[0],
+    'palette_downscale'      : 1,
+    'palette_frame_step'     : 1,
+    'palette_early_stop'     : False,
+    'palette_sample'         : None,
+    'keyframe_index'         : False,
+    'subtitle_cache'         : False,
+    'probe'                  : False,
+    'palette_colors'         : 256,
+    'max_bytes'              : None,
+    'tmp_dir'                : None,
+    'stage_timeout'          : None,
+    'nice'                   : 0,
+    'cpu_affinity'           : None,
+    'memory_limit'           : None,
+    'threads'                : None,
+    'filter_threads'         : None,
+    'filter_complex_threads' : None,
+    'thread_budget'          : THREAD_BUDGET_POLICIES[0],
+}
+
+# Path of the source and destination when they are stdin and stdout
+PIPE_PATH = '-'
+
+# Subtitle files cut in process (the others are cut by FFmpeg), and the ASS header of the SubRip ones (the FFmpeg default one)
+TEXT_SUBTITLE_EXTENSIONS = ['.srt', '.ass', '.ssa']
+SRT_TIMING = re.compile(r'^\s*(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)')
+SRT_TAG = re.compile(r'<(/?)([a-zA-Z]+)([^>]*)>')
+SRT_FONT_ATTRIBUTE = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+ASS_TIME = re.compile(r'^(\d+):(\d+):(\d+)[.:](\d+)$')
+SRT_ASS_HEADER = '''[Script Info]
+; Script generated by video2gif
+ScriptType: v4.00+
+PlayResX: 384
+PlayResY: 288
+ScaledBorderAndShadow: yes
+YCbCr Matrix: None
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,16,&Hffffff,&Hffffff,&H0,&H0,0,0,0,0,100,100,0,0,1,1,0,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+'''
+
+# Options that can be changed by each output variant of a job
+VARIANT_OPTIONS = ['fps', 'size', 'resize_mode', 'dither', 'bayer_scale', 'mode', 'onestep']
+STAGE_MESSAGES = {
+    'subextract'           : 'Extracting subtitles...',
+    'subcut'               : 'Extracting subtitles...',
+    'subextractall'        : 'Extracting subtitle tracks...',
+    'palettegen'           : 'Creating Palette...',
+    'palettegen_numpy'     : 'Creating Palette...',
+    'gifcreate'            : 'Creating GIF...',
+    'gifcreate_fused'      : 'Creating GIF...',
+    'gifcreate_fused_save' : 'Creating GIF...',
+    'gifcreate_variants'   : 'Creating GIFs...',
+    'gifcreate_onestep'    : 'Creating GIF...',
+    'proxycreate'          : 'Creating proxy...',
+    'budgetsample'         : 'Sampling clip...',
+    'budgettrial'          : 'Estimating GIF size...',
+    'gifsicle'             : 'Optimize GIF...',
+    'gifsicle_pipe'        : 'Optimize GIF...',
+    'gifoptimize'          : 'Optimize GIF...',
+    'spool'                : 'Reading source...',
+    'probe'                : 'Reading source info...',
+    'keyindex'             : 'Indexing source keyframes...',
+    'gifstitch'            : 'Joining GIF segments...',
 }
 
+# In process palette engines: the histogram is checked every PALETTE_STABLE_FRAMES frames (with early stop),
+# and it is stable when less than PALETTE_STABLE_DELTA of the pixels moved to other bins
+PALETTE_STABLE_FRAMES = 8
+PALETTE_STABLE_DELTA  = 0.002
+KMEANS_ITERATIONS     = 16
+KMEANS_BATCH          = 8192
+
+# Max frames of a 'count:K' palette sample, each one is read by its own input (and decoder)
+PALETTE_SAMPLE_MAX_COUNT = 64
+
+# Bounds of the keyframe index cache (an index is a few bytes for each keyframe of a source) and of the source info cache
+INDEX_CACHE_SIZE    = 256 * 1024**2
+INDEX_CACHE_ENTRIES = 10000
+PROBE_CACHE_SIZE    = 64 * 1024**2
+PROBE_CACHE_ENTRIES = 10000
+
+# Bounds of the subtitle cache (the whole subtitle tracks of the sources, as ASS), and the codecs of the tracks that can be
+# converted to ASS (bitmap subtitles cannot)
+SUBTITLE_CACHE_SIZE    = 1024**3
+SUBTITLE_CACHE_ENTRIES = 10000
+TEXT_SUBTITLE_CODECS   = ['ass', 'ssa', 'subrip', 'srt', 'mov_text', 'webvtt', 'text']
+
+# Lines of the FFmpeg '-progress' blocks (written on stderr with the log lines), a block ends with 'progress'
+PROGRESS_LINE = re.compile(r'^(frame|fps|stream_\d+_\d+_q|bitrate|total_size|out_time_us|out_time_ms|out_time|dup_frames|drop_frames|speed|progress)=(.*)$')
+
+# Bounds of the toolchain cache, that keeps the version and the features of the programs
+TOOLCHAIN_CACHE_SIZE    = 16 * 1024**2
+TOOLCHAIN_CACHE_ENTRIES = 100
+
+# First Gifsicle version with the lossy compression and the threads
+GIFSICLE_LOSSY_VERSION = (1, 92)
+
+# Max width and height of a GIF
+GIF_MAX_SIZE = 65535
+
+# Target size search (max_bytes): the clip is sampled by BUDGET_WINDOWS windows of BUDGET_WINDOW seconds (shorter
+# clips are sampled whole), at most BUDGET_MAX_TRIALS settings are encoded from the sample and at most BUDGET_MAX_ENCODES
+# GIFs are created. Each step of the search lowers in turn the colors, the fps and the size (by BUDGET_SCALE).
+BUDGET_WINDOWS     = 3
+BUDGET_WINDOW      = 2.0
+BUDGET_MAX_TRIALS  = 8
+BUDGET_MAX_ENCODES = 3
+BUDGET_COLORS      = [256, 192, 128, 96, 64, 48, 32, 16]
+BUDGET_FPS         = [25, 20, 15, 12, 10, 8, 6, 5]
+BUDGET_SCALE       = 0.85
+BUDGET_MIN_WIDTH   = 96
+
+# Min duration (in seconds) of a segment encoded in parallel, shorter segments cost more than they save
+SEGMENT_MIN_DURATION = 2.0
+
+''' Errors '''
+
+class Video2GifError(Exception):
+    '''Base class of the errors raised by the conversion API'''
+
+class InvalidJobError(Video2GifError, ValueError):
+    '''A job option is unknown or not valid'''
+
+class MissingProgramsError(Video2GifError):
+    '''A program required by the job (ffmpeg, gifsicle), or a feature of it, is not reachable'''
+    
+    def __init__(self, programs):
+        super(MissingProgramsError, self).__init__('Missing programs: %s' % ', '.join(programs))
+        self.programs = programs
+
+class SizeLimitError(Video2GifError):
+    '''The GIF does not fit in the max size of the job, even with the smallest settings tried'''
+
+class QueueFullError(Video2GifError):
+    '''The conversion queue of the server is full'''
+
+class CommandError(Video2GifError):
+    '''A stage command failed (or it could not be executed)'''
+    
+    def __init__(self, stage, cmd_line, returncode=None, reason=None):
+        if reason is None:
+            reason = 'exit code %s' % returncode
+        super(CommandError, self).__init__("Stage '%s' failed (%s)" % (stage, reason))
+        self.stage = stage
+        self.cmd_line = cmd_line
+        self.returncode = returncode
+
+class StageTimeoutError(CommandError):
+    '''A stage command was killed because it ran longer than the stage timeout'''
+    
+    def __init__(self, stage, cmd_line, timeout):
+        super(StageTimeoutError, self).__init__(stage, cmd_line, reason='timed out after %g seconds' % timeout)
+        self.timeout = timeout
+
 ''' Utils '''
 
 def format_time(seconds):
@@ -752,155 +1017,1933 @@ def ffmpeg_escape(s):
     else:
         return re.escape(s)
 
+def setup_fonts():
+    # If the OS is windows, set env vars for font config
+    if IS_WIN:
+        os.environ['FC_CONFIG_DIR']     = os.path.join(CURRENT_DIR, 'fonts')
+        os.environ['FONTCONFIG_PATH']   = os.path.join(CURRENT_DIR, 'fonts')
+        os.environ['FONTCONFIG_FILE']   = 'fonts.conf'
+
 def clean_files(args):
-    print('An error occurred!')
-    
     # Remove temp and dirty files
-    if os.path.isfile(args['subtitles_unescaped']):
-        os.remove(args['subtitles_unescaped'])
-    if os.path.isfile(args['palette']):
-        os.remove(args['palette'])
-    if os.path.isfile(args['destinationGif']):
-        os.remove(args['destinationGif'])
-    if os.path.isfile(args['destinationGifOpt']):
-        os.remove(args['destinationGifOpt'])
+    remove_workdir(args['workdir'])
+    for output in args['outputs']:
+        for path in (output['destinationGif'], output['destinationGifOpt']):
+            if path != PIPE_PATH and os.path.isfile(path):
+                os.remove(path)
+
+# Work directories of the running jobs (removed at exit, if a job is interrupted) and roots already swept
+_WORKDIRS = set()
+_SWEPT_ROOTS = set()
+_WORKDIRS_LOCK = threading.Lock()
+
+def temp_root(tmp_dir=None):
+    '''
+    Directory where the work directories are created: 'tmp_dir', the VIDEO2GIF_TMPDIR environment variable, a RAM-backed
+    directory (/dev/shm) if it is available with enough free space, or the system temp directory
+    '''
+    
+    root = tmp_dir or os.environ.get(TMP_DIR_ENV)
+    if root:
+        return os.path.abspath(root)
+    if hasattr(os, 'statvfs') and os.path.isdir(RAM_TMP_DIR) and os.access(RAM_TMP_DIR, os.W_OK | os.X_OK):
+        try:
+            stats = os.statvfs(RAM_TMP_DIR)
+            if stats.f_bavail * stats.f_frsize >= RAM_TMP_MIN_FREE:
+                return RAM_TMP_DIR
+        except OSError:
+            pass
+    return tempfile.gettempdir()
+
+def process_alive(pid):
+    '''If a process is running (always True on Windows, where it is not checked)'''
+    
+    if IS_WIN:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def sweep_workdirs(root):
+    '''Remove the work directories left in 'root' by killed (or crashed) processes, once for each process'''
+    
+    with _WORKDIRS_LOCK:
+        if root in _SWEPT_ROOTS:
+            return
+        _SWEPT_ROOTS.add(root)
+    
+    now = time.time()
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        match = WORKDIR_NAME.match(name)
+        path = os.path.join(root, name)
+        if not match or int(match.group(1)) == os.getpid() or not os.path.isdir(path):
+            continue
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+        if age > ORPHAN_MAX_AGE or (age > ORPHAN_MIN_AGE and not process_alive(int(match.group(1)))):
+            LOGGER.debug('Removing the work directory of a dead process: %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+def make_workdir(tmp_dir=None):
+    '''Create the private work directory of a job (the temp files of its stages), it is removed at exit if the job is interrupted'''
+    
+    root = temp_root(tmp_dir)
+    sweep_workdirs(root)
+    workdir = tempfile.mkdtemp(prefix='%s%d_' % (TEMP_PREFIX, os.getpid()), dir=root)
+    with _WORKDIRS_LOCK:
+        _WORKDIRS.add(workdir)
+    return workdir
+
+def remove_workdir(workdir):
+    shutil.rmtree(workdir, ignore_errors=True)
+    with _WORKDIRS_LOCK:
+        _WORKDIRS.discard(workdir)
+
+@atexit.register
+def remove_workdirs():
+    # Work directories of the jobs interrupted by an exception or a signal
+    with _WORKDIRS_LOCK:
+        workdirs = list(_WORKDIRS)
+    for workdir in workdirs:
+        remove_workdir(workdir)
+
+# Child processes of the running stages (killed at exit, if a job is interrupted)
+_PROCESSES = set()
+_PROCESSES_LOCK = threading.Lock()
+
+@atexit.register
+def kill_processes():
+    # Registered after remove_workdirs, so it is called before it (the children are not writing in the work directories)
+    with _PROCESSES_LOCK:
+        procs = list(_PROCESSES)
+    for p in procs:
+        kill_process(p)
+
+def process_options(args):
+    '''
+    Popen keyword arguments of a child process of a stage (POSIX only): the process gets its own session (and so its own
+    process group), so it is killed with its children, and the nice level, CPU affinity and memory limit of the job are
+    set by a function called in the child before executing the program, passed only if one of them is set (or with
+    Python 2, that cannot start a new session otherwise)
+    '''
+    
+    if IS_WIN:
+        return {}
+    
+    nice, cpus, memory_limit = args.get('nice'), args.get('cpu_affinity'), args.get('memory_limit')
+    options = {}
+    new_session = sys.version_info >= (3, 2)
+    if new_session:
+        options['start_new_session'] = True
+    if not new_session or nice or cpus or memory_limit:
+        def setup():
+            if not new_session:
+                os.setsid()
+            if nice:
+                os.nice(nice)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+            if memory_limit:
+                # The address space is limited (the resident memory limit is not enforced by Linux)
+                hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+                limit = memory_limit if hard == resource.RLIM_INFINITY else min(memory_limit, hard)
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        options['preexec_fn'] = setup
+    return options
+
+def start_process(argv, args, threads=0, **kwargs):
+    '''
+    Start a child process of a stage (the Popen keyword arguments are passed as they are), with the limits of the job;
+    it is killed if it runs longer than the stage timeout, and its 'timed_out' attribute is set
+    
+    The 'threads' taken from the thread budget are given back when the process is waited (or if it cannot be started).
+    '''
+    
+    try:
+        p = Popen(argv, **dict(process_options(args), **kwargs))
+    except BaseException:
+        if threads:
+            THREAD_BUDGET.release(threads)
+        raise
+    p.budget_threads = threads
+    p.timed_out = False
+    p.timer = None
+    p.cancel = args.get('cancel')
+    with _PROCESSES_LOCK:
+        _PROCESSES.add(p)
+        cancelled = p.cancel is not None and p.cancel.is_set()
+    if cancelled:
+        # The conversion has been cancelled while the command was starting, so the stage fails
+        kill_process(p)
+    if args.get('stage_timeout'):
+        p.timer = threading.Timer(args['stage_timeout'], timeout_process, [p, args['stage_timeout']])
+        p.timer.daemon = True
+        p.timer.start()
+    return p
+
+def timeout_process(p, timeout):
+    with _PROCESSES_LOCK:
+        if p not in _PROCESSES:
+            # Already ended
+            return
+        p.timed_out = timeout
+    LOGGER.debug('Killing the process %d, running for more than %g seconds' % (p.pid, timeout))
+    kill_process(p)
+
+def kill_process(p):
+    '''Kill a child process, with its process group (its own children) if it is not on Windows'''
+    
+    try:
+        if IS_WIN:
+            p.kill()
+        else:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # Already ended
+        pass
+
+def cancel_commands(cancel):
+    '''
+    Cancel the conversions started with the 'cancel' event from another thread: the event is set, and their commands
+    are killed (the ones started later too), so their stages fail and their files are removed. The in process stages
+    (e.g. the palette engines, the builtin optimizer) are not interrupted, the conversion stops at its next command.
+    '''
+    
+    with _PROCESSES_LOCK:
+        cancel.set()
+        procs = [p for p in _PROCESSES if p.cancel is cancel]
+    for p in procs:
+        kill_process(p)
+
+def process_error(cmd_name, cmd_line, p, reason=None):
+    '''The error of a failed child process: StageTimeoutError if it was killed by the stage timeout, CommandError otherwise'''
+    
+    if getattr(p, 'timed_out', False):
+        return StageTimeoutError(cmd_name, cmd_line, p.timed_out)
+    return CommandError(cmd_name, cmd_line, returncode=p.returncode, reason=reason)
+
+def available_cpus():
+    '''Number of CPUs the process can run on'''
+    
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return cpu_count()
+
+class ThreadBudget(object):
+    '''
+    Threads of the FFmpeg commands running in the process, split among them so that concurrent jobs do not oversubscribe
+    the CPUs (each FFmpeg command uses a thread for each CPU, by default)
+    
+    With the 'throughput' policy a command starts at once with an even share of the free CPUs among the commands expected
+    to run and not started yet (the workers of a batch, the segments of a clip, the conversions in progress), so a single
+    thread each when many run; with the 'latency' policy it waits until THREAD_BUDGET_WIDTH threads are free, so fewer
+    commands run, each one faster. A command never waits when nothing else is running.
+    
+    Args:
+        cpus (int): Optional, the threads to split (Default: the CPUs the process can run on)
+    '''
+    
+    def __init__(self, cpus=None):
+        self.cpus = cpus or available_cpus()
+        self.used = 0
+        self.running = 0
+        self.expected = [] # Commands expected to run at the same time, by each pool of workers running
+        self.conversions = 0 # Conversions in progress, each one running a command at least
+        self._cond = threading.Condition()
+    
+    @property
+    def jobs(self):
+        '''Commands expected to run at the same time, the most expected by a running pool of workers'''
+        
+        return max(self.expected) if self.expected else 1
+    
+    def expect(self, jobs):
+        '''Expect the commands of a pool of workers to run at the same time, until unexpect() is called'''
+        
+        with self._cond:
+            self.expected.append(jobs)
+    
+    def unexpect(self, jobs):
+        '''Stop expecting the commands of a pool of workers, when it ends'''
+        
+        with self._cond:
+            self.expected.remove(jobs)
+    
+    @contextlib.contextmanager
+    def expecting(self, jobs):
+        '''Expect the commands of a pool of workers while the block runs'''
+        
+        self.expect(jobs)
+        try:
+            yield
+        finally:
+            self.unexpect(jobs)
+    
+    def enter(self):
+        '''Count a conversion in progress, so the concurrent conversions of the API split the CPUs also if not expected'''
+        
+        with self._cond:
+            self.conversions += 1
+    
+    def leave(self):
+        with self._cond:
+            self.conversions -= 1
+    
+    def acquire(self, policy, limit=None, block=True):
+        '''
+        Take the threads of a command
+        
+        Args:
+            policy (str): 'throughput' or 'latency'
+            limit (int): Optional, the max threads of the command (e.g. the CPUs of its affinity)
+            block (bool): If the free threads are waited (or else None is returned when they are not enough)
+        
+        Returns:
+            int: the threads, to be given back with release()
+        '''
+        
+        limit = min(limit or self.cpus, self.cpus)
+        with self._cond:
+            while True:
+                free = self.cpus - self.used
+                if policy == 'latency':
+                    threads = min(THREAD_BUDGET_WIDTH, limit)
+                    ready = free >= threads or not self.running
+                else:
+                    # The free threads are split among the expected commands not started yet, at least one each
+                    expected = max(self.running + 1, self.jobs, self.conversions)
+                    threads = max(1, min(free // (expected - self.running), limit))
+                    ready = True
+                if ready:
+                    self.used += threads
+                    self.running += 1
+                    return threads
+                if not block:
+                    return None
+                self._cond.wait()
+    
+    def release(self, threads):
+        with self._cond:
+            self.used -= threads
+            self.running -= 1
+            self._cond.notify_all()
+
+# Shared by the jobs of the process (batch, server and API ones)
+THREAD_BUDGET = ThreadBudget()
+
+def stage_threads(args, block=True):
+    '''
+    Threads of an FFmpeg command of a stage, taken from the thread budget if the job uses it and 'threads' is not set
+    
+    Returns:
+        int: the threads taken (0 if not taken from the budget), None if they are not free (only if not 'block')
+    '''
+    
+    if args.get('thread_budget', 'off') == 'off' or args.get('threads') is not None:
+        return 0
+    limit = len(args['cpu_affinity']) if args.get('cpu_affinity') else None
+    return THREAD_BUDGET.acquire(args['thread_budget'], limit, block)
+
+def thread_options(argv, args, threads):
+    '''
+    Add the thread options of the job to an FFmpeg command line: '-threads' before each input (the decoders) and the
+    filter threads; the ones not set are the 'threads' taken from the thread budget (if any)
+    
+    Returns:
+        int: the decoding threads, None if FFmpeg chooses them
+    '''
+    
+    def value(name):
+        return args.get(name) if args.get(name) is not None else (threads or None)
+    
+    options = []
+    for name in ('filter_threads', 'filter_complex_threads'):
+        if value(name) is not None:
+            options.extend(['-' + name, str(value(name))])
+    argv[1:1] = options
+    
+    decoding = value('threads')
+    if decoding is not None:
+        for i in reversed([i for i, arg in enumerate(argv) if arg == '-i']):
+            argv[i:i] = ['-threads', str(decoding)]
+    return decoding
+
+def exit_on_signals():
+    '''Exit on SIGTERM and SIGHUP as on Ctrl+C (the work directories are removed), for the command line'''
+    
+    def exit_on_signal(signum, frame):
+        raise SystemExit(128 + signum)
+    for name in ('SIGTERM', 'SIGHUP'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), exit_on_signal)
 
 def check_programs(args):
-    global FNULL
+    '''
+    Check the programs needed by a job, and the FFmpeg filters and encoders used by its stages, with the toolchain registry
+    (the programs are executed only when their features are not known yet)
+    
+    Returns:
+        list: the missing programs and features
+    '''
     
     programs = ['ffmpeg']
-    if args['optimize']:
+    if args['optimize'] and args['optimizer'] == 'gifsicle':
         programs.append('gifsicle')
+    if args['segments'] != 1 or (args['palette_sample'] or '').startswith('count:') or args['keyframe_index'] or args['probe'] or args['max_bytes'] or (args['subtitle_cache'] and args['burn_track'] > -1):
+        # The duration of the clip is needed to split it (or to sample its frames), the keyframes to index it, and the source info to check the job (and to fit it in a size, or to list its subtitle tracks)
+        programs.append('ffprobe')
     
     missing = []
+    if (args['palette_engine'] != 'ffmpeg' or (args['optimize'] and args['optimizer'] == 'builtin')) and numpy is None:
+        missing.append('numpy')
+    infos = {}
     for p in programs:
-        try:
-            call(p, stdout=FNULL, stderr=FNULL)
-        except OSError:
+        infos[p] = program_info(p, args['cache_dir'])
+        if infos[p] is None:
             missing.append(p)
     
+    # Features are checked only if the lists of the build were read
+    ffmpeg = infos['ffmpeg']
+    if ffmpeg is not None:
+        filters = ['fps', 'scale', 'split', 'palettegen', 'paletteuse']
+        encoders = ['gif', 'png']
+        if args['burn_track'] > -1 or args['burn_file']:
+            filters.append('subtitles')
+        if args['palette_frame_step'] > 1:
+            filters.append('framestep')
+        if args['segments'] != 1 or args['keyframe_index'] or args['palette_sample']:
+            filters.extend(['trim', 'setpts', 'concat'])
+        if args['max_bytes']:
+            filters.extend(['select', 'setpts'])
+        if args['proxy_cache'] or args['mode'] == 'single' or args['max_bytes']:
+            encoders.append('ffv1')
+        if args['palette_engine'] != 'ffmpeg':
+            encoders.append('ppm')
+        if ffmpeg['filters']:
+            missing.extend('ffmpeg %s filter' % f for f in filters if f not in ffmpeg['filters'])
+        if ffmpeg['encoders']:
+            missing.extend('ffmpeg %s encoder' % e for e in encoders if e not in ffmpeg['encoders'])
+    
+    gifsicle = infos.get('gifsicle')
+    if gifsicle is not None and (args['lossy'] or args['gifsicle_threads'] != 1) and version_tuple(gifsicle['version']) < GIFSICLE_LOSSY_VERSION:
+        missing.append('gifsicle %s (--lossy and --threads)' % '.'.join(str(n) for n in GIFSICLE_LOSSY_VERSION))
+    
     return missing
 
-def cmd_exec(cmd_name, args):
-    global FNULL
+def version_tuple(version):
+    '''The numbers of a version string (e.g. (1, 96) for '1.96'), an unknown version is the greatest one'''
     
-    # Exec command line
-    cmd_line = COMMANDS[cmd_name].format(**args)
-    if args['log'] in LOG_DEBUG:
-        LOGGER.debug('Exec command line:\n%s\n\n' % cmd_line)
-        res = call(shlex.split(cmd_line), stdout=sys.stderr)
-        print('\n', file=sys.stderr)
+    if not version:
+        return (float('inf'),)
+    return tuple(int(n) for n in re.findall(r'\d+', version.split('-')[0])[:3]) or (float('inf'),)
+
+def wait_process(p):
+    '''
+    Wait the end of a process
+    
+    Returns:
+        tuple: the exit code and the CPU time (user and system, in seconds) of the process, None if not available (e.g. on Windows)
+    '''
+    
+    cpu = None
+    if hasattr(os, 'wait4'):
+        try:
+            status, usage = os.wait4(p.pid, 0)[1:]
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            cpu = usage.ru_utime + usage.ru_stime
+        except OSError:
+            # Already waited
+            p.wait()
     else:
-        res = call(shlex.split(cmd_line), stdout=FNULL, stderr=FNULL)
+        p.wait()
     
-    # In case of errors, clean and exit
-    if res != 0:
-        clean_files(args)
-        raise SystemExit
+    # Not killed at exit or by the stage timeout anymore
+    with _PROCESSES_LOCK:
+        if p not in _PROCESSES:
+            return p.returncode, cpu
+        _PROCESSES.discard(p)
+    if getattr(p, 'timer', None) is not None:
+        p.timer.cancel()
+    if getattr(p, 'budget_threads', 0):
+        THREAD_BUDGET.release(p.budget_threads)
+    return p.returncode, cpu
+
+def progress_reader(stream, cmd_name, args, state, passthrough):
+    '''
+    Read the '-progress' blocks written by FFmpeg on its stderr (the log lines are written to stderr if 'passthrough'),
+    keeping the last values in 'state' and calling back args['progress'] (if set) at the end of each block
+    '''
+    
+    start_time = time.time()
+    block = {}
+    for raw_line in iter(stream.readline, b''):
+        line = raw_line.decode('utf-8', 'replace').rstrip()
+        if not progress_line(line, block, state, cmd_name, args, start_time) and passthrough:
+            print(line, file=sys.stderr)
+    stream.close()
+
+def progress_line(line, block, state, cmd_name, args, start_time):
+    '''
+    Parse a line written by FFmpeg with '-progress', collecting the values of the current block in 'block'; at the end
+    of the block 'state' is updated and args['progress'] (if set) is called back
     
+    The callback gets the stage name and a dict with 'frames', 'fps', 'speed', 'time' (the output time), 'elapsed',
+    'eta' (None if the output duration is unknown) and 'done'.
+    
+    Returns:
+        bool: False if the line is not a progress one (a log line)
+    '''
+    
+    def number(value, default=None):
+        try:
+            return float(value.rstrip('x'))
+        except (AttributeError, ValueError):
+            return default
+    
+    match = PROGRESS_LINE.match(line)
+    if not match:
+        return False
+    block[match.group(1)] = match.group(2).strip()
+    if match.group(1) != 'progress':
+        return True
+    
+    elapsed = time.time() - start_time
+    out_time = number(block.get('out_time_us'), 0) / 1000000.0
+    duration = args.get('output_duration')
+    eta = None
+    if duration and out_time > 0:
+        eta = max(duration - out_time, 0) * elapsed / out_time
+    state.update({
+        'frames'    : int(number(block.get('frame'), 0)),
+        'fps'       : number(block.get('fps')),
+        'speed'     : number(block.get('speed')),
+        'time'      : out_time,
+        'elapsed'   : elapsed,
+        'eta'       : 0 if block['progress'] == 'end' else eta,
+        'done'      : block['progress'] == 'end',
+    })
+    block.clear()
+    
+    if args.get('progress') is not None:
+        try:
+            args['progress'](cmd_name, dict(state))
+        except Exception:
+            # The stderr must be read until the end, or FFmpeg blocks
+            LOGGER.debug('Progress callback failed:\n%s' % traceback.format_exc())
+    return True
+
+def program_argv(cmd_line):
+    '''Split a command line, with the program path resolved by the toolchain registry (kept as is if not found)'''
+    
+    argv = shlex.split(cmd_line)
+    argv[0] = find_program(argv[0]) or argv[0]
+    return argv
 
-''' Args parser '''
+def binary_stream(stream):
+    # Python 3 text streams wrap a binary buffer
+    return getattr(stream, 'buffer', stream)
 
-def int_not_negative(value):
-    try:
-        ivalue = int(value)
-        if ivalue < 0:
-            raise argparse.ArgumentTypeError("'%s' is a negative int value" % value)
-        return ivalue
-    except ValueError:
-        raise argparse.ArgumentTypeError("'%s' is not an int value" % value)
+def cmd_exec(cmd_name, args, notify=None, stdin=None, stdout=None):
+    '''
+    Execute a stage command line
+    
+    Args:
+        cmd_name (str): The stage name (a key of COMMANDS)
+        args (dict): The values used to format the command line
+        notify (callable): Optional, called with the stage message before the execution
+        stdin (file): Optional, the stdin of the command (Default: null device)
+        stdout (file): Optional, the stdout of the command (Default: null device, or stderr if the log is verbose)
+    
+    Returns:
+        StageResult: the result of the stage
+    
+    Raises:
+        CommandError: if the command fails or it cannot be executed
+    '''
+    
+    return cmd_pipe([cmd_name], args, notify, stdin, stdout)[0]
 
-def file_path_read(fpath):
+def cmd_pipe(cmd_names, args, notify=None, stdin=None, stdout=None):
+    '''
+    Execute stage command lines connected by pipes (the stdout of each one is the stdin of the next one)
+    
+    Args:
+        cmd_names (list): The stage names (keys of COMMANDS)
+        args (dict): The values used to format the command lines
+        notify (callable): Optional, called with the message of each stage before the execution
+        stdin (file): Optional, the stdin of the first command (Default: null device)
+        stdout (file): Optional, the stdout of the last command (Default: null device, or stderr if the log is verbose)
+    
+    Returns:
+        list: a StageResult for each stage
+    
+    Raises:
+        CommandError: if a command fails or it cannot be executed (the first one that failed is reported)
+    '''
+    
+    if notify is not None:
+        for cmd_name in cmd_names:
+            notify(STAGE_MESSAGES[cmd_name])
+    
+    debug = args['log'] in LOG_DEBUG
+    devnull = open(os.devnull, 'r+')
+    if stdin is None:
+        stdin = devnull
+    if stdout is None:
+        stdout = sys.stderr if debug else devnull
+    
+    # Exec command lines, FFmpeg ones write their progress on stderr
+    cmd_lines = [COMMANDS[cmd_name].format(**args) for cmd_name in cmd_names]
+    procs, readers = [], []
+    start_time = time.time()
     try:
-        if not (os.path.isfile(fpath) and os.access(fpath, os.R_OK)):
-            raise argparse.ArgumentTypeError("'%s' is not a valid path or the file is not readable" % fpath)
-        return fpath
-    except OSError:
-        raise argparse.ArgumentTypeError("'%s' is not a valid path or the file is not readable" % fpath)
-
-def file_path_write(fpath):
+        for i, (cmd_name, cmd_line) in enumerate(zip(cmd_names, cmd_lines)):
+            if debug:
+                LOGGER.debug('Exec command line:\n%s\n\n' % cmd_line)
+            last = i == len(cmd_names) - 1
+            argv = program_argv(cmd_line)
+            progress = os.path.splitext(os.path.basename(argv[0]))[0] == 'ffmpeg'
+            threads, decoding = 0, None
+            if progress:
+                threads = stage_threads(args)
+                decoding = thread_options(argv, args, threads)
+                argv[1:1] = ['-progress', 'pipe:2', '-nostats']
+            procs.append(start_process(
+                argv, args, threads,
+                stdin=procs[-1].stdout if procs else stdin,
+                stdout=stdout if last else PIPE,
+                stderr=PIPE if progress else (None if debug else devnull)
+            ))
+            
+            procs[-1].threads = decoding
+            state = {}
+            reader = None
+            if progress:
+                reader = threading.Thread(target=progress_reader, args=(procs[-1].stderr, cmd_name, args, state, debug))
+                reader.daemon = True
+                reader.start()
+            readers.append((reader, state))
+            
+            # Only the next command keeps the pipe open, so the previous one gets an error if the next one ends
+            if len(procs) > 1:
+                procs[-2].stdout.close()
+    except (OSError, SubprocessError) as e:
+        for p in procs:
+            kill_process(p)
+            wait_process(p)
+        devnull.close()
+        raise CommandError(cmd_name, cmd_line, reason=str(e))
+    except BaseException:
+        # Interrupted while starting the commands, the ones already started are killed
+        for p in procs:
+            kill_process(p)
+            wait_process(p)
+        devnull.close()
+        raise
+    
+    results = []
     try:
-        if not os.access(os.path.abspath(os.path.join(fpath, os.pardir)), os.W_OK):
-            raise argparse.ArgumentTypeError("'%s' is not a valid path or the directory is not writable" % fpath)
-        return fpath
-    except OSError:
-        raise argparse.ArgumentTypeError("'%s' is not a valid path or the directory is not writable" % fpath)
+        for cmd_name, cmd_line, p, (reader, state) in zip(cmd_names, cmd_lines, procs, readers):
+            res, cpu = wait_process(p)
+            if reader is not None:
+                reader.join()
+            results.append(StageResult(cmd_name, cmd_line, res, time.time() - start_time, cpu=cpu, frames=state.get('frames'),
+                                       fps=state.get('fps'), speed=state.get('speed'), threads=p.threads))
+    except BaseException:
+        # Interrupted (e.g. Ctrl+C), the children are in their own process groups and they do not get the signal
+        for p in procs:
+            kill_process(p)
+            wait_process(p)
+        raise
+    finally:
+        devnull.close()
+    if debug:
+        print('\n', file=sys.stderr)
+    
+    # A timed out command is reported before the ones that failed because it was killed
+    failed = [(stage, p) for stage, p in zip(results, procs) if stage.returncode != 0]
+    failed.sort(key=lambda item: not item[1].timed_out)
+    if failed:
+        raise process_error(failed[0][0].name, failed[0][0].cmd_line, failed[0][1])
+    
+    return results
 
-def size_string(size_str):
+def cmd_open(cmd_name, args, stdin=None):
     '''
-    Check if the size string passed is correct and purge it
+    Start a stage command line, whose stdout is read by the caller (the returned Popen 'stdout')
     
-    A size string is invalid if:
-    - is None or empty
-    - contains more or less than one ':'
-    - contains non digit chars
-    - not respect the pattern WIDTH:HEIGHT
-    - WIDTH or HEIGHT are positive integers (but both can be 0, that means 'keep the rateo'
+    Raises:
+        CommandError: if the command cannot be executed
+    '''
     
-    Args:
-        size_str (str): The raw time string
+    debug = args['log'] in LOG_DEBUG
+    cmd_line = COMMANDS[cmd_name].format(**args)
+    if debug:
+        LOGGER.debug('Exec command line:\n%s\n\n' % cmd_line)
+    
+    argv = program_argv(cmd_line)
+    threads = stage_threads(args)
+    decoding = thread_options(argv, args, threads)
+    with open(os.devnull, 'r+') as devnull:
+        try:
+            p = start_process(argv, args, threads, stdin=stdin or devnull, stdout=PIPE, stderr=None if debug else devnull)
+        except (OSError, SubprocessError) as e:
+            raise CommandError(cmd_name, cmd_line, reason=str(e))
+    p.threads = decoding
+    return p
+
+''' GIF '''
 
+def gif_sub_blocks_end(data, pos):
+    '''Position after the data sub-blocks starting at 'pos' (each one prefixed by its size, up to an empty one)'''
+    
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+def gif_read(path):
+    '''
+    Split a GIF in its blocks
+    
     Returns:
-        str: the size string purged
+        tuple: the header (with the logical screen descriptor), the global color table,
+               the application extensions (e.g. the loop one) and the frames,
+               each one a list of its extension blocks (e.g. the delay one) and its image block
     
     Raises:
-        argparse.ArgumentTypeError: if the size string passed is invalid
+        ValueError: if the file is not a valid GIF
     '''
     
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    if data[:6] not in (b'GIF87a', b'GIF89a') or len(data) < 14:
+        raise ValueError("'%s' is not a GIF" % path)
+    
+    pos = 13
+    color_table = data[pos:pos]
+    if data[10] & 0x80:
+        color_table = data[pos:pos + 3 * 2 ** ((data[10] & 0x07) + 1)]
+        pos += len(color_table)
+    
+    app_extensions, frames, extensions = [], [], []
     try:
-        # Strip the size string
-        size_str = size_str.strip()
-        
-        # Base checks
-        if not size_str:
-            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
-        
-        # Check pattern
-        size_split = size_str.split(':')
-        if not size_str or len(size_split)!=2:
-            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
-        
-        width, height = int(size_split[0]), int(size_split[1])
-        if width<0 or height<0:
-            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
-        
-        # If one value is 0, convert to -1 (FFmpeg standard to keep rateo)
-        if width == 0:  width  = -1
-        if height == 0: height = -1
-        
-        # Rebuild the size string
-        return '{}:{}'.format(width, height)
-    except (ValueError, IndexError) as ex:
-        raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
+        while data[pos] != 0x3B:
+            if data[pos] == 0x21:
+                # Extension (graphic control, application, comment...)
+                end = gif_sub_blocks_end(data, pos + 2)
+                if data[pos + 1] == 0xFF:
+                    app_extensions.append(data[pos:end])
+                else:
+                    extensions.append(data[pos:end])
+            elif data[pos] == 0x2C:
+                # Image descriptor, local color table, LZW code size and image data
+                end = pos + 10
+                if data[pos + 9] & 0x80:
+                    end += 3 * 2 ** ((data[pos + 9] & 0x07) + 1)
+                end = gif_sub_blocks_end(data, end + 1)
+                frames.append((extensions, data[pos:end]))
+                extensions = []
+            else:
+                raise ValueError('Unknown block 0x%02X at %d' % (data[pos], pos))
+            pos = end
+    except IndexError:
+        raise ValueError("'%s' is truncated" % path)
+    
+    return data[:13], color_table, app_extensions, frames
 
-def time_string_to_secs(time_string):
+def gif_stitch(segments, starts, fps, destination):
     '''
-    Check if the time string passed is correct and convert it to seconds
+    Join GIF segments (with the same size) in a single GIF
     
-    A time string is invalid if:
-    - is None or empty
-    - contains ',' (to separate seconds and microseconds is used '.')
-    - ends with '.'
-    - contains non digit chars
-    - not respect the pattern ((HH:)MM:)SS(.mm)
+    Header and loop settings are taken from the first segment, the frames of a segment with a different
+    global color table get it as local color table.
+    Frame delays are rounded by each segment from its own start, so they are computed again on the frame
+    times of the whole GIF (as a serial encoding does).
     
     Args:
-        time_string (str): The raw time string
-
-    Returns:
-        float: the time string converted into seconds
+        segments (list): The segment paths, in order
+        starts (list): The start time (in seconds) of each segment
+        fps (int): The frame rate of the segments
+        destination (str): The GIF path
     
     Raises:
-        argparse.ArgumentTypeError: if the time string passed is invalid
+        CommandError: if a segment is not a valid GIF
     '''
     
     try:
-        # Strip the time string
-        time_string = time_string.strip()
-        
-        # Base checks
-        if not time_string or ',' in time_string or time_string.endswith('.'):
-            raise argparse.ArgumentTypeError("'%s' is not a valid time" % time_string)
+        parts = [gif_read(path) for path in segments]
+    except ValueError as e:
+        raise CommandError('gifstitch', '', reason=str(e))
+    
+    header, color_table, app_extensions = parts[0][:3]
+    with open(destination, 'wb') as f:
+        f.write(header)
+        f.write(color_table)
+        for block in app_extensions:
+            f.write(block)
+        
+        for start, (segment_header, segment_table, _, frames) in zip(starts, parts):
+            elapsed = 0 # Centiseconds, from the segment start
+            for extensions, image in frames:
+                for block in extensions:
+                    if block[1] == 0xF9:
+                        # Graphic control extension, with the frame delay: start and end of the frame are moved on the nearest frame times
+                        # (a frame lasts at least 1/fps, the last one of a segment has no next frame to take its duration from)
+                        delay = block[4] | block[5] << 8
+                        first = int(round(start * fps + elapsed * fps / 100.0))
+                        last = max(int(round(start * fps + (elapsed + delay) * fps / 100.0)), first + 1)
+                        elapsed += delay
+                        delay = int(round(last * 100.0 / fps)) - int(round(first * 100.0 / fps))
+                        block = block[:4] + bytearray([delay & 0xFF, delay >> 8]) + block[6:]
+                    f.write(block)
+                
+                if segment_table != color_table and not image[9] & 0x80:
+                    # Keep the segment palette, as local color table
+                    image = image[:9] + bytearray([image[9] & 0x40 | 0x80 | (segment_header[10] & 0x08) << 2 | segment_header[10] & 0x07]) + segment_table + image[10:]
+                f.write(image)
+        f.write(b'\x3B')
+
+def stream_read(stream, size):
+    '''Read exactly 'size' bytes from a stream'''
+    
+    data = stream.read(size)
+    if len(data) < size:
+        raise ValueError('The GIF is truncated')
+    return data
+
+def gif_read_sub_blocks(stream, raw=False):
+    '''Read the data sub-blocks at the current position of a stream (up to the empty one), joined (or as they are, if 'raw')'''
+    
+    chunks = []
+    while True:
+        size = stream_read(stream, 1)
+        if raw:
+            chunks.append(size)
+        if size == b'\x00':
+            return b''.join(chunks)
+        chunks.append(stream_read(stream, bytearray(size)[0]))
+
+def gif_sub_blocks(data):
+    '''Split data in sub-blocks, each one prefixed by its size (up to 255 bytes), ended by an empty one'''
+    
+    blocks = bytearray()
+    for pos in range(0, len(data), 255):
+        chunk = data[pos:pos + 255]
+        blocks.append(len(chunk))
+        blocks += chunk
+    blocks.append(0)
+    return blocks
+
+def lzw_decode(data, min_size):
+    '''
+    Decode the LZW image data of a GIF frame
+    
+    Raises:
+        ValueError: if a code is not valid
+    '''
+    
+    clear = 1 << min_size
+    end = clear + 1
+    table = [bytes(bytearray([i])) for i in range(clear)] + [b'', b'']
+    size = min_size + 1
+    mask = (1 << size) - 1
+    bits = nbits = 0
+    prev = None
+    pixels = bytearray()
+    for byte in bytearray(data):
+        bits |= byte << nbits
+        nbits += 8
+        while nbits >= size:
+            code = bits & mask
+            bits >>= size
+            nbits -= size
+            if code == clear:
+                del table[end + 1:]
+                size = min_size + 1
+                mask = (1 << size) - 1
+                prev = None
+                continue
+            if code == end:
+                return pixels
+            if prev is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                table.append(prev + entry[:1])
+            elif code == len(table):
+                entry = prev + prev[:1]
+                table.append(entry)
+            else:
+                raise ValueError('Invalid LZW code %d' % code)
+            pixels += entry
+            prev = entry
+            if len(table) > mask and size < 12:
+                size += 1
+                mask = (1 << size) - 1
+    return pixels
+
+def lzw_encode(pixels, min_size, alternatives=None):
+    '''
+    Encode the pixels (color indexes) of a GIF frame with LZW, the table is cleared when it is full
+    
+    With 'alternatives' (a color index for each pixel, that can be shown instead of it, e.g. its color instead of the
+    transparent one) each pixel is encoded with the index that continues the current string, or else with the one equal
+    to the previous pixel.
+    '''
+    
+    clear = 1 << min_size
+    end = clear + 1
+    data = bytearray()
+    size = min_size + 1
+    bits, nbits = clear, size
+    table = {}
+    lookup = table.get
+    next_code = end + 1
+    limit = 1 << size
+    pixels = bytearray(pixels)
+    alternatives = bytearray(alternatives) if alternatives is not None else pixels
+    code = previous = pixels[0]
+    for pixel, other in zip(pixels[1:], alternatives[1:]):
+        key = code << 8 | pixel
+        found = lookup(key)
+        if found is None and other != pixel:
+            other_key = code << 8 | other
+            other_found = lookup(other_key)
+            if other_found is not None or other == previous:
+                pixel, key, found = other, other_key, other_found
+        previous = pixel
+        if found is not None:
+            code = found
+            continue
+        
+        bits |= code << nbits
+        nbits += size
+        if next_code == 4096:
+            bits |= clear << nbits
+            nbits += size
+            table = {}
+            lookup = table.get
+            next_code = end + 1
+            size = min_size + 1
+            limit = 1 << size
+        else:
+            table[key] = next_code
+            next_code += 1
+            if next_code > limit and size < 12:
+                size += 1
+                limit <<= 1
+        while nbits >= 8:
+            data.append(bits & 0xFF)
+            bits >>= 8
+            nbits -= 8
+        code = pixel
+    
+    bits |= code << nbits
+    nbits += size
+    if next_code == limit and size < 12:
+        size += 1
+    bits |= end << nbits
+    nbits += size
+    while nbits > 0:
+        data.append(bits & 0xFF)
+        bits >>= 8
+        nbits -= 8
+    return data
+
+def gif_optimize(source, destination):
+    '''
+    Optimize a GIF read from a stream, frame by frame (only the screen and the current frame are kept in memory)
+    
+    Each frame is cropped to the bounding box of the pixels changed on the screen, the unchanged pixels are made transparent
+    (if the frame has a transparent color) and it is encoded again with LZW; frames that change nothing are dropped, their
+    delay is added to the previous frame. Frames that restore the screen after being shown are copied as they are.
+    
+    Args:
+        source (file): The GIF, a binary stream
+        destination (file): The optimized GIF, a binary stream
+    
+    Raises:
+        ValueError: if the source is not a valid GIF
+    '''
+    
+    header = bytearray(stream_read(source, 13))
+    if header[:6] not in (b'GIF87a', b'GIF89a'):
+        raise ValueError('Not a GIF')
+    width, height = struct.unpack('<HH', bytes(header[6:10]))
+    color_table = b''
+    if header[10] & 0x80:
+        color_table = stream_read(source, 3 * 2 ** ((header[10] & 0x07) + 1))
+    destination.write(header[:6].replace(b'GIF87a', b'GIF89a') + header[6:])
+    destination.write(color_table)
+    
+    # Colors on the screen, and their index in the color table that drew them
+    screen = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    shown = numpy.zeros((height, width), dtype=bool)
+    indexes = numpy.zeros((height, width), dtype=numpy.uint8)
+    tables = numpy.full((height, width), -1, dtype=numpy.int32)
+    palettes = {}
+    pending = None # Graphic control extension and image of the last frame, written when the next one is read
+    control = None
+    while True:
+        block = bytearray(stream_read(source, 1))[0]
+        if block == 0x3B:
+            break
+        
+        if block == 0x21:
+            label = stream_read(source, 1)
+            data = gif_read_sub_blocks(source, raw=label != b'\xF9')
+            if label == b'\xF9':
+                control = bytearray(data[:4])
+            else:
+                # Other extensions (loop, comments) are kept in place
+                if pending is not None:
+                    destination.write(b''.join(pending))
+                    pending = None
+                destination.write(b'\x21' + label + data)
+            continue
+        if block != 0x2C:
+            raise ValueError('Unknown block 0x%02X' % block)
+        
+        descriptor = bytearray(stream_read(source, 9))
+        left, top, frame_width, frame_height = struct.unpack('<HHHH', bytes(descriptor[:8]))
+        local_table = b''
+        if descriptor[8] & 0x80:
+            local_table = stream_read(source, 3 * 2 ** ((descriptor[8] & 0x07) + 1))
+        min_size = bytearray(stream_read(source, 1))[0]
+        data = gif_read_sub_blocks(source)
+        control_block = b'\x21\xF9' + gif_sub_blocks(control) if control is not None else b''
+        image = b'\x2C' + descriptor + local_table + bytearray([min_size]) + gif_sub_blocks(data)
+        disposal = (control[0] >> 2) & 0x07 if control is not None else 0
+        transparent = control[3] if control is not None and control[0] & 0x01 else None
+        delay = control[1] | control[2] << 8 if control is not None else 0
+        control = None
+        
+        # Pixels and colors of the frame
+        table = local_table or color_table
+        if table not in palettes:
+            palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+            palette[:len(table) // 3] = numpy.frombuffer(bytes(table), dtype=numpy.uint8).reshape(-1, 3)
+            palettes[table] = (palette, len(palettes))
+        palette, table_id = palettes[table]
+        pixels = numpy.zeros(frame_width * frame_height, dtype=numpy.uint8)
+        decoded = lzw_decode(data, min_size)[:len(pixels)]
+        pixels[:len(decoded)] = numpy.frombuffer(bytes(decoded), dtype=numpy.uint8)
+        pixels = pixels.reshape(frame_height, frame_width)
+        if descriptor[8] & 0x40:
+            # Interlaced rows
+            rows = numpy.concatenate([numpy.arange(start, frame_height, step) for start, step in ((0, 8), (4, 8), (2, 4), (1, 2))])
+            pixels = pixels[numpy.argsort(rows)]
+        
+        # The frame on the screen, clipped
+        frame_height, frame_width = max(min(frame_height, height - top), 0), max(min(frame_width, width - left), 0)
+        pixels = pixels[:frame_height, :frame_width]
+        opaque = pixels != transparent if transparent is not None else numpy.ones(pixels.shape, dtype=bool)
+        colors = palette[pixels]
+        area = (slice(top, top + frame_height), slice(left, left + frame_width))
+        changed = opaque & (~shown[area] | (colors != screen[area]).any(axis=2))
+        if transparent is not None:
+            # Indexes that show the same color of each pixel: its own one, or the one already on the screen if drawn with the same color table
+            same = numpy.where(opaque, pixels, numpy.where(shown[area] & (tables[area] == table_id), indexes[area], transparent))
+        previous = (screen.copy(), shown.copy(), indexes.copy(), tables.copy()) if disposal == 3 else None
+        screen[area][opaque] = colors[opaque]
+        shown[area] |= opaque
+        indexes[area][opaque] = pixels[opaque]
+        tables[area][opaque] = table_id
+        
+        if disposal in (2, 3) or not pixels.size:
+            # The frame is shown and then removed, so it is copied as it is
+            if disposal == 2:
+                shown[area] = False
+                tables[area] = -1
+            elif disposal == 3:
+                screen, shown, indexes, tables = previous
+            if pending is not None:
+                destination.write(b''.join(pending))
+            pending = [control_block, image]
+            continue
+        
+        if not changed.any() and pending is not None and pending[0]:
+            # Nothing changed, the frame lasts more
+            pending_control = bytearray(pending[0])
+            pending_delay = min((pending_control[4] | pending_control[5] << 8) + delay, 0xFFFF)
+            pending_control[4:6] = struct.pack('<H', pending_delay)
+            pending[0] = bytes(pending_control)
+            continue
+        
+        if changed.any():
+            ys, xs = numpy.flatnonzero(changed.any(axis=1)), numpy.flatnonzero(changed.any(axis=0))
+            y0, y1, x0, x1 = ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+        else:
+            y0, y1, x0, x1 = 0, 1, 0, 1
+        # Unchanged pixels are transparent, or of their color if it compresses better
+        box = pixels[y0:y1, x0:x1]
+        alternatives = None
+        if transparent is not None:
+            alternatives = same[y0:y1, x0:x1].astype(numpy.uint8).tobytes()
+            box = numpy.where(changed[y0:y1, x0:x1], box, transparent).astype(numpy.uint8)
+            min_size = max(min_size, transparent.bit_length(), 2)
+        
+        # A local color table equal to the global one is dropped
+        packed = descriptor[8] & 0x87
+        if local_table == color_table:
+            packed, local_table = 0, b''
+        image = (b'\x2C' + struct.pack('<HHHHB', left + x0, top + y0, x1 - x0, y1 - y0, packed) + local_table +
+                 bytearray([min_size]) + gif_sub_blocks(lzw_encode(box.tobytes(), min_size, alternatives)))
+        if pending is not None:
+            destination.write(b''.join(pending))
+        pending = [control_block, image]
+    
+    if pending is not None:
+        destination.write(b''.join(pending))
+    destination.write(b'\x3B')
+
+''' Subtitles '''
+
+def subtitle_time(hours, minutes, seconds, fraction):
+    '''Milliseconds of a subtitle timestamp (the fraction is the digits after the separator)'''
+    
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(round(float('0.' + fraction) * 1000))
+
+def ass_time(ms):
+    '''ASS timestamp (H:MM:SS.cc) of a time in milliseconds'''
+    
+    cs = ms // 10
+    return '%d:%02d:%02d.%02d' % (cs // 360000, cs // 6000 % 60, cs // 100 % 60, cs % 100)
+
+def srt_text_to_ass(lines):
+    '''Text of an ASS event from the lines of a SubRip one, the HTML-like tags are replaced with the ASS override tags'''
+    
+    fonts = [] # Overrides set by each open font tag, reset when it is closed
+    def tag(match):
+        closing, name, attributes = match.group(1), match.group(2).lower(), match.group(3)
+        if name in ('i', 'b', 'u', 's'):
+            return '{\\%s%d}' % (name, 0 if closing else 1)
+        if name != 'font':
+            return match.group(0)
+        if closing:
+            return ''.join('{\\%s}' % o for o in fonts.pop()) if fonts else ''
+        
+        overrides = []
+        for attribute, value in ((m.group(1).lower(), m.group(2) or m.group(3) or m.group(4)) for m in SRT_FONT_ATTRIBUTE.finditer(attributes)):
+            if attribute == 'color' and re.match(r'^#?[0-9a-fA-F]{6}$', value):
+                rgb = int(value.lstrip('#'), 16)
+                overrides.append(('c', '&H%X&' % ((rgb & 0xFF) << 16 | (rgb & 0xFF00) | rgb >> 16)))
+            elif attribute == 'face':
+                overrides.append(('fn', value))
+            elif attribute == 'size' and value.isdigit():
+                overrides.append(('fs', value))
+        fonts.append([name for name, _ in overrides])
+        return ''.join('{\\%s%s}' % o for o in overrides)
+    
+    return SRT_TAG.sub(tag, '\\N'.join(lines))
+
+def cut_subtitles(source, destination, charenc, start, end):
+    '''
+    Cut a SubRip or ASS subtitle file to a clip and write it as ASS (in UTF-8), in process and reading a line at a time
+    
+    The events shown in the clip are kept and shifted to the clip start (the ones that start before it start at 0), the
+    others are dropped. The styles of an ASS file are kept, a SubRip file gets the default style of FFmpeg.
+    
+    Args:
+        source (str): The SubRip (.srt) or ASS (.ass, .ssa) file
+        destination (str): The ASS file
+        charenc (str): The encoding of the source
+        start (float): The clip start (in seconds, negative if not set)
+        end (float): The clip end (in seconds, negative if not set)
+    
+    Returns:
+        int: the number of events written
+    
+    Raises:
+        LookupError: if the encoding is not known by Python
+    '''
+    
+    encoding = 'utf-8-sig' if codecs.lookup(charenc).name == 'utf-8' else charenc
+    start_ms = int(round(max(start, 0) * 1000))
+    end_ms = int(round(end * 1000)) if end >= 0 else None
+    
+    def shifted(ev_start, ev_end):
+        # Timestamps of an event in the clip, None if it is not shown
+        if ev_end <= start_ms or (end_ms is not None and ev_start >= end_ms):
+            return None
+        return ass_time(max(ev_start - start_ms, 0)), ass_time(max(ev_end - start_ms, 0))
+    
+    events = 0
+    with io.open(source, 'r', encoding=encoding, errors='replace') as f, open(destination, 'wb') as out:
+        if os.path.splitext(source)[1].lower() == '.srt':
+            out.write(SRT_ASS_HEADER.encode('utf-8'))
+            timing, text = None, []
+            for line in itertools.chain(f, ['']):
+                line = line.rstrip('\r\n')
+                match = SRT_TIMING.match(line)
+                if match:
+                    timing, text = match.groups(), []
+                elif line.strip():
+                    text.append(line.strip())
+                    continue
+                elif timing is not None and text:
+                    # An empty line (or the end of the file) ends the event
+                    times = shifted(subtitle_time(*timing[:4]), subtitle_time(*timing[4:]))
+                    if times is not None:
+                        out.write(('Dialogue: 0,%s,%s,Default,,0,0,0,,%s\n' % (times + (srt_text_to_ass(text),))).encode('utf-8'))
+                        events += 1
+                    timing, text = None, []
+        else:
+            fields = None # Fields of the events, from the format line of the events section
+            for line in f:
+                line = line.rstrip('\r\n').lstrip(u'\ufeff')
+                kind, _, values = line.partition(':')
+                if line.strip().lower() == '[events]':
+                    fields = []
+                elif kind == 'Format' and fields is not None:
+                    fields = [name.strip().lower() for name in values.split(',')]
+                elif kind in ('Dialogue', 'Comment') and fields and 'start' in fields and 'end' in fields:
+                    values = values.lstrip().split(',', len(fields) - 1)
+                    if len(values) != len(fields):
+                        continue
+                    i, j = fields.index('start'), fields.index('end')
+                    match_start, match_end = ASS_TIME.match(values[i].strip()), ASS_TIME.match(values[j].strip())
+                    times = shifted(subtitle_time(*match_start.groups()), subtitle_time(*match_end.groups())) if match_start and match_end else None
+                    if times is None:
+                        continue
+                    values[i], values[j] = times
+                    line = kind + ': ' + ','.join(values)
+                    events += 1
+                out.write((line + '\n').encode('utf-8'))
+    return events
+
+''' Palette engines '''
+
+def png_write(path, width, height, pixels):
+    '''Write an 8 bit RGBA PNG image, 'pixels' are the RGBA bytes of the rows'''
+    
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+    
+    row_size = width * 4
+    raw = b''.join(b'\x00' + pixels[y * row_size:(y + 1) * row_size] for y in range(height))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 9)))
+        f.write(chunk(b'IEND', b''))
+
+def ppm_frames(stream):
+    '''Read the frames of a stream of binary PPM images (as written by the FFmpeg "image2pipe" muxer), as arrays of RGB pixels'''
+    
+    while True:
+        tokens = []
+        while len(tokens) < 4:
+            line = stream.readline()
+            if not line:
+                return
+            if not line.startswith(b'#'):
+                tokens.extend(line.split())
+        if tokens[0] != b'P6' or tokens[3] != b'255':
+            raise ValueError('Unsupported PPM image (%s)' % b' '.join(tokens[:4]).decode('ascii', 'replace'))
+        width, height = int(tokens[1]), int(tokens[2])
+        data = stream.read(width * height * 3)
+        if len(data) < width * height * 3:
+            return
+        yield numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 3)
+
+class ColorHistogram(object):
+    '''
+    Histogram of the colors of the frames, with 5 bits per channel
+    
+    Each bin keeps also the sum of its colors, so it is represented by their mean color (not by the bin center).
+    In "diff" mode only the pixels that differ from the previous frame are counted (all the ones of the first frame).
+    '''
+    
+    BITS = 5
+    
+    def __init__(self, mode):
+        self.mode = mode
+        self.bins = 1 << (3 * self.BITS)
+        self.counts = numpy.zeros(self.bins)
+        self.sums = numpy.zeros((3, self.bins))
+        self.frames = 0
+        self._previous = None
+    
+    def add(self, frame):
+        pixels = frame.reshape(-1, 3)
+        if self.mode == 'diff' and self._previous is not None and self._previous.shape == pixels.shape:
+            changed = (pixels != self._previous).any(axis=1)
+            self._previous = pixels
+            pixels = pixels[changed]
+        else:
+            self._previous = pixels
+        self.frames += 1
+        if not len(pixels):
+            return
+        
+        # A contiguous row for each channel
+        shift = 8 - self.BITS
+        channels = pixels.T.astype(numpy.int32)
+        index = (channels[0] >> shift) << (2 * self.BITS) | (channels[1] >> shift) << self.BITS | channels[2] >> shift
+        self.counts += numpy.bincount(index, minlength=self.bins)
+        for c in range(3):
+            self.sums[c] += numpy.bincount(index, weights=channels[c], minlength=self.bins)
+    
+    def distribution(self):
+        total = self.counts.sum()
+        return self.counts / total if total else self.counts.copy()
+    
+    def colors(self):
+        '''The used bins, as mean colors and weights'''
+        
+        used = numpy.nonzero(self.counts)[0]
+        weights = self.counts[used]
+        return (self.sums[:, used] / weights).T, weights
+
+def median_cut(colors, weights, max_colors):
+    '''
+    Reduce weighted colors with the median cut, splitting each time the box with the biggest squared error
+    along its axis with the biggest squared error, at the weighted median
+    
+    Returns:
+        array: the palette colors (up to 'max_colors'), as float RGB
+    '''
+    
+    def box_error(indexes):
+        w = weights[indexes]
+        c = colors[indexes]
+        mean = (c * w[:, None]).sum(axis=0) / w.sum()
+        errors = (((c - mean) ** 2) * w[:, None]).sum(axis=0)
+        return errors.max(), int(errors.argmax())
+    
+    boxes = [numpy.arange(len(colors))]
+    errors = [box_error(boxes[0])]
+    while len(boxes) < max_colors:
+        # The box with the biggest error (boxes with a single color have no error)
+        n = max(range(len(boxes)), key=lambda i: errors[i][0])
+        error, axis = errors[n]
+        if error <= 0:
+            break
+        
+        box = boxes[n]
+        order = box[numpy.argsort(colors[box, axis], kind='mergesort')]
+        cumulative = numpy.cumsum(weights[order])
+        split = int(numpy.searchsorted(cumulative, cumulative[-1] / 2.0))
+        split = min(max(split, 1), len(order) - 1)
+        boxes[n:n + 1] = [order[:split], order[split:]]
+        errors[n:n + 1] = [box_error(order[:split]), box_error(order[split:])]
+    
+    return numpy.array([(colors[b] * weights[b][:, None]).sum(axis=0) / weights[b].sum() for b in boxes])
+
+def nearest_colors(colors, palette):
+    '''Index of the nearest palette color of each color'''
+    
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, without the |c|^2 constant
+    distances = -2 * colors.dot(palette.T) + (palette ** 2).sum(axis=1)
+    return distances.argmin(axis=1)
+
+def kmeans(colors, weights, palette, iterations=KMEANS_ITERATIONS, batch_size=KMEANS_BATCH):
+    '''
+    Refine a palette with mini-batch k-means on weighted colors
+    
+    Each iteration takes a batch of colors (drawn by weight, with a fixed seed, so the palette is reproducible)
+    and moves every palette color toward the mean of its batch colors, with a learning rate that decreases
+    with the colors already assigned to it.
+    
+    Returns:
+        array: the refined palette colors, as float RGB
+    '''
+    
+    palette = palette.copy()
+    assigned = numpy.zeros(len(palette))
+    random = numpy.random.RandomState(0)
+    probabilities = weights / weights.sum()
+    for _ in range(iterations):
+        batch = colors[random.choice(len(colors), batch_size, p=probabilities)]
+        nearest = nearest_colors(batch, palette)
+        counts = numpy.bincount(nearest, minlength=len(palette))
+        used = counts > 0
+        sums = numpy.zeros_like(palette)
+        for c in range(3):
+            sums[:, c] = numpy.bincount(nearest, weights=batch[:, c], minlength=len(palette))
+        assigned += counts
+        rate = counts[used] / assigned[used]
+        palette[used] += rate[:, None] * (sums[used] / counts[used][:, None] - palette[used])
+    
+    return palette
+
+def numpy_palette(args, result, notify):
+    '''
+    Create the palette in process: the (sampled) frames are read from FFmpeg and their colors are reduced
+    with the median cut, refined with k-means if the engine is 'kmeans'
+    
+    The palette image is the one of the FFmpeg palettegen filter: 16x16 pixels, the last color transparent.
+    With 'palette_early_stop' the reading stops when the color histogram is stable.
+    '''
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES['palettegen_numpy'])
+    
+    cmd_line = COMMANDS['palettegen_numpy'].format(**args)
+    start_time = time.time()
+    histogram = ColorHistogram(args['mode'])
+    p = cmd_open('palettegen_numpy', args, stdin=args['stdin'])
+    stopped = False
+    try:
+        distribution = None
+        for frame in ppm_frames(p.stdout):
+            histogram.add(frame)
+            if args['palette_early_stop'] and histogram.frames % PALETTE_STABLE_FRAMES == 0:
+                # Half of the L1 distance is the fraction of pixels that moved to other bins
+                current = histogram.distribution()
+                if distribution is not None and 0.5 * numpy.abs(current - distribution).sum() < PALETTE_STABLE_DELTA:
+                    stopped = True
+                    break
+                distribution = current
+    except ValueError as e:
+        kill_process(p)
+        raise process_error('palettegen_numpy', cmd_line, p, reason=str(e))
+    finally:
+        if stopped:
+            kill_process(p)
+        p.stdout.close()
+        res, cpu = wait_process(p)
+    
+    if res != 0 and not stopped:
+        raise process_error('palettegen_numpy', cmd_line, p)
+    if not histogram.frames and args['palette_sample'] == 'keyframes':
+        # No key frame in the clip, no palette is written (as FFmpeg does) and palette_exec samples all the frames
+        result.stages.append(StageResult('palettegen_numpy', cmd_line, res, time.time() - start_time, cpu=cpu, frames=0, threads=p.threads))
+        return
+    if not histogram.frames or not histogram.counts.any():
+        raise CommandError('palettegen_numpy', cmd_line, reason='no frames read')
+    
+    # A color is reserved to transparency, as FFmpeg does
+    colors, weights = histogram.colors()
+    palette = median_cut(colors, weights, args['palette_colors'] - 1)
+    if args['palette_engine'] == 'kmeans' and len(palette) > 1:
+        palette = kmeans(colors, weights, palette)
+    
+    rgba = numpy.zeros((256, 4), dtype=numpy.uint8)
+    rgba[:, 3] = 255
+    rgba[:len(palette), :3] = numpy.clip(numpy.round(palette), 0, 255)
+    rgba[255] = (0, 255, 0, 0)
+    png_write(args['palette'], 16, 16, rgba.tobytes())
+    
+    result.stages.append(StageResult('palettegen_numpy', cmd_line, res, time.time() - start_time, cpu=cpu, frames=histogram.frames, threads=p.threads))
+
+def palette_pass(args, result, notify):
+    if args['palette_engine'] == 'ffmpeg':
+        result.stages.append(cmd_exec('palettegen', args, notify, stdin=args['stdin']))
+    else:
+        numpy_palette(args, result, notify)
+
+def palette_exec(args, result, notify):
+    '''
+    Create the palette of a job in its own pass, with the palette engine of the job (and from its sampled frames)
+    
+    A clip shorter than the GOP of the source may have no key frame: with the 'keyframes' sample no palette is written,
+    so it is created again from all the frames of the clip.
+    '''
+    
+    palette_samples(args, result, notify)
+    keyframes = args['palette_sample'] == 'keyframes'
+    if keyframes and os.path.isfile(args['palette']):
+        # The palette of a previous pass (another level of the target size search) is not the one of this pass
+        os.remove(args['palette'])
+    palette_pass(args, result, notify)
+    
+    if keyframes and not os.path.isfile(args['palette']):
+        LOGGER.debug('No key frame in the clip, the palette is created from all its frames')
+        args['palette_sample'] = None
+        try:
+            palette_samples(args, result, notify)
+            palette_pass(args, result, notify)
+        finally:
+            args['palette_sample'] = 'keyframes'
+
+''' Cache '''
+
+def default_cache_dir():
+    if IS_WIN:
+        base_dir = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dir, __title__)
+
+def source_identity(path):
+    '''Identity of a file, it changes if the file is replaced or modified'''
+    
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime]
+
+def cache_key(*parts):
+    '''Hash the parts (JSON serializable values) that identify a cache entry'''
+    
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class DiskCache(object):
+    '''
+    Persistent cache of files stored in a directory, bounded in total size and number of entries
+    
+    When a bound is exceeded the least recently used entries are evicted (a hit updates the entry mtime).
+    Entries are written with a temp name and then renamed, so concurrent jobs (and processes) never see partial files.
+    
+    Args:
+        directory (str): The cache directory (created if missing)
+        max_size (int): Max total size of the entries, in bytes
+        max_entries (int): Max number of entries
+    '''
+    
+    def __init__(self, directory, max_size, max_entries):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Maybe created by a concurrent job
+                if not os.path.isdir(directory):
+                    raise
+    
+    def path(self, key, ext=''):
+        return os.path.join(self.directory, key + ext)
+    
+    def get(self, key, ext=''):
+        '''Return the path of the entry (or None if missing), updating the hit/miss counters'''
+        
+        path = self.path(key, ext)
+        try:
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        with self._lock:
+            self.hits += 1
+        return path
+    
+    def put(self, key, src_path, ext='', move=False):
+        '''Copy (or move) a file into the cache and evict the least recently used entries, return the entry path'''
+        
+        path = self.path(key, ext)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=self.directory)
+        os.close(fd)
+        try:
+            try:
+                if not move:
+                    raise OSError
+                # Fails if the file is in another file system
+                if IS_WIN:
+                    os.remove(tmp_path)
+                os.rename(src_path, tmp_path)
+            except OSError:
+                shutil.copyfile(src_path, tmp_path)
+            if IS_WIN and os.path.isfile(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        self.evict()
+        return path
+    
+    def checkout(self, path, dst_path):
+        '''
+        Hard link an entry to 'dst_path' so it can be used even if evicted by concurrent jobs,
+        return the path to use ('path' itself if the link is not possible)
+        '''
+        
+        try:
+            os.link(path, dst_path)
+            return dst_path
+        except (OSError, AttributeError):
+            return path
+    
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp_'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+            except OSError:
+                pass
+        
+        # Remove the oldest entries until both the bounds are respected
+        entries.sort()
+        total_size = sum(e[1] for e in entries)
+        count = len(entries)
+        for mtime, size, name in entries:
+            if total_size <= self.max_size and count <= self.max_entries:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+            total_size -= size
+            count -= 1
+    
+    def stats(self):
+        entries, size = 0, 0
+        for name in os.listdir(self.directory):
+            if not name.startswith('.tmp_'):
+                entries += 1
+                size += os.path.getsize(os.path.join(self.directory, name))
+        return {
+            'directory'     : self.directory,
+            'hits'          : self.hits,
+            'misses'        : self.misses,
+            'evictions'     : self.evictions,
+            'entries'       : entries,
+            'size'          : size,
+        }
+
+# Caches opened by this process (by directory), so their counters are shared by all the jobs
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_cache(name, cache_dir, max_size, max_entries):
+    directory = os.path.join(cache_dir or default_cache_dir(), name)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(directory)
+        if cache is None:
+            cache = _CACHES[directory] = DiskCache(directory, max_size, max_entries)
+        else:
+            # The last job bounds win
+            cache.max_size, cache.max_entries = max_size, max_entries
+    return cache
+
+def cache_stats():
+    '''Hit, miss and eviction counters (plus entries and size) of the caches opened by this process'''
+    
+    with _CACHES_LOCK:
+        caches = list(_CACHES.values())
+    return dict((os.path.basename(c.directory), c.stats()) for c in caches)
+
+def subtitles_identity(args):
+    if args['burn_file']:
+        return ['file', source_identity(args['burn_file']), args['charenc']]
+    elif args['burn_track'] > -1:
+        return ['track', args['burn_track'], args['charenc']]
+    return None
+
+def palette_key(args):
+    '''Key of the palette of a job, that depends only on the source, the cutting, the subtitles, the filters, the stats mode, the colors and the palette engine (and its sampling)'''
+    
+    return cache_key('palette', source_identity(args['sourceVideo']), args['cutting'], args['cut_filters'], subtitles_identity(args), args['filters'], args['mode'],
+                     args['palette_engine'], args['palette_sampling'], args['palette_early_stop'], args['palette_sample'], args['palette_colors'])
+
+def source_info_key(path):
+    '''Key of the info of a source, that depends only on the source'''
+    
+    return cache_key('probe', source_identity(path))
+
+def keyframe_index_key(path):
+    '''Key of the keyframe index of a source, that depends only on the source'''
+    
+    return cache_key('keyframes', source_identity(path))
+
+def subtitle_track_key(path, track, charenc):
+    '''Key of a whole subtitle track of a source, that depends only on the source, the track and the encoding'''
+    
+    return cache_key('subtitles', source_identity(path), track, charenc)
+
+def proxy_key(args):
+    '''Key of the proxy of a job, that depends only on the source, the cutting, the subtitles and the filters'''
+    
+    return cache_key('proxy', source_identity(args['sourceVideo']), args['cutting'], args['cut_filters'], subtitles_identity(args), args['filters'])
+
+''' Toolchain '''
+
+def find_program(name):
+    '''Path of a program, the copy bundled in the script folder comes first and then the PATH is searched (None if not found)'''
+    
+    extensions = ['.exe', ''] if IS_WIN else ['']
+    for directory in [CURRENT_DIR] + os.environ.get('PATH', '').split(os.pathsep):
+        for ext in extensions:
+            path = os.path.join(directory.strip('"'), name + ext)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.abspath(path)
+    return None
+
+def program_output(path, option):
+    with open(os.devnull, 'r+') as devnull:
+        p = Popen([path, option], stdin=devnull, stdout=PIPE, stderr=devnull)
+        return p.communicate()[0].decode('utf-8', 'replace')
+
+def detect_program(name, path):
+    '''Run a program to read its version (and for FFmpeg the filters and the encoders of the build)'''
+    
+    info = {'name': name, 'path': path, 'version': None, 'filters': [], 'encoders': []}
+    if name == 'gifsicle':
+        match = re.search(r'Gifsicle\s+(\S+)', program_output(path, '--version'))
+    else:
+        match = re.search(r'version\s+(\S+)', program_output(path, '-version'))
+    if match:
+        info['version'] = match.group(1)
+    
+    if name == 'ffmpeg':
+        # E.g. ' TSC paletteuse        VV->V      Use a palette...' and ' V....D gif        GIF (Graphics Interchange Format)'
+        info['filters'] = sorted(set(re.findall(r'(?m)^\s*[T.][S.][C.]?\s+(\w+)\s+\S*->\S*', program_output(path, '-filters'))))
+        info['encoders'] = sorted(set(re.findall(r'(?m)^\s*[VAS][A-Z.]{5}\s+(\w+)\s', program_output(path, '-encoders'))))
+    return info
+
+# Programs already detected by this process (by toolchain key)
+_TOOLCHAIN = {}
+_TOOLCHAIN_LOCK = threading.Lock()
+
+def program_info(name, cache_dir=None):
+    '''
+    Path, version and features of a program (None if it is not found)
+    
+    The features are detected once and kept in the 'toolchain' cache, keyed on the program path, size and mtime
+    (an updated program is detected again), so the program is not executed by the next jobs and processes.
+    
+    Returns:
+        dict: 'name', 'path', 'version', and for FFmpeg 'filters' and 'encoders' (empty if they cannot be read)
+    '''
+    
+    path = find_program(name)
+    if path is None:
+        return None
+    key = cache_key('toolchain', source_identity(path))
+    with _TOOLCHAIN_LOCK:
+        info = _TOOLCHAIN.get(key)
+    if info is not None:
+        return info
+    
+    # The cache directory may not be writable (e.g. a read-only or missing HOME), then the features are kept only in memory
+    try:
+        cache = get_cache('toolchain', cache_dir, TOOLCHAIN_CACHE_SIZE, TOOLCHAIN_CACHE_ENTRIES)
+        cached_info = cache.get(key, '.json')
+    except (OSError, IOError):
+        cache = cached_info = None
+    if cached_info:
+        try:
+            with open(cached_info) as f:
+                info = json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+    
+    if info is None:
+        try:
+            info = detect_program(name, path)
+        except OSError:
+            return None
+        if cache is not None:
+            info_path = None
+            try:
+                fd, info_path = tempfile.mkstemp(suffix='.json')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(info, f)
+                cache.put(key, info_path, '.json', move=True)
+            except (OSError, IOError):
+                LOGGER.debug('Toolchain cache not written:\n%s' % traceback.format_exc())
+            finally:
+                if info_path and os.path.isfile(info_path):
+                    os.remove(info_path)
+    
+    with _TOOLCHAIN_LOCK:
+        _TOOLCHAIN[key] = info
+    return info
+
+''' Args parser '''
+
+def int_not_negative(value):
+    try:
+        ivalue = int(value)
+        if ivalue < 0:
+            raise argparse.ArgumentTypeError("'%s' is a negative int value" % value)
+        return ivalue
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not an int value" % value)
+
+def byte_size(value):
+    '''Parse a size in bytes, with an optional K, M, G or T suffix (powers of 1024)'''
+    
+    try:
+        value = str(value).strip().upper()
+        exp = 'BKMGT'.find(value[-1:]) if value[-1:].isalpha() else 0
+        if exp < 0:
+            raise ValueError
+        if value[-1:].isalpha():
+            value = value[:-1]
+        size = int(float(value) * 1024**exp)
+        if size < 0:
+            raise ValueError
+        return size
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a valid size in bytes" % value)
+
+def cpu_list(value):
+    '''Parse a CPU list, CPU numbers and ranges separated by ',' (e.g. '0-3,6'), or a list of CPU numbers'''
+    
+    try:
+        if isinstance(value, STRING_TYPES):
+            cpus = set()
+            for part in value.split(','):
+                first, _, last = part.strip().partition('-')
+                cpus.update(range(int(first), int(last or first) + 1))
+        else:
+            cpus = set(int(cpu) for cpu in value)
+        if not cpus or min(cpus) < 0:
+            raise ValueError
+        return sorted(cpus)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("'%s' is not a valid CPU list" % (value,))
+
+def file_path_read(fpath):
+    try:
+        if not (os.path.isfile(fpath) and os.access(fpath, os.R_OK)):
+            raise argparse.ArgumentTypeError("'%s' is not a valid path or the file is not readable" % fpath)
+        return fpath
+    except OSError:
+        raise argparse.ArgumentTypeError("'%s' is not a valid path or the file is not readable" % fpath)
+
+def source_path(fpath):
+    # Source can be read from stdin
+    if fpath == PIPE_PATH:
+        return fpath
+    return file_path_read(fpath)
+
+def destination_path(fpath):
+    # Destination can be written to stdout
+    if fpath == PIPE_PATH:
+        return fpath
+    return file_path_write(fpath)
+
+def file_path_write(fpath):
+    try:
+        if not os.access(os.path.abspath(os.path.join(fpath, os.pardir)), os.W_OK):
+            raise argparse.ArgumentTypeError("'%s' is not a valid path or the directory is not writable" % fpath)
+        return fpath
+    except OSError:
+        raise argparse.ArgumentTypeError("'%s' is not a valid path or the directory is not writable" % fpath)
+
+def size_string(size_str):
+    '''
+    Check if the size string passed is correct and purge it
+    
+    A size string is invalid if:
+    - is None or empty
+    - contains more or less than one ':'
+    - contains non digit chars
+    - not respect the pattern WIDTH:HEIGHT
+    - WIDTH or HEIGHT are positive integers (but both can be 0, that means 'keep the rateo'
+      -1 is accepted too, so an already purged size string is still valid)
+    
+    Args:
+        size_str (str): The raw time string
+
+    Returns:
+        str: the size string purged
+    
+    Raises:
+        argparse.ArgumentTypeError: if the size string passed is invalid
+    '''
+    
+    try:
+        # Strip the size string
+        size_str = size_str.strip()
+        
+        # Base checks
+        if not size_str:
+            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
+        
+        # Check pattern
+        size_split = size_str.split(':')
+        if not size_str or len(size_split)!=2:
+            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
+        
+        width, height = int(size_split[0]), int(size_split[1])
+        if width<-1 or height<-1:
+            raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
+        
+        # If one value is 0, convert to -1 (FFmpeg standard to keep rateo)
+        if width == 0:  width  = -1
+        if height == 0: height = -1
+        
+        # Rebuild the size string
+        return '{}:{}'.format(width, height)
+    except (ValueError, IndexError) as ex:
+        raise argparse.ArgumentTypeError("'%s' is not a valid size" % size_str)
+
+def palette_sample_string(sample_str):
+    '''
+    Check if the palette sample string passed is correct and purge it
+    
+    A palette sample string is one of:
+    - 'fps:N', N frames per second (N is a positive number)
+    - 'keyframes', only the key frames
+    - 'count:K', K evenly spaced frames (K is a positive integer, up to PALETTE_SAMPLE_MAX_COUNT)
+    
+    Args:
+        sample_str (str): The raw palette sample string
+    
+    Returns:
+        str: the palette sample string purged
+    
+    Raises:
+        argparse.ArgumentTypeError: if the palette sample string passed is invalid
+    '''
+    
+    kind, sep, value = sample_str.strip().lower().partition(':')
+    try:
+        if kind == 'keyframes' and not sep:
+            return kind
+        if kind == 'fps' and 0 < float(value) < float('inf'):
+            return 'fps:%g' % float(value)
+        if kind == 'count' and 0 < int(value) <= PALETTE_SAMPLE_MAX_COUNT:
+            return 'count:%d' % int(value)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("'%s' is not a valid palette sample, one of (%s)" % (sample_str, '|'.join(PALETTE_SAMPLES)))
+
+def time_string_to_secs(time_string):
+    '''
+    Check if the time string passed is correct and convert it to seconds
+    
+    A time string is invalid if:
+    - is None or empty
+    - contains ',' (to separate seconds and microseconds is used '.')
+    - ends with '.'
+    - contains non digit chars
+    - not respect the pattern ((HH:)MM:)SS(.mm)
+    
+    Args:
+        time_string (str): The raw time string
+
+    Returns:
+        float: the time string converted into seconds
+    
+    Raises:
+        argparse.ArgumentTypeError: if the time string passed is invalid
+    '''
+    
+    try:
+        # Strip the time string
+        time_string = time_string.strip()
+        
+        # Base checks
+        if not time_string or ',' in time_string or time_string.endswith('.'):
+            raise argparse.ArgumentTypeError("'%s' is not a valid time" % time_string)
         
         # Check pattern (to preserve the leading zeros in microseconds, keep seconds field value as a string)
         t_split = time_string.split(':')
@@ -941,17 +2984,48 @@ def time_string_to_secs(time_string):
     except (ValueError, IndexError) as ex:
         raise argparse.ArgumentTypeError("'%s' is not a valid time" % time_string)
 
-def get_args():
+def variant_string(variant_str):
+    '''
+    Check if the variant string passed is correct and convert it to the variant options
+    
+    A variant string is 'DESTINATION[,OPTION=VALUE...]', where OPTION is one of VARIANT_OPTIONS
+    (also with '-' instead of '_'), e.g. 'small.gif,size=320:0,fps=10,dither=none'
+    
+    Args:
+        variant_str (str): The raw variant string
+    
+    Returns:
+        dict: the variant options, with the destination as 'destinationGif'
+    
+    Raises:
+        argparse.ArgumentTypeError: if the variant string passed is invalid
+    '''
+    
+    v_split = variant_str.split(',')
+    variant = {'destinationGif': file_path_write(v_split[0].strip())}
+    for option in v_split[1:]:
+        name, sep, value = option.partition('=')
+        name = name.strip().replace('-', '_')
+        if not sep or name not in VARIANT_OPTIONS:
+            raise argparse.ArgumentTypeError("'%s' is not a valid variant option, one of (%s)" % (option, '|'.join(VARIANT_OPTIONS)))
+        try:
+            variant[name] = option_value(name, value.strip())
+        except InvalidJobError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    
+    return variant
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description=__description__)
     parser.add_argument(
         'sourceVideo',
-        type=file_path_read,
-        help='Source video path'
+        type=source_path,
+        help='Source video path ("-" to read it from stdin)'
     )
     parser.add_argument(
         'destinationGif',
-        type=file_path_write,
-        help='Output GIF path'
+        type=destination_path,
+        help='Output GIF path ("-" to write it to stdout)'
     )
     parser.add_argument(
         '-v',
@@ -962,7 +3036,7 @@ def get_args():
     parser.add_argument(
         '-f',
         '--fps',
-        default=15,
+        default=DEFAULTS['fps'],
         dest='fps',
         type=int_not_negative,
         help='Set the fps. (Default: 15)'
@@ -970,7 +3044,7 @@ def get_args():
     parser.add_argument(
         '-s',
         '--size',
-        default='640:0',
+        default=DEFAULTS['size'],
         dest='size',
         type=size_string,
         help='GIF size, in WIDTH:HEIGHT format. "0" can be used to keep the ratio ("0:0" keep video size). (Default: 640:0)'
@@ -978,7 +3052,7 @@ def get_args():
     parser.add_argument(
         '-r', 
         '--resize-mode',
-        default=RESIZE_FILTERS[0],
+        default=DEFAULTS['resize_mode'],
         dest='resize_mode',
         choices=RESIZE_FILTERS,
         help='Resize filter, one of (%s). (Default: %s)' % ('|'.join(RESIZE_FILTERS), RESIZE_FILTERS[0])
@@ -986,7 +3060,7 @@ def get_args():
     parser.add_argument(
         '-a',
         '--at',
-        default=-1,
+        default=DEFAULTS['start'],
         dest='start',
         type=time_string_to_secs,
         help='Moment in which the GIF begins, in seconds or "HH:MM:SS[.m+]" time format. If setted, must be lower than --to param. (Default: 0)'
@@ -994,7 +3068,7 @@ def get_args():
     parser.add_argument(
         '-t', 
         '--to',
-        default=-1,
+        default=DEFAULTS['end'],
         dest='end',
         type=time_string_to_secs,
         help='Moment in which the GIF ends, in seconds or "HH:MM:SS[.m+]" time format. If setted, must be greater than --at param. (Default: Till end)'
@@ -1002,7 +3076,7 @@ def get_args():
     parser.add_argument(
         '-d',
         '--dither',
-        default=DITHER_MODES[0],
+        default=DEFAULTS['dither'],
         dest='dither',
         choices=DITHER_MODES,
         help='Dithering algorithm to use. One of (%s). (Default: %s)' % ('|'.join(DITHER_MODES), DITHER_MODES[0])
@@ -1010,15 +3084,16 @@ def get_args():
     parser.add_argument(
         '-b',
         '--bayer-scale',
-        default=2,
+        default=DEFAULTS['bayer_scale'],
         dest='bayer_scale',
+        type=int,
         choices=BAYER_SCALES,
         help='Select the Bayer algorithm scale factor, in the range [0 - 5] (used only if --dither is "bayer"). Lower values tend to produce less artefacts but larger images. (Default: 2)'
     )
     parser.add_argument(
         '-m',
         '--mode',
-        default='full',
+        default=DEFAULTS['mode'],
         dest='mode',
         choices=GENERATION_MODES,
         help="Color generation mode, one of (full|diff|single). 'diff' optimize the colors of moving objects at the cost of the background quality, 'single' optimize the colors for each frame (but can introduce flickering), 'full' look for a middle ground. (Default: full)"
@@ -1026,191 +3101,2384 @@ def get_args():
     parser.add_argument(
         '-l',
         '--log',
-        default=LOG_MODES[0],
+        default=DEFAULTS['log'],
         dest='log',
         choices=LOG_MODES,
         help='FFmpeg log mode, one of (%s). (Default: %s)' % ('|'.join(LOG_MODES), LOG_MODES[0])
     )
     parser.add_argument(
-        '-e',
-        '--encoding',
-        default='UTF-8',
-        dest='charenc',
-        help='Subtitle encoding (it has effect only if a burning option is enabled). (Default: UTF-8)'
+        '-e',
+        '--encoding',
+        default=DEFAULTS['charenc'],
+        dest='charenc',
+        help='Subtitle encoding (it has effect only if a burning option is enabled). (Default: UTF-8)'
+    )
+    parser.add_argument(
+        '-o',
+        '--onestep',
+        dest='onestep',
+        action='store_true',
+        help='Do not generate palette for the GIF. Tend to produce worse, but way smaller GIFs. If used --mode, --dither and --bayer-scale parameters are ignored.'
+    )
+    parser.add_argument(
+        '-2',
+        '--two-pass',
+        dest='twopass',
+        action='store_true',
+        help='Generate the palette in a separate pass, decoding the video twice. By default the palette is generated and used in the same pass, that is faster but keeps in memory all the frames of the GIF (in "full" and "diff" modes), so this option is useful only for very long GIFs.'
+    )
+    parser.add_argument(
+        '--palette-engine',
+        default=DEFAULTS['palette_engine'],
+        dest='palette_engine',
+        choices=PALETTE_ENGINES,
+        help='Palette engine, one of (%s). "median_cut" and "kmeans" (median cut refined by k-means) create the palette in process (require NumPy), in a separate pass, and do not support the "single" mode. (Default: %s)' % ('|'.join(PALETTE_ENGINES), DEFAULTS['palette_engine'])
+    )
+    parser.add_argument(
+        '--palette-downscale',
+        default=DEFAULTS['palette_downscale'],
+        dest='palette_downscale',
+        type=int_not_negative,
+        help='Downscale by this factor the frames used to create the palette, faster but less accurate. (Default: %d)' % DEFAULTS['palette_downscale']
+    )
+    parser.add_argument(
+        '--palette-frame-step',
+        default=DEFAULTS['palette_frame_step'],
+        dest='palette_frame_step',
+        type=int_not_negative,
+        help='Create the palette using one frame every N, faster but less accurate. (Default: %d)' % DEFAULTS['palette_frame_step']
+    )
+    parser.add_argument(
+        '--palette-sample',
+        default=DEFAULTS['palette_sample'],
+        dest='palette_sample',
+        type=palette_sample_string,
+        help='Create the palette, in a separate pass, only from a temporal sample of the clip, one of (%s): N frames per second, the key frames (the other frames are not decoded) or K evenly spaced frames (read seeking to each one). Much faster on long clips. (Default: all the frames)' % '|'.join(PALETTE_SAMPLES)
+    )
+    parser.add_argument(
+        '--palette-early-stop',
+        dest='palette_early_stop',
+        action='store_true',
+        help='Stop reading frames when the colors of the palette frames are stable (only with the in process palette engines).'
+    )
+    parser.add_argument(
+        '--palette-colors',
+        default=DEFAULTS['palette_colors'],
+        dest='palette_colors',
+        type=int_not_negative,
+        help='Max number of colors of the palette, in the range [2 - 256] (a color is reserved to transparency). Fewer colors make smaller GIFs. (Default: %d)' % DEFAULTS['palette_colors']
+    )
+    parser.add_argument(
+        '-g',
+        '--gifsicle',
+        dest='optimize',
+        action='store_true',
+        help='Use gifsicle afterwards to validate, optimize and compress it (require "gifsicle" executable reachable, or the builtin optimizer with --optimizer builtin).'
+    )
+    parser.add_argument(
+        '--optimizer',
+        default=DEFAULTS['optimizer'],
+        dest='optimizer',
+        choices=OPTIMIZERS,
+        help='GIF optimizer used by --gifsicle, one of (%s). "builtin" optimizes the GIF in process while FFmpeg writes it (require NumPy): it drops the frames that change nothing, crops the others and makes transparent their unchanged pixels when it compresses better. It is slower than gifsicle, and the GIF is a bit bigger. (Default: %s)' % ('|'.join(OPTIMIZERS), DEFAULTS['optimizer'])
+    )
+    parser.add_argument(
+        '--gifsicle-level',
+        default=DEFAULTS['gifsicle_level'],
+        dest='gifsicle_level',
+        type=int,
+        choices=GIFSICLE_LEVELS,
+        help='Gifsicle optimization level, one of (%s). Higher levels try more, and are slower. (Default: %d)' % ('|'.join(str(l) for l in GIFSICLE_LEVELS), DEFAULTS['gifsicle_level'])
+    )
+    parser.add_argument(
+        '--lossy',
+        default=DEFAULTS['lossy'],
+        dest='lossy',
+        type=int_not_negative,
+        help='Gifsicle lossy compression, that alters the colors of the pixels to shrink the GIF (e.g. 30 is light, 200 is heavy; require gifsicle 1.92 or upper). (Default: %d, lossless)' % DEFAULTS['lossy']
+    )
+    parser.add_argument(
+        '--gifsicle-colors',
+        default=DEFAULTS['gifsicle_colors'],
+        dest='gifsicle_colors',
+        type=int_not_negative,
+        help='Reduce the colors of the GIF with gifsicle, in the range [2 - 256]. (Default: the colors of the palette)'
+    )
+    parser.add_argument(
+        '--gifsicle-threads',
+        default=DEFAULTS['gifsicle_threads'],
+        dest='gifsicle_threads',
+        type=int_not_negative,
+        help='Threads used by gifsicle, 0 to use a thread for each CPU (require gifsicle 1.92 or upper; gifsicle uses them only in some operations, so the speed up is often small). (Default: %d)' % DEFAULTS['gifsicle_threads']
+    )
+    parser.add_argument(
+        '--max-bytes',
+        default=DEFAULTS['max_bytes'],
+        dest='max_bytes',
+        type=byte_size,
+        help='Max size of the GIF, in bytes (K, M and G suffixes are accepted). The size is estimated encoding a short sample of the clip with lower colors, fps and size (in turn) than the ones set, and the GIF is created with the best settings that fit. Not together with --variant, --proxy-cache and a GIF written to stdout. (Default: no limit)'
+    )
+    
+    parser.add_argument(
+        '--cache-dir',
+        default=DEFAULTS['cache_dir'],
+        dest='cache_dir',
+        help='Directory of the persistent caches. (Default: %s)' % default_cache_dir()
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        default=DEFAULTS['tmp_dir'],
+        dest='tmp_dir',
+        help='Directory where the temp files of the job are written, in a private directory removed at the end (also if the job is interrupted). (Default: the %s environment variable, or %s if it has 1 GiB free, or the system temp directory)' % (TMP_DIR_ENV, RAM_TMP_DIR)
+    )
+    parser.add_argument(
+        '--stage-timeout',
+        default=DEFAULTS['stage_timeout'],
+        dest='stage_timeout',
+        type=time_string_to_secs,
+        help='Max time of each stage, in the format ((HH:)MM:)SS(.mm): a command running longer is killed (with its process group) and the job fails. (Default: no limit)'
+    )
+    parser.add_argument(
+        '--nice',
+        default=DEFAULTS['nice'],
+        dest='nice',
+        type=int_not_negative,
+        help='Niceness added to the commands of the stages, in the range [0 - %d] (higher values give a lower CPU priority; not on Windows). (Default: %d)' % (MAX_NICE, DEFAULTS['nice'])
+    )
+    parser.add_argument(
+        '--cpu-affinity',
+        default=DEFAULTS['cpu_affinity'],
+        dest='cpu_affinity',
+        type=cpu_list,
+        help='CPUs where the commands of the stages run, numbers and ranges separated by \',\' (e.g. 0-3,6; Linux only). (Default: all the CPUs)'
+    )
+    parser.add_argument(
+        '--memory-limit',
+        default=DEFAULTS['memory_limit'],
+        dest='memory_limit',
+        type=byte_size,
+        help='Max address space of each command of the stages, in bytes (K, M and G suffixes are accepted): a command that exceeds it fails, and the job with it (not on Windows). (Default: no limit)'
+    )
+    parser.add_argument(
+        '--threads',
+        default=DEFAULTS['threads'],
+        dest='threads',
+        type=int_not_negative,
+        help='Decoding threads of the FFmpeg commands (-threads of their inputs), 0 for a thread for each CPU. (Default: chosen by FFmpeg, or by --thread-budget)'
+    )
+    parser.add_argument(
+        '--filter-threads',
+        default=DEFAULTS['filter_threads'],
+        dest='filter_threads',
+        type=int_not_negative,
+        help='Threads of the simple filtergraphs of the FFmpeg commands (-filter_threads). (Default: chosen by FFmpeg, or by --thread-budget)'
+    )
+    parser.add_argument(
+        '--filter-complex-threads',
+        default=DEFAULTS['filter_complex_threads'],
+        dest='filter_complex_threads',
+        type=int_not_negative,
+        help='Threads of the complex filtergraphs of the FFmpeg commands (-filter_complex_threads). (Default: chosen by FFmpeg, or by --thread-budget)'
+    )
+    parser.add_argument(
+        '--thread-budget',
+        default=DEFAULTS['thread_budget'],
+        dest='thread_budget',
+        choices=THREAD_BUDGET_POLICIES,
+        help='Split the CPUs among the FFmpeg commands running in the process (the concurrent jobs of batch and serve), setting the thread options not set, one of (%s). "throughput" starts each command at once with an even share of the free CPUs (one thread when many run), "latency" runs fewer commands with %d threads each, the others wait. (Default: %s)' % ('|'.join(THREAD_BUDGET_POLICIES), THREAD_BUDGET_WIDTH, DEFAULTS['thread_budget'])
+    )
+    parser.add_argument(
+        '--palette-cache',
+        dest='palette_cache',
+        action='store_true',
+        help='Store the palettes in a persistent cache, and reuse them when the source, the cutting, the subtitles, --fps, --size, --resize-mode and --mode are the same (the palette creation is skipped, useful when only --dither, --bayer-scale or --gifsicle change).'
+    )
+    parser.add_argument(
+        '--palette-cache-size',
+        default=DEFAULTS['palette_cache_size'],
+        dest='palette_cache_size',
+        type=byte_size,
+        help='Max size of the palette cache, in bytes (K, M and G suffixes are accepted), least recently used palettes are removed. (Default: 64M)'
+    )
+    parser.add_argument(
+        '--palette-cache-entries',
+        default=DEFAULTS['palette_cache_entries'],
+        dest='palette_cache_entries',
+        type=int_not_negative,
+        help='Max number of palettes in the palette cache. (Default: %d)' % DEFAULTS['palette_cache_entries']
+    )
+    parser.add_argument(
+        '--proxy-cache',
+        dest='proxy_cache',
+        action='store_true',
+        help='Store the cut, resized and subtitled frames in a lossless proxy video, kept in a persistent cache, and reuse it when the source, the cutting, the subtitles, --fps, --size and --resize-mode are the same (the source is not decoded again, useful when tuning the other options).'
+    )
+    parser.add_argument(
+        '--proxy-cache-size',
+        default=DEFAULTS['proxy_cache_size'],
+        dest='proxy_cache_size',
+        type=byte_size,
+        help='Max size of the proxy cache, in bytes (K, M and G suffixes are accepted), least recently used proxies are removed. (Default: 4G)'
+    )
+    parser.add_argument(
+        '--proxy-cache-entries',
+        default=DEFAULTS['proxy_cache_entries'],
+        dest='proxy_cache_entries',
+        type=int_not_negative,
+        help='Max number of proxies in the proxy cache. (Default: %d)' % DEFAULTS['proxy_cache_entries']
+    )
+    parser.add_argument(
+        '--keyframe-index',
+        dest='keyframe_index',
+        action='store_true',
+        help='Seek to the keyframe before --at, taken from an index of the source keyframes kept in a persistent cache (built with ffprobe on the first use), and cut the clip exactly with a filter. Useful when many clips are cut from the same long source.'
+    )
+    parser.add_argument(
+        '--subtitle-cache',
+        dest='subtitle_cache',
+        action='store_true',
+        help='With --burn-sub-track, extract all the text subtitle tracks of the source in a single pass and keep them in a persistent cache, so each clip is cut from the cached track without reading the source again. Useful when many subtitled clips are cut from the same source.'
+    )
+    parser.add_argument(
+        '--probe',
+        dest='probe',
+        action='store_true',
+        help='Read the source info with ffprobe (kept in a persistent cache) before the conversion, to check the subtitle track and the cutting points (--to is clamped to the source end) and to resolve the "0" dimensions of the sizes, failing before any decoding.'
+    )
+    parser.add_argument(
+        '--progress',
+        dest='show_progress',
+        action='store_true',
+        help='Show the progress of each FFmpeg stage while it runs: frames, encoding fps, speed and ETA (when the clip duration is known).'
+    )
+    parser.add_argument(
+        '--summary',
+        default=None,
+        dest='summary',
+        help='Write a JSON summary of the conversion to this path, with wall and CPU time, frames, fps and speed of each stage.'
+    )
+    parser.add_argument(
+        '--variant',
+        default=DEFAULTS['variants'],
+        dest='variants',
+        type=variant_string,
+        action='append',
+        help='Create also another GIF from the same decoding, with different options. The format is "DESTINATION[,OPTION=VALUE...]" where OPTION is one of (%s), the missing ones are taken from the main GIF (e.g. "small.gif,size=320:0,fps=10"). Can be used more times, and not together with --two-pass, --palette-cache, --proxy-cache, --segments, --palette-sample and the in process palette engines.' % '|'.join(VARIANT_OPTIONS)
+    )
+    parser.add_argument(
+        '--segments',
+        default=DEFAULTS['segments'],
+        dest='segments',
+        type=int_not_negative,
+        help='Split the clip in time segments encoded in parallel (with a palette computed on the whole clip) and joined in the GIF, 0 for a segment for each CPU. Each segment is at least %g seconds long. (Default: %d, no split)' % (SEGMENT_MIN_DURATION, DEFAULTS['segments'])
+    )
+    
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--burn-sub-track',
+        default=DEFAULTS['burn_track'],
+        dest='burn_track',
+        type=int_not_negative,
+        help='Burn in the GIF a source file subtitle track.'
+    )
+    group.add_argument(
+        '--burn-sub-file',
+        default=DEFAULTS['burn_file'],
+        dest='burn_file',
+        type=file_path_read,
+        help='Burn in the GIF an external subtitle file.'
+    )
+    
+    # Parse args
+    args = vars(parser.parse_args(argv))
+    
+    # Check if cutting points are valid
+    if args['start'] >= 0 and args['end'] >= 0 and args['start'] >= args['end']:
+        parser.error('Start cutting point is greater or equal than end cutting point')
+    
+    # Init logger
+    if args['log'] in LOG_DEBUG:
+        _log_handler = logging.StreamHandler()
+        _log_handler.setFormatter(LOG_FORMAT)
+        _log_level = logging.DEBUG
+    else:
+        _log_handler = NullHandler()
+        _log_level = logging.WARN
+    LOGGER.setLevel(_log_level)
+    LOGGER.addHandler(_log_handler)
+    LOGGER.debug('%s debug module init finished', __title__)
+    
+    return args
+
+def get_batch_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='%s batch' % os.path.basename(sys.argv[0]),
+        description='Convert all the jobs listed in a JSON or CSV manifest, running more conversions at the same time'
+    )
+    parser.add_argument(
+        'manifest',
+        type=file_path_read,
+        help='Manifest path. A JSON manifest is a list of {"source", "destination", "options"} objects, a CSV manifest has the "source" and "destination" columns plus a column for each option. Options are named as the Python API ones, relative paths are relative to the manifest directory.'
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default=cpu_count(),
+        dest='jobs',
+        type=int_not_negative,
+        help='Max number of concurrent conversions. (Default: number of CPUs, %d)' % cpu_count()
+    )
+    parser.add_argument(
+        '-r',
+        '--report',
+        default=None,
+        dest='report',
+        type=file_path_write,
+        help='Write a JSON report with status, time elapsed (in seconds) and size (in bytes) of each job.'
+    )
+    
+    args = vars(parser.parse_args(argv))
+    if args['jobs'] == 0:
+        parser.error('argument -j/--jobs: must be greater than 0')
+    
+    return args
+
+def get_serve_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='%s serve' % os.path.basename(sys.argv[0]),
+        description='Run an HTTP server that queues the conversion requests and executes them with a pool of workers'
+    )
+    parser.add_argument(
+        '-H',
+        '--host',
+        default='127.0.0.1',
+        dest='host',
+        help='Address to listen on. (Default: 127.0.0.1)'
+    )
+    parser.add_argument(
+        '-p',
+        '--port',
+        default=8080,
+        dest='port',
+        type=int_not_negative,
+        help='Port to listen on. (Default: 8080)'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        default=cpu_count(),
+        dest='workers',
+        type=int_not_negative,
+        help='Number of concurrent conversions. (Default: number of CPUs)'
+    )
+    parser.add_argument(
+        '-q',
+        '--queue-size',
+        default=32,
+        dest='queue_size',
+        type=int_not_negative,
+        help='Max number of queued conversions, when the queue is full the requests are rejected with a 429 status, 0 for no limit. (Default: 32)'
+    )
+    parser.add_argument(
+        '-k',
+        '--keep',
+        default=100,
+        dest='keep',
+        type=int_not_negative,
+        help='Number of finished jobs (and GIFs) kept, the oldest ones are removed. (Default: 100)'
     )
     parser.add_argument(
-        '-o',
-        '--onestep',
-        dest='onestep',
-        action='store_true',
-        help='Do not generate palette for the GIF. Tend to produce worse, but way smaller GIFs. If used --mode, --dither and --bayer-scale parameters are ignored.'
+        '--max-upload',
+        default=1024**3,
+        dest='max_upload',
+        type=byte_size,
+        help='Max size of an uploaded source, in bytes (K, M and G suffixes are accepted). (Default: 1G)'
     )
     parser.add_argument(
-        '-g',
-        '--gifsicle',
-        dest='optimize',
+        '--work-dir',
+        default=None,
+        dest='work_dir',
+        help='Directory of the uploaded sources and of the created GIFs. (Default: a temp directory, removed at exit)'
+    )
+    parser.add_argument(
+        '--allow-paths',
+        dest='allow_paths',
         action='store_true',
-        help='Use gifsicle afterwards to validate, optimize and compress it (require "gifsicle" executable reachable).'
+        help='Accept server paths as "sourceVideo" and "burn_file" options (otherwise the source must be uploaded). Use it only if the clients are trusted.'
     )
     
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument(
-        '--burn-sub-track',
-        default=-1,
-        dest='burn_track',
-        type=int_not_negative,
-        help='Burn in the GIF a source file subtitle track.'
-    )
-    group.add_argument(
-        '--burn-sub-file',
-        default=None,
-        dest='burn_file',
-        type=file_path_read,
-        help='Burn in the GIF an external subtitle file.'
-    )
+    args = vars(parser.parse_args(argv))
+    if args['workers'] == 0:
+        parser.error('argument -w/--workers: must be greater than 0')
+    if args['work_dir'] and not os.path.isdir(args['work_dir']):
+        parser.error("argument --work-dir: '%s' is not a directory" % args['work_dir'])
+    
+    return args
+
+''' API '''
+
+def time_value(value):
+    '''
+    Convert a cutting point passed to the API in seconds
+    
+    Args:
+        value (str|int|float|None): A time string, a number of seconds or None (or a negative value) if not set
+    
+    Returns:
+        float: the cutting point in seconds (-1 if not set)
+    
+    Raises:
+        argparse.ArgumentTypeError: if the time string passed is invalid
+    '''
+    
+    if value is None:
+        return -1
+    if isinstance(value, (int, float)):
+        return float(value) if value >= 0 else -1
+    return time_string_to_secs(value)
+
+class GifJob(object):
+    '''
+    Specification of a GIF conversion, it accepts the same options of the command line
+    
+    Args:
+        sourceVideo (str): Source video path
+        destinationGif (str): Output GIF path
+        **options: Any key of DEFAULTS (the 'dest' name of the command line argument)
+    
+    Raises:
+        InvalidJobError: if an option is unknown or not valid
+    '''
+    
+    def __init__(self, sourceVideo, destinationGif, **options):
+        unknown = set(options) - set(DEFAULTS)
+        if unknown:
+            raise InvalidJobError('Unknown options: %s' % ', '.join(sorted(unknown)))
+        
+        self.sourceVideo = sourceVideo
+        self.destinationGif = destinationGif
+        for name, default in DEFAULTS.items():
+            setattr(self, name, options.get(name, default))
+        
+        self.validate()
+    
+    def validate(self):
+        # Values passed as strings (e.g. read from a manifest)
+        for name in DEFAULTS:
+            setattr(self, name, option_value(name, getattr(self, name)))
+        
+        # Values checked (and purged) with the same functions used by the args parser
+        try:
+            source_path(self.sourceVideo)
+            destination_path(self.destinationGif)
+            self.fps = int_not_negative(self.fps)
+            self.size = size_string(self.size)
+            self.start = time_value(self.start)
+            self.end = time_value(self.end)
+            if self.burn_track is None or self.burn_track == -1:
+                self.burn_track = -1
+            else:
+                self.burn_track = int_not_negative(self.burn_track)
+            if self.burn_file is not None:
+                file_path_read(self.burn_file)
+            self.palette_cache_size = byte_size(self.palette_cache_size)
+            self.palette_cache_entries = int_not_negative(self.palette_cache_entries)
+            self.proxy_cache_size = byte_size(self.proxy_cache_size)
+            self.proxy_cache_entries = int_not_negative(self.proxy_cache_entries)
+            self.segments = int_not_negative(self.segments)
+            self.palette_downscale = int_not_negative(self.palette_downscale)
+            self.palette_frame_step = int_not_negative(self.palette_frame_step)
+            self.palette_sample = palette_sample_string(self.palette_sample) if self.palette_sample else None
+            self.palette_colors = int_not_negative(self.palette_colors)
+            self.max_bytes = byte_size(self.max_bytes) if self.max_bytes is not None else None
+            self.gifsicle_level = int_not_negative(self.gifsicle_level)
+            self.lossy = int_not_negative(self.lossy)
+            self.gifsicle_colors = int_not_negative(self.gifsicle_colors) if self.gifsicle_colors is not None else None
+            self.gifsicle_threads = int_not_negative(self.gifsicle_threads)
+            self.stage_timeout = time_value(self.stage_timeout) if self.stage_timeout is not None else None
+            self.nice = int_not_negative(self.nice)
+            self.cpu_affinity = cpu_list(self.cpu_affinity) if self.cpu_affinity is not None else None
+            self.memory_limit = byte_size(self.memory_limit) if self.memory_limit is not None else None
+            for name in ('threads', 'filter_threads', 'filter_complex_threads'):
+                if getattr(self, name) is not None:
+                    setattr(self, name, int_not_negative(getattr(self, name)))
+        except argparse.ArgumentTypeError as e:
+            raise InvalidJobError(str(e))
+        except (TypeError, ValueError, AttributeError) as e:
+            # Values of a wrong type (e.g. a list for fps), that the parsing functions do not expect
+            raise InvalidJobError('Invalid option value (%s)' % e)
+        
+        # Values with a fixed set of choices
+        for name, choices in (('resize_mode', RESIZE_FILTERS), ('dither', DITHER_MODES), ('bayer_scale', BAYER_SCALES), ('mode', GENERATION_MODES), ('palette_engine', PALETTE_ENGINES), ('optimizer', OPTIMIZERS), ('gifsicle_level', GIFSICLE_LEVELS), ('thread_budget', THREAD_BUDGET_POLICIES), ('log', LOG_MODES)):
+            try:
+                valid = getattr(self, name) in choices
+            except TypeError:
+                valid = False
+            if not valid:
+                raise InvalidJobError("'%s' is not a valid %s, one of (%s)" % (getattr(self, name), name, '|'.join(str(c) for c in choices)))
+        
+        # Output variants, checked as jobs with the same source and cutting
+        if self.variants:
+            if not isinstance(self.variants, (list, tuple)) or not all(isinstance(v, (dict, GifJob)) for v in self.variants):
+                raise InvalidJobError('Variants must be a list of option dicts or GifJob objects')
+            if self.twopass or self.palette_cache or self.proxy_cache or self.segments != 1 or self.palette_engine != 'ffmpeg' or self.palette_sample:
+                raise InvalidJobError('Variants cannot be used with twopass, palette_cache, proxy_cache, segments, palette_sample and the in process palette engines')
+            if any(v.get('destinationGif') == PIPE_PATH for v in self.variants if isinstance(v, dict)):
+                raise InvalidJobError('Only the main GIF can be written to stdout')
+            variants = []
+            for variant in self.variants:
+                if isinstance(variant, GifJob):
+                    variant = variant.as_dict()
+                options = dict(variant)
+                destination = options.pop('destinationGif', None)
+                unknown = set(options) - set(VARIANT_OPTIONS)
+                if not destination or unknown:
+                    raise InvalidJobError("Variants require 'destinationGif', and accept only (%s)" % '|'.join(VARIANT_OPTIONS))
+                shared = dict((name, getattr(self, name)) for name in DEFAULTS if name not in VARIANT_OPTIONS and name not in ('variants', 'segments', 'palette_engine'))
+                shared.update((name, getattr(self, name)) for name in VARIANT_OPTIONS)
+                shared.update(options)
+                variants.append(GifJob(self.sourceVideo, destination, **shared))
+            self.variants = variants
+        else:
+            self.variants = []
+        
+        # Cross checks
+        if self.start >= 0 and self.end >= 0 and self.start >= self.end:
+            raise InvalidJobError('Start cutting point is greater or equal than end cutting point')
+        if self.palette_downscale < 1 or self.palette_frame_step < 1:
+            raise InvalidJobError('palette_downscale and palette_frame_step must be greater than 0')
+        if self.palette_engine != 'ffmpeg' and self.mode == 'single':
+            raise InvalidJobError("The in process palette engines do not support the 'single' mode")
+        if self.palette_sample and self.mode == 'single':
+            raise InvalidJobError("palette_sample cannot be used with the 'single' mode")
+        if self.burn_track > -1 and self.burn_file:
+            raise InvalidJobError('Only one between burn_track and burn_file can be set')
+        if not 2 <= self.palette_colors <= 256:
+            raise InvalidJobError('palette_colors must be in the range [2 - 256]')
+        if self.gifsicle_colors is not None and not 2 <= self.gifsicle_colors <= 256:
+            raise InvalidJobError('gifsicle_colors must be in the range [2 - 256]')
+        if self.optimizer != 'gifsicle' and (self.gifsicle_level != DEFAULTS['gifsicle_level'] or self.lossy or self.gifsicle_colors or self.gifsicle_threads != 1):
+            raise InvalidJobError('gifsicle_level, lossy, gifsicle_colors and gifsicle_threads require the gifsicle optimizer')
+        if self.tmp_dir is not None and not os.path.isdir(self.tmp_dir):
+            raise InvalidJobError('The temp directory "%s" does not exist' % self.tmp_dir)
+        if self.stage_timeout is not None and self.stage_timeout <= 0:
+            raise InvalidJobError('stage_timeout must be greater than 0')
+        if self.nice > MAX_NICE:
+            raise InvalidJobError('nice must be in the range [0 - %d]' % MAX_NICE)
+        for name, supported in (('nice', hasattr(os, 'nice')), ('cpu_affinity', hasattr(os, 'sched_setaffinity')), ('memory_limit', resource is not None)):
+            if getattr(self, name) and (IS_WIN or not supported):
+                raise InvalidJobError('%s is not supported on this platform' % name)
+        if self.cpu_affinity and not set(self.cpu_affinity) <= os.sched_getaffinity(0):
+            raise InvalidJobError('The CPUs (%s) are not available, the available ones are (%s)' % (
+                ','.join(str(c) for c in self.cpu_affinity), ','.join(str(c) for c in sorted(os.sched_getaffinity(0)))))
+        if self.max_bytes is not None and (self.variants or self.proxy_cache or self.destinationGif == PIPE_PATH):
+            raise InvalidJobError('max_bytes cannot be used with variants, proxy_cache and a GIF written to stdout')
+        if self.sourceVideo == PIPE_PATH and (self.palette_cache or self.proxy_cache or self.keyframe_index or self.subtitle_cache):
+            raise InvalidJobError('Caches and the keyframe index cannot be used when the source is read from stdin')
+    
+    def as_dict(self):
+        options = dict((name, getattr(self, name)) for name in DEFAULTS)
+        if not options['variants']:
+            options['variants'] = None
+        else:
+            options['variants'] = [dict((name, getattr(v, name)) for name in ['destinationGif'] + VARIANT_OPTIONS) for v in options['variants']]
+        options['sourceVideo'] = self.sourceVideo
+        options['destinationGif'] = self.destinationGif
+        return options
+
+class StageResult(object):
+    '''Result of a single stage (an executed command line)'''
+    
+    def __init__(self, name, cmd_line, returncode, elapsed, cpu=None, frames=None, fps=None, speed=None, threads=None):
+        self.name = name
+        self.cmd_line = cmd_line
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.cpu = cpu # CPU time (user and system) of the command, if known
+        self.frames = frames # Frames written, and encoding fps and speed (FFmpeg stages only)
+        self.fps = fps
+        self.speed = speed
+        self.threads = threads # Decoding threads of the command, if set (or taken from the thread budget)
+    
+    def as_dict(self):
+        return {
+            'name'          : self.name,
+            'cmd_line'      : self.cmd_line,
+            'returncode'    : self.returncode,
+            'elapsed'       : self.elapsed,
+            'cpu'           : self.cpu,
+            'frames'        : self.frames,
+            'fps'           : self.fps,
+            'speed'         : self.speed,
+            'threads'       : self.threads,
+        }
+
+class Result(object):
+    '''Result of a GIF conversion'''
+    
+    def __init__(self, job):
+        self.job = job
+        self.stages = []
+        self.elapsed = 0.0
+        self.size = 0
+        self.palette_cache = None # 'hit' or 'miss', if the palette cache is enabled
+        self.proxy_cache = None # 'hit' or 'miss', if the proxy cache is enabled
+        self.keyframe_index = None # 'hit' or 'miss', if the keyframe index is used
+        self.subtitle_cache = None # 'hit' or 'miss', if the subtitle cache is enabled (and the subtitle track is a text one)
+        self.source = None # Source info (as dict), if the source is probed
+        self.budget = None # Settings chosen to fit the GIF in 'max_bytes' (and estimated size, trials and encodes), if set
+        self.variants = [] # Destination and size of each output variant
+    
+    @property
+    def destinationGif(self):
+        return self.job.destinationGif
+    
+    def as_dict(self):
+        return {
+            'sourceVideo'       : self.job.sourceVideo,
+            'destinationGif'    : self.job.destinationGif,
+            'elapsed'           : self.elapsed,
+            'cpu'               : sum(st.cpu for st in self.stages if st.cpu is not None),
+            'size'              : self.size,
+            'palette_cache'     : self.palette_cache,
+            'proxy_cache'       : self.proxy_cache,
+            'keyframe_index'    : self.keyframe_index,
+            'subtitle_cache'    : self.subtitle_cache,
+            'source'            : self.source,
+            'budget'            : self.budget,
+            'variants'          : self.variants,
+            'stages'            : [st.as_dict() for st in self.stages],
+        }
+
+class SourceInfo(object):
+    '''
+    Info of a source video, read from the ffprobe JSON output
+    
+    Times are in seconds (the duration is 0 if unknown), width and height are the displayed ones (the rotation is applied,
+    as FFmpeg does), and the subtitle tracks are in the order used by 'burn_track'.
+    '''
+    
+    def __init__(self, info):
+        source_format = info.get('format') or {}
+        streams = info.get('streams') or []
+        videos = [st for st in streams if st.get('codec_type') == 'video']
+        video = videos[0] if videos else {}
+        self.has_video = bool(videos)
+        
+        # Matroska streams have the duration only as tag, and the container one includes all the streams
+        durations = [video.get('duration'), (video.get('tags') or {}).get('DURATION'), source_format.get('duration')]
+        self.duration = 0
+        for value in durations:
+            try:
+                h, m, sec = ([0, 0] + value.split(':'))[-3:]
+                self.duration = int(h) * 3600 + int(m) * 60 + float(sec)
+                break
+            except (AttributeError, ValueError):
+                continue
+        try:
+            self.start_time = float(source_format.get('start_time'))
+        except (TypeError, ValueError):
+            self.start_time = 0
+        
+        self.width = int(video.get('width') or 0)
+        self.height = int(video.get('height') or 0)
+        rotation = 0
+        for side_data in video.get('side_data_list') or []:
+            rotation = int(side_data.get('rotation', rotation))
+        if rotation % 180:
+            self.width, self.height = self.height, self.width
+        try:
+            num, _, den = (video.get('avg_frame_rate') or '').partition('/')
+            self.fps = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            self.fps = 0
+        self.video_codec = video.get('codec_name')
+        
+        self.audio_tracks = len([st for st in streams if st.get('codec_type') == 'audio'])
+        self.subtitle_tracks = []
+        for st in streams:
+            if st.get('codec_type') == 'subtitle':
+                tags = st.get('tags') or {}
+                self.subtitle_tracks.append({'codec': st.get('codec_name'), 'language': tags.get('language'), 'title': tags.get('title')})
+    
+    def as_dict(self):
+        return {
+            'has_video'         : self.has_video,
+            'duration'          : self.duration,
+            'start_time'        : self.start_time,
+            'width'             : self.width,
+            'height'            : self.height,
+            'fps'               : self.fps,
+            'video_codec'       : self.video_codec,
+            'audio_tracks'      : self.audio_tracks,
+            'subtitle_tracks'   : self.subtitle_tracks,
+        }
+
+def cut_options(start, end):
+    '''FFmpeg input options that cut the clip from 'start' to 'end' (in seconds, negative if not set)'''
+    
+    # Format start cutting point cmd option
+    ss = ''
+    if start >= 0:
+        ss = '-ss %f' % start
+    
+    # Format end cutting point cmd option
+    t = ''
+    if end >= 0:
+        if start >= 0:
+            # If start cutting point is valid and greater than zero, convert end cutting point to gif duration (in seconds)
+            t = '-t %f' % (end - start)
+        else:
+            t = '-t %f' % end
+    
+    return (ss + ' ' + t).strip()
+
+def build_args(job, workdir, stdin=None, stdout=None):
+    '''
+    Build the values used to format the stage command lines of a job (temp files are placed in 'workdir')
+    
+    The 'stdin' and 'stdout' streams (Default: the process ones) are used if the source or the destination is '-'.
+    '''
+    
+    args = job.as_dict()
+    args['workdir'] = workdir
+    
+    # Streams, used only if the source or the destination are pipes
+    args['stdin'] = args['stdout'] = None
+    if args['sourceVideo'] == PIPE_PATH:
+        args['sourceVideo'] = 'pipe:0'
+        args['stdin'] = binary_stream(stdin or sys.stdin)
+    if args['destinationGif'] == PIPE_PATH:
+        args['stdout'] = binary_stream(stdout or sys.stdout)
+    
+    args['cutting'] = cut_options(args['start'], args['end'])
+    args['output_duration'] = args['end'] - max(args['start'], 0) if args['end'] >= 0 else None # Used for the ETA, if known
+    args['progress'] = None # Called back with the progress of the FFmpeg stages
+    args['cancel'] = None # Event set when the conversion is cancelled from another thread (see cancel_commands)
+    args['sub_cutting'] = args['cutting'] # Subtitles are always cut as the clip
+    args['cut_filters'] = '' # Filters that cut the clip (before the subtitles), if it is not cut by the seek
+    args['keyframes'] = None # Keyframe timestamps of the source, if indexed
+    
+    # Fix some params and insert util params
+    single_mode = args['mode']=='single'
+    args['palette'] = os.path.join(workdir, PALETTE_MKV if single_mode else PALETTE_PNG)
+    args['palette_ext'] = os.path.splitext(args['palette'])[1]
+    args['palette_opts'] = '-c:v ffv1' if single_mode else '-update 1' # Lossless palettes
+    args['new'] = 1 if single_mode else 0 # Take new palette for each output frame
+    args['palette_pass'] = args['twopass'] or args['palette_engine'] != 'ffmpeg' or args['palette_sample'] is not None # Palette created in its own pass
+    
+    # Frames sampled for the palette
+    sampling = []
+    if args['palette_frame_step'] > 1:
+        sampling.append('framestep=%d' % args['palette_frame_step'])
+    if args['palette_downscale'] > 1:
+        sampling.append('scale=iw/%d:-1:flags=area' % args['palette_downscale'])
+    args['palette_sampling'] = ''.join(f + ',' for f in sampling)
+    
+    args['subtitles_unescaped'] = os.path.join(workdir, SUB_EXTRACTED)
+    args['subtitles'] = ffmpeg_escape(args['subtitles_unescaped'])
+    args['charenc'] = ''.join(args['charenc'].upper().split()) # All uppercase and remove spaces
+    args['sub_filters'] = ''
+    args['segment_times'] = [] # Start and end of each segment, if the clip is split
+    args['gifsicle_opts'] = gifsicle_options(args)
+    
+    # Filters, paletteuse and destinations of the GIF (and of its variants)
+    args['outputs'] = [output_args(j, args['optimize'], os.path.join(workdir, NOT_OPT_GIF % i)) for i, j in enumerate([job] + job.variants)]
+    args.update(args['outputs'][0])
+    args['palettegen'] = PALETTEGEN.format(**args)
+    args['budget'] = None # State of the target size search, if 'max_bytes' is set
+    
+    return args
+
+def gifsicle_options(args):
+    '''Gifsicle options of a job: optimization level, lossy compression, colors and threads'''
+    
+    options = ['-O%d' % args['gifsicle_level']]
+    if args['lossy']:
+        options.append('--lossy=%d' % args['lossy'])
+    if args['gifsicle_colors']:
+        options.append('--colors %d' % args['gifsicle_colors'])
+    if args['gifsicle_threads'] != 1:
+        options.append('-j%d' % (args['gifsicle_threads'] or cpu_count()))
+    return ' '.join(options)
+
+def output_args(job, optimize, not_opt_path):
+    '''Build the values that can change for each output variant of a job ('not_opt_path' is the GIF before the optimization)'''
+    
+    args = dict((name, getattr(job, name)) for name in ['destinationGif'] + VARIANT_OPTIONS)
+    args['diff_mode'] = 'rectangle' # This is the best 'diff_mode' offered, so is always set
+    args['new'] = 1 if args['mode']=='single' else 0 # Take new palette for each output frame
+    args['destinationGifOpt'] = ''
+    args['optimized'] = False # Optimized while created
+    
+    # Filters (fps and resize)
+    args['filters'] = BASE_FILTERS.format(**args)
+    args['scale_filter'] = SCALE_FILTER.format(**args)
+    
+    # Paletteuse
+    args['paletteuse'] = PALETTEUSE.format(**args)
+    
+    # Edit 'destinationGif' and 'destinationGifOpt' if written to stdout (through gifsicle if 'optimize' is enabled) or if 'optimize' is enabled
+    if args['destinationGif'] == PIPE_PATH:
+        args['destinationGif'], args['destinationGifOpt'] = 'pipe:1', PIPE_PATH if optimize else ''
+    elif optimize:
+        args['destinationGif'], args['destinationGifOpt'] = not_opt_path, args['destinationGif']
+    
+    return args
+
+def variants_graph(args):
+    '''
+    Build the filter graph (and the output options) that creates all the output variants of a job from a single decoding
+    
+    Variants with the same filters share the resized stream, and the ones with also the same mode share the palette.
+    
+    Returns:
+        tuple: the filter graph and the output options
+    '''
+    
+    outputs = args['outputs']
+    
+    # Group the variants by filters, keeping the order
+    groups = []
+    for i, output in enumerate(outputs):
+        for filters, indexes in groups:
+            if filters == output['filters']:
+                indexes.append(i)
+                break
+        else:
+            groups.append((output['filters'], [i]))
+    
+    graph = ['[0:v]%s%ssplit=%d%s' % (args['cut_filters'], args['sub_filters'], len(groups), ''.join('[f%d]' % n for n in range(len(groups))))]
+    for n, (filters, indexes) in enumerate(groups):
+        # A resized stream for each palette (one for each mode) and for each variant
+        modes = []
+        for i in indexes:
+            if not outputs[i]['onestep'] and outputs[i]['mode'] not in modes:
+                modes.append(outputs[i]['mode'])
+        streams = ['[f%d_%d]' % (n, k) for k in range(len(modes) + len(indexes))]
+        graph.append('[f%d]%s,split=%d%s' % (n, filters, len(streams), ''.join(streams)))
+        
+        palettes = {}
+        for k, mode in enumerate(modes):
+            users = [i for i in indexes if not outputs[i]['onestep'] and outputs[i]['mode'] == mode]
+            labels = ['[p%d]' % i for i in users]
+            palettegen = PALETTEGEN.format(mode=mode, palette_colors=args['palette_colors'])
+            graph.append('%s%s%s,split=%d%s' % (streams[k], args['palette_sampling'], palettegen, len(users), ''.join(labels)))
+            palettes.update(zip(users, labels))
+        
+        for stream, i in zip(streams[len(modes):], indexes):
+            if outputs[i]['onestep']:
+                graph.append('%snull[g%d]' % (stream, i))
+            else:
+                graph.append('%s%s%s[g%d]' % (stream, palettes[i], outputs[i]['paletteuse'], i))
+    
+    options = ' '.join('-map "[g%d]" -f gif "%s"' % (i, output['destinationGif']) for i, output in enumerate(outputs))
+    return ';'.join(graph), options
+
+def spool_source(args, result, notify):
+    '''Copy the source from stdin to a temp file, for the jobs that read it more than once'''
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES['spool'])
+    
+    start_time = time.time()
+    spool_path = os.path.join(args['workdir'], SOURCE_SPOOL)
+    with open(spool_path, 'wb') as f:
+        shutil.copyfileobj(args['stdin'], f, 1024**2)
+    args['sourceVideo'], args['stdin'] = spool_path, None
+    
+    result.stages.append(StageResult('spool', '', 0, time.time() - start_time))
+
+def gif_exec(cmd_name, args, result, notify):
+    '''
+    Execute a stage that creates the GIF, writing it to stdout if required; if 'optimize' is enabled, the GIF is piped to
+    the optimizer (without a temp file, except for the variants, that are optimized afterwards)
+    '''
+    
+    piped = args['optimize'] and cmd_name != 'gifcreate_variants'
+    if piped and args['optimizer'] == 'builtin':
+        gif_optimize_exec(cmd_name, args, result, notify)
+        return
+    
+    if args['stdout'] is None and not piped:
+        result.stages.append(cmd_exec(cmd_name, args, notify, stdin=args['stdin']))
+        return
+    
+    cmd_names = [cmd_name, 'gifsicle_pipe'] if args['optimize'] else [cmd_name]
+    if args['stdout'] is None:
+        with open(args['destinationGifOpt'], 'wb') as f:
+            result.stages.extend(cmd_pipe(cmd_names, dict(args, destinationGif='pipe:1'), notify, stdin=args['stdin'], stdout=f))
+        args['outputs'][0]['optimized'] = True
+        return
+    
+    # Text written to stdout must precede the GIF
+    sys.stdout.flush()
+    args['stdout'].flush()
+    
+    result.stages.extend(cmd_pipe(cmd_names, args, notify, stdin=args['stdin'], stdout=args['stdout']))
+
+def gif_optimize_exec(cmd_name, args, result, notify):
+    '''Execute a stage that creates the GIF, optimizing it with the builtin optimizer while FFmpeg writes it (without a temp file)'''
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES[cmd_name])
+        notify(STAGE_MESSAGES['gifoptimize'])
+    
+    pipe_args = dict(args, destinationGif='pipe:1')
+    cmd_line = COMMANDS[cmd_name].format(**pipe_args)
+    if args['stdout'] is not None:
+        # Text written to stdout must precede the GIF
+        sys.stdout.flush()
+        args['stdout'].flush()
+    
+    start_time = time.time()
+    p = cmd_open(cmd_name, pipe_args, stdin=args['stdin'])
+    destination = args['stdout'] if args['stdout'] is not None else open(args['destinationGifOpt'], 'wb')
+    error = None
+    try:
+        gif_optimize(p.stdout, destination)
+    except ValueError as e:
+        error = str(e)
+    finally:
+        if destination is not args['stdout']:
+            destination.close()
+        else:
+            destination.flush()
+        p.stdout.close()
+        res, cpu = wait_process(p)
+    
+    # A GIF truncated because FFmpeg failed is reported as its failure
+    if error is not None and res == 0:
+        raise CommandError('gifoptimize', cmd_line, reason=error)
+    if res != 0:
+        raise process_error(cmd_name, cmd_line, p)
+    elapsed = time.time() - start_time
+    result.stages.append(StageResult(cmd_name, cmd_line, res, elapsed, cpu=cpu, threads=p.threads))
+    result.stages.append(StageResult('gifoptimize', '', 0, elapsed))
+    args['outputs'][0]['optimized'] = True
+
+def optimize_exec(args, result, notify, source=None):
+    '''Optimize the GIF of an output with the optimizer of the job (from 'source', a binary stream, if given, to stdout)'''
+    
+    if args['optimizer'] == 'gifsicle':
+        result.stages.append(cmd_exec('gifsicle', args, notify))
+        return
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES['gifoptimize'])
+    start_time = time.time()
+    try:
+        if source is not None:
+            gif_optimize(source, args['stdout'])
+            args['stdout'].flush()
+        else:
+            with open(args['destinationGif'], 'rb') as f, open(args['destinationGifOpt'], 'wb') as destination:
+                gif_optimize(f, destination)
+    except ValueError as e:
+        raise CommandError('gifoptimize', '', reason=str(e))
+    result.stages.append(StageResult('gifoptimize', '', 0, time.time() - start_time))
+
+def load_subtitle_track(args, result, notify):
+    '''
+    Read the whole subtitle track of the job from the subtitle cache; when missing, all the text subtitle tracks of
+    the source are extracted in a single pass (the source is read once for all the tracks) and cached
+    
+    Returns:
+        str: the path of the track (as ASS, in UTF-8), None if the track is not a text one
+    '''
+    
+    cache = get_cache('subtitles', args['cache_dir'], SUBTITLE_CACHE_SIZE, SUBTITLE_CACHE_ENTRIES)
+    key = subtitle_track_key(args['sourceVideo'], args['burn_track'], args['charenc'])
+    track = cache.get(key, '.ass')
+    result.subtitle_cache = 'hit' if track else 'miss'
+    if not track:
+        info = probe_source(args, result, notify)
+        tracks = [i for i, t in enumerate(info.subtitle_tracks) if t['codec'] in TEXT_SUBTITLE_CODECS]
+        if args['burn_track'] not in tracks:
+            result.subtitle_cache = None
+            return None
+        
+        paths = [os.path.join(args['workdir'], SUB_TRACK % i) for i in tracks]
+        args['subtitle_maps'] = ' '.join('-map 0:s:%d "%s"' % (i, path) for i, path in zip(tracks, paths))
+        result.stages.append(cmd_exec('subextractall', args, notify))
+        for i, path in zip(tracks, paths):
+            entry = cache.put(subtitle_track_key(args['sourceVideo'], i, args['charenc']), path, '.ass', move=True)
+            if i == args['burn_track']:
+                track = entry
+    
+    return cache.checkout(track, os.path.join(args['workdir'], SUB_TRACK % args['burn_track']))
+
+def subcut_process(args, result, burn_file, charenc):
+    '''Cut a subtitle file to the clip in process, returns False if it is not a SubRip or ASS one (or Python does not know its encoding)'''
+    
+    if os.path.splitext(burn_file)[1].lower() not in TEXT_SUBTITLE_EXTENSIONS:
+        return False
+    start_time = time.time()
+    try:
+        cut_subtitles(burn_file, args['subtitles_unescaped'], charenc, args['start'], args['end'])
+    except LookupError:
+        # An encoding known only by iconv
+        return False
+    result.stages.append(StageResult('subcut', '', 0, time.time() - start_time))
+    return True
+
+def subcut_stage(args, result, notify, burn_file, charenc):
+    '''Cut a subtitle file to the clip in process if it is a SubRip or ASS one, or else return the FFmpeg command that cuts it'''
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES['subcut'])
+    if subcut_process(args, result, burn_file, charenc):
+        return None
+    return 'subcut', dict(args, burn_file=burn_file, charenc=charenc, stdin=None)
+
+def subtitle_stage(args, result, notify):
+    '''
+    Prepare the subtitles of a job (if an option is enabled), shared by the runners: the in process stages (the cached
+    track, the cut of SubRip and ASS files) are executed here, and the command still needed is returned, as its name and
+    args (None if there is none), to be executed by the runner (its start is already notified)
+    '''
+    
+    if args['burn_track'] < 0 and not args['burn_file']:
+        return None
+    
+    # Create subtitle filter string
+    args['sub_filters'] = SUBS_FILTER.format(**args)
+    
+    if args['burn_track'] > -1 and args['subtitle_cache']:
+        # The clip is cut from the cached track, written in UTF-8 by FFmpeg
+        track = load_subtitle_track(args, result, notify)
+        if track is not None:
+            return subcut_stage(args, result, notify, track, 'UTF-8')
+    
+    if args['burn_track'] > -1:
+        if notify is not None:
+            notify(STAGE_MESSAGES['subextract'])
+        return 'subextract', args
+    return subcut_stage(args, result, notify, args['burn_file'], args['charenc'])
+
+def prepare_subtitles(args, result, notify):
+    command = subtitle_stage(args, result, notify)
+    if command is not None:
+        cmd_name, cmd_args = command
+        result.stages.append(cmd_exec(cmd_name, cmd_args, stdin=cmd_args['stdin']))
+
+def prepare_proxy(args, result, notify):
+    '''Replace the source with a proxy of the cut, resized and subtitled frames, taken from the proxy cache (or created)'''
+    
+    cache = get_cache('proxies', args['cache_dir'], args['proxy_cache_size'], args['proxy_cache_entries'])
+    key = proxy_key(args)
+    proxy = cache.get(key, os.path.splitext(PROXY_MKV)[1])
+    result.proxy_cache = 'hit' if proxy else 'miss'
+    
+    if not proxy:
+        prepare_subtitles(args, result, notify)
+        args['proxy'] = os.path.join(args['workdir'], PROXY_MKV)
+        result.stages.append(cmd_exec('proxycreate', args, notify))
+        proxy = cache.put(key, args['proxy'], os.path.splitext(PROXY_MKV)[1], move=True)
+    
+    # The proxy has already been cut, resized and subtitled
+    args['sourceVideo'] = cache.checkout(proxy, os.path.join(args['workdir'], PROXY_MKV))
+    args['cutting'] = ''
+    args['sub_cutting'] = ''
+    args['cut_filters'] = ''
+    args['sub_filters'] = ''
+    args['filters'] = 'null'
+    args['scale_filter'] = 'null'
+
+def checkout_palette(cache, args):
+    '''Copy the cached palette of the job to its work directory, returns False if it is not cached'''
+    
+    cached_palette = cache.get(args['palette_key'], args['palette_ext'])
+    if not cached_palette:
+        return False
+    
+    # Use a copy, so the entry can be evicted by concurrent jobs
+    try:
+        shutil.copyfile(cached_palette, args['palette'])
+    except (OSError, IOError):
+        return False
+    return True
+
+def read_source_info(args, notify=None, use_cache=True):
+    '''
+    Read the info of the source of a job with ffprobe, or from the source info cache (keyed on the source identity)
+    
+    Returns:
+        tuple: the SourceInfo and the StageResult of ffprobe (None if cached)
+    '''
+    
+    cache = key = None
+    if use_cache:
+        cache = get_cache('probes', args['cache_dir'], PROBE_CACHE_SIZE, PROBE_CACHE_ENTRIES)
+        key = source_info_key(args['sourceVideo'])
+        cached_info = cache.get(key, '.json')
+        if cached_info:
+            try:
+                with open(cached_info) as f:
+                    return SourceInfo(json.load(f)), None
+            except (OSError, IOError, ValueError):
+                pass
+    
+    probe_path = os.path.join(args['workdir'], SOURCE_PROBE)
+    with open(probe_path, 'w+') as f:
+        stage = cmd_exec('probe', args, notify, stdout=f)
+        f.seek(0)
+        try:
+            info = json.load(f)
+        except ValueError:
+            info = None
+    
+    if info is None:
+        info = {}
+    elif cache is not None:
+        cache.put(key, probe_path, '.json', move=True)
+    return SourceInfo(info), stage
+
+def probe_source(args, result, notify):
+    '''Read (only once per job) the info of the current source of a job, the temp files (spooled sources and proxies) are not cached'''
+    
+    infos = args.setdefault('source_infos', {})
+    if args['sourceVideo'] not in infos:
+        temp_file = os.path.dirname(os.path.abspath(args['sourceVideo'])) == os.path.abspath(args['workdir'])
+        infos[args['sourceVideo']], stage = read_source_info(args, notify, use_cache=not temp_file)
+        if stage is not None:
+            result.stages.append(stage)
+    return infos[args['sourceVideo']]
+
+def resolve_size(size, width, height):
+    '''Replace the -1 dimensions of a size string with the ones computed by the FFmpeg scale filter from the source size'''
+    
+    w, h = [int(v) for v in size.split(':')]
+    if w < 0 and h < 0:
+        w, h = width, height
+    elif w < 0:
+        w = (h * width + height // 2) // height
+    elif h < 0:
+        h = (w * height + width // 2) // width
+    return '%d:%d' % (w, h)
+
+def check_source(args, result, notify):
+    '''
+    Check a job against the info of its source, before any conversion stage
+    
+    The cut range is clamped to the source duration, and the sizes with a -1 dimension are replaced with the GIF sizes.
+    
+    Raises:
+        InvalidJobError: if the source has no video, the subtitle track is missing, the start is beyond the source end, or a GIF is too large
+    '''
+    
+    info = probe_source(args, result, notify)
+    result.source = info.as_dict()
+    
+    if not info.has_video:
+        raise InvalidJobError('The source has no video stream')
+    if args['burn_track'] >= len(info.subtitle_tracks):
+        raise InvalidJobError('The source has no subtitle track %d (it has %d)' % (args['burn_track'], len(info.subtitle_tracks)))
+    
+    if info.duration > 0:
+        if args['start'] >= info.duration:
+            raise InvalidJobError('Start cutting point is beyond the end of the source (%s)' % format_time(info.duration))
+        if args['end'] > info.duration:
+            args['end'] = -1
+            args['cutting'] = args['sub_cutting'] = cut_options(args['start'], args['end'])
+        args['output_duration'] = (args['end'] if args['end'] >= 0 else info.duration) - max(args['start'], 0)
+    
+    if info.width > 0 and info.height > 0:
+        for output in args['outputs']:
+            output['size'] = resolve_size(output['size'], info.width, info.height)
+            if any(int(v) > GIF_MAX_SIZE for v in output['size'].split(':')):
+                raise InvalidJobError("The GIF size '%s' is greater than the max GIF size (%d)" % (output['size'], GIF_MAX_SIZE))
+            output['filters'] = BASE_FILTERS.format(**output)
+            output['scale_filter'] = SCALE_FILTER.format(**output)
+        args.update(args['outputs'][0])
+
+def clip_bounds(args, result, notify):
+    '''
+    Read (only once per job) the timestamp of the clip start in the current source (a proxy is already cut) and the clip duration
+    
+    Returns:
+        tuple: the clip start timestamp and the clip duration (in seconds), the duration is 0 or less if unknown
+    '''
+    
+    if 'clip_offset' not in args:
+        base = max(args['start'], 0) if args['cutting'] else 0
+        info = probe_source(args, result, notify)
+        start_time, duration = info.start_time, info.duration - base
+        if args['end'] >= 0 and args['cutting']:
+            duration = min(duration, args['end'] - base)
+        args['clip_offset'], args['clip_duration'] = start_time + base, duration
+        if duration > 0:
+            args['output_duration'] = duration
+    
+    return args['clip_offset'], args['clip_duration']
+
+def keyframe_before(keyframes, position):
+    '''Timestamp of the last keyframe before (or at) a position of the source, 0 if there are none'''
+    
+    i = bisect.bisect_right(keyframes, position)
+    return keyframes[i - 1] if i else 0
+
+def load_keyframes(args, result, notify):
+    '''
+    Read the keyframe timestamps (from the source start) of the source video stream, from the keyframe index cache
+    (the index is built with ffprobe, reading all the packets of the source, when missing)
+    
+    Returns:
+        list: the sorted keyframe timestamps (in seconds)
+    '''
+    
+    cache = get_cache('indexes', args['cache_dir'], INDEX_CACHE_SIZE, INDEX_CACHE_ENTRIES)
+    key = keyframe_index_key(args['sourceVideo'])
+    index = cache.get(key, '.json')
+    result.keyframe_index = 'hit' if index else 'miss'
+    if index:
+        try:
+            with open(index) as f:
+                return json.load(f)
+        except (OSError, IOError, ValueError):
+            result.keyframe_index = 'miss'
+    
+    index_path = os.path.join(args['workdir'], KEYFRAME_INDEX)
+    with open(index_path, 'w+') as f:
+        result.stages.append(cmd_exec('keyindex', args, notify, stdout=f))
+        f.seek(0)
+        start_time, keyframes = 0, []
+        for line in f:
+            fields = line.strip().split(',')
+            try:
+                if len(fields) == 1:
+                    start_time = float(fields[0])
+                elif 'K' in fields[1]:
+                    keyframes.append(float(fields[0]))
+            except ValueError:
+                # Missing timestamp
+                continue
+    
+    keyframes = sorted(set(round(k - start_time, 6) for k in keyframes))
+    with open(index_path, 'w') as f:
+        json.dump(keyframes, f)
+    cache.put(key, index_path, '.json', move=True)
+    return keyframes
+
+def keyframe_cutting(args, result, notify):
+    '''
+    Seek the clip start to the keyframe before it, taken from the keyframe index of the source, and cut the clip exactly with a trim filter
+    
+    The subtitles are still cut by the seek ('sub_cutting'), and the trim filter is applied before them.
+    '''
+    
+    if args['start'] <= 0 and args['segments'] == 1:
+        # Nothing to seek
+        return
+    
+    args['keyframes'] = load_keyframes(args, result, notify)
+    if args['start'] <= 0:
+        return
+    
+    key = keyframe_before(args['keyframes'], args['start'])
+    start = args['start'] - key
+    end = ':end=%f' % (args['end'] - key) if args['end'] >= 0 else ''
+    args['cutting'] = '-noaccurate_seek -ss %f' % key
+    args['cut_filters'] = 'trim=start=%f%s,setpts=PTS-%f/TB,' % (start, end, start)
+
+def segment_times(args, result, notify):
+    '''
+    Split the clip in segments that can be encoded in parallel
+    
+    The segments start on an output frame (a multiple of 1/fps from the clip start), so they have the same frames of a serial encoding.
+    
+    Returns:
+        list: the start and end of each segment (in seconds, from the clip start), a single segment if the clip is too short
+    '''
+    
+    duration = clip_bounds(args, result, notify)[1]
+    segments = args['segments'] or cpu_count()
+    segments = min(segments, int(duration // SEGMENT_MIN_DURATION))
+    if segments < 2 or args['fps'] <= 0:
+        return [(0, duration)]
+    
+    frames = duration * args['fps']
+    starts = [int(round(i * frames / segments)) / float(args['fps']) for i in range(segments)]
+    return list(zip(starts, starts[1:] + [duration]))
+
+def palette_samples(args, result, notify):
+    '''
+    Set the inputs ('palette_source') and the filters ('palette_graph') of the palette pass, that read only the frames sampled
+    
+    With 'fps:N' the frames dropped are not resized, with 'keyframes' the other frames are not decoded at all, and with 'count:K'
+    the source is opened once for each frame, seeking to it (only the frames from the previous key frame are decoded).
+    '''
+    
+    kind, _, value = (args['palette_sample'] or '').partition(':')
+    args['palette_source'] = '%s -i "%s"' % (args['cutting'], args['sourceVideo'])
+    graph = args['cut_filters'] + args['sub_filters'] + args['filters']
+    if kind == 'fps':
+        graph = '%s%sfps=%s,%s' % (args['cut_filters'], args['sub_filters'], value, args['scale_filter'])
+    elif kind == 'keyframes':
+        # Cut by the seek, a trim from the keyframe before the clip would drop it
+        args['palette_source'] = '-skip_frame nokey %s -i "%s"' % (args['sub_cutting'], args['sourceVideo'])
+        graph = args['sub_filters'] + args['scale_filter']
+    elif kind == 'count':
+        offset, duration = clip_bounds(args, result, notify)
+        if duration > 0:
+            # The frames keep the timestamps of the source (for the subtitles), and are joined with the ones of the clip
+            base = max(args['start'], 0) if args['cutting'] else 0
+            count = int(value)
+            inputs, chains = [], []
+            for i in range(count):
+                inputs.append('-ss %f -i "%s"' % (base + (i + 0.5) * duration / count, args['sourceVideo']))
+                chains.append('[%d:v]trim=end_frame=1,setpts=PTS-%f/TB,%s%s,setpts=PTS-STARTPTS[s%d];' % (i, offset, args['sub_filters'], args['scale_filter'], i))
+            args['palette_source'] = '-copyts ' + ' '.join(inputs)
+            graph = '%s%sconcat=n=%d:v=1:a=0' % (''.join(chains), ''.join('[s%d]' % i for i in range(count)), count)
+    args['palette_graph'] = graph + ',' + args['palette_sampling']
+
+def create_gif_segments(args, result, notify):
+    '''Create the GIF encoding its segments in parallel, with the same palette, and join them'''
+    
+    # A palette for the whole clip (the "single" mode and onestep GIFs have a palette for each frame)
+    if args['onestep']:
+        cmd_name = 'gifcreate_onestep'
+    elif args['mode'] == 'single':
+        cmd_name = 'gifcreate_fused'
+    else:
+        cmd_name = 'gifcreate'
+        if args['palette_cache']:
+            cache = get_cache('palettes', args['cache_dir'], args['palette_cache_size'], args['palette_cache_entries'])
+            cached_palette = checkout_palette(cache, args)
+            result.palette_cache = 'hit' if cached_palette else 'miss'
+            if not cached_palette:
+                palette_exec(args, result, notify)
+                cache.put(args['palette_key'], args['palette'], args['palette_ext'])
+        else:
+            palette_exec(args, result, notify)
+    
+    # Each segment is read from an output frame before its start (up to an output frame after its end), keeping the timestamps
+    # of the whole clip, so the fps filter picks the same frames of a serial encoding; then the extra frames are trimmed
+    base = max(args['start'], 0) if args['cutting'] else 0
+    offset = 'setpts=PTS-%f/TB,' % args['clip_offset']
+    frame = 1.0 / args['fps']
+    segments_args = []
+    for i, (start, end) in enumerate(args['segment_times']):
+        last = i == len(args['segment_times']) - 1
+        seek = max(start - frame, 0)
+        read_end = end if last else end + frame
+        trim_end = '' if last else ':end=%f' % (end - frame / 2)
+        segment_args = dict(args)
+        segment_args['cutting'] = '-ss %f -t %f -copyts' % (base + seek, read_end - seek)
+        if args['keyframes'] is not None:
+            # Seek to the keyframe, the demuxer can stop earlier so the read end is set by the trim
+            segment_args['cutting'] = '-noaccurate_seek -ss %f -copyts' % keyframe_before(args['keyframes'], base + seek)
+            trim_end = ':end=%f' % (end if last else end - frame / 2)
+        segment_args['cut_filters'] = ''
+        segment_args['sub_filters'] = offset + args['sub_filters']
+        segment_args['filters'] = '%s,trim=start=%f%s,setpts=PTS-STARTPTS' % (args['filters'], start - frame / 2, trim_end)
+        segment_args['destinationGif'] = os.path.join(args['workdir'], SEGMENT_GIF % i)
+        segment_args['output_duration'] = end - start
+        segments_args.append(segment_args)
+    
+    # The segments split the thread budget among them
+    pool = ThreadPool(len(segments_args))
+    try:
+        with THREAD_BUDGET.expecting(len(segments_args)):
+            stages = pool.map(lambda a: cmd_exec(cmd_name, a, notify if a is segments_args[0] else None), segments_args)
+    finally:
+        pool.close()
+        pool.join()
+    result.stages.extend(stages)
+    
+    if notify is not None:
+        notify(STAGE_MESSAGES['gifstitch'])
+    start_time = time.time()
+    segments = [s['destinationGif'] for s in segments_args]
+    starts = [start for start, end in args['segment_times']]
+    stitched = args['destinationGif'] if args['stdout'] is None else os.path.join(args['workdir'], STITCHED_GIF)
+    gif_stitch(segments, starts, args['fps'], stitched)
+    result.stages.append(StageResult('gifstitch', '', 0, time.time() - start_time))
+    
+    if args['stdout'] is not None:
+        # Text written to stdout must precede the GIF
+        sys.stdout.flush()
+        args['stdout'].flush()
+        
+        with open(stitched, 'rb') as f:
+            if args['optimize'] and args['optimizer'] == 'builtin':
+                optimize_exec(args, result, notify, source=f)
+            elif args['optimize']:
+                result.stages.extend(cmd_pipe(['gifsicle_pipe'], args, notify, stdin=f, stdout=args['stdout']))
+            else:
+                shutil.copyfileobj(f, args['stdout'], 1024**2)
+                args['stdout'].flush()
+
+def budget_levels(args):
+    '''
+    Settings tried to fit a GIF in 'max_bytes', from the ones of the job to the smallest ones
+    
+    An error diffusion dither is replaced by 'bayer' first (ordered dithering is steadier between frames, so less pixels
+    change), then each level lowers one of colors, fps and size, in turn.
+    
+    Returns:
+        list: dicts of 'fps', 'size', 'dither' and 'palette_colors'
+    '''
+    
+    width, height = [int(v) for v in args['size'].split(':')]
+    level = dict((name, args[name]) for name in ('fps', 'size', 'dither', 'palette_colors'))
+    levels = [dict(level)]
+    if level['dither'] not in ('bayer', 'none') and not args['onestep']:
+        level['dither'] = 'bayer'
+        levels.append(dict(level))
+    
+    scale = 1.0
+    while True:
+        lowered = False
+        colors = [c for c in BUDGET_COLORS if c < level['palette_colors']]
+        if colors and not args['onestep']:
+            level['palette_colors'] = colors[0]
+            levels.append(dict(level))
+            lowered = True
+        fps = [f for f in BUDGET_FPS if f < level['fps']]
+        if fps:
+            level['fps'] = fps[0]
+            levels.append(dict(level))
+            lowered = True
+        if width * scale * BUDGET_SCALE >= BUDGET_MIN_WIDTH:
+            scale *= BUDGET_SCALE
+            level['size'] = '%d:%d' % (int(round(width * scale)), max(int(round(height * scale)), 1))
+            levels.append(dict(level))
+            lowered = True
+        if not lowered:
+            return levels
+
+def budget_sample(args, result, notify):
+    '''
+    Encode losslessly a sample of the clip (evenly spaced windows, the whole clip if it is short) with the subtitles burned,
+    at the fps and size of the job: the trial encodes read it, so the source is decoded only once
+    
+    Returns:
+        float: the ratio between the clip and the sample durations
+    '''
     
-    # Parse args
-    args = vars(parser.parse_args())
+    duration = float(args['output_duration'] or 0)
+    ratio = 1.0
+    args['budget_windows'] = ''
+    if duration > 2 * BUDGET_WINDOWS * BUDGET_WINDOW and args['fps'] > 0:
+        step = duration / BUDGET_WINDOWS
+        starts = [i * step + (step - BUDGET_WINDOW) / 2 for i in range(BUDGET_WINDOWS)]
+        windows = '+'.join('gte(t,%f)*lt(t,%f)' % (start, start + BUDGET_WINDOW) for start in starts)
+        args['budget_windows'] = "setpts=PTS-STARTPTS,select='%s',setpts=N/(%d*TB)," % (windows, args['fps'])
+        ratio = duration / (BUDGET_WINDOWS * BUDGET_WINDOW)
     
-    # Check if cutting points are valid
-    if args['start'] >= 0 and args['end'] >= 0 and args['start'] >= args['end']:
-        parser.error('Start cutting point is greater or equal than end cutting point')
+    args['budget_sample'] = os.path.join(args['workdir'], BUDGET_SAMPLE_MKV)
+    result.stages.append(cmd_exec('budgetsample', args, notify, stdin=args['stdin']))
+    return ratio
+
+def budget_estimate(args, index, result, notify):
+    '''
+    Estimate the size of the GIF with the settings of a level, encoding the sample with them (only once for each level)
     
-    # Init logger
-    if args['log'] in LOG_DEBUG:
-        _log_handler = logging.StreamHandler()
-        _log_handler.setFormatter(LOG_FORMAT)
-        _log_level = logging.DEBUG
-    else:
-        _log_handler = NullHandler()
-        _log_level = logging.WARN
-    LOGGER.setLevel(_log_level)
-    LOGGER.addHandler(_log_handler)
-    LOGGER.debug('%s debug module init finished', __title__)
+    Returns:
+        float: the estimated size, None if the trial encodes are over
+    '''
     
-    # Check if there are all programs (and update them)
-    missing_programs = check_programs(args)
-    if missing_programs:
-        print('Missing programs: %s' % ', '.join(missing_programs))
-        return
+    budget = args['budget']
+    if index not in budget['sizes']:
+        if len(budget['sizes']) >= BUDGET_MAX_TRIALS:
+            return None
+        if notify is not None:
+            notify(STAGE_MESSAGES['budgettrial'])
+        
+        options = dict((name, args[name]) for name in ('resize_mode', 'bayer_scale', 'mode', 'onestep', 'optimize', 'optimizer', 'gifsicle_level',
+                                                      'lossy', 'gifsicle_colors', 'gifsicle_threads', 'log', 'cache_dir', 'tmp_dir',
+                                                      'stage_timeout', 'nice', 'cpu_affinity', 'memory_limit',
+                                                      'threads', 'filter_threads', 'filter_complex_threads', 'thread_budget',
+                                                      'palette_engine', 'palette_downscale', 'palette_frame_step', 'palette_early_stop'))
+        options.update(budget['levels'][index])
+        # The trial is cancelled with the job, and its progress is reported as the 'budgettrial' stage of the job
+        progress = args['progress'] and (lambda stage, info: args['progress']('budgettrial', info))
+        trial = convert(GifJob(args['budget_sample'], os.path.join(args['workdir'], BUDGET_TRIAL_GIF % index), **options),
+                        progress=progress, cancel=args['cancel'])
+        cpu = [st.cpu for st in trial.stages if st.cpu is not None]
+        result.stages.append(StageResult('budgettrial', '; '.join(st.cmd_line for st in trial.stages), 0, trial.elapsed, cpu=sum(cpu) if cpu else None))
+        budget['sizes'][index] = trial.size
+    return budget['sizes'][index] * budget['ratio'] * budget['correction']
+
+def reuse_budget_trial(args):
+    '''
+    If the sample is the whole clip, its trial GIF with the settings set is the GIF: it is moved to the destination
     
-    return args
+    Returns:
+        bool: True if the trial GIF was used
+    '''
+    
+    budget = args['budget']
+    if budget is None or budget['ratio'] != 1.0:
+        return False
+    shutil.move(os.path.join(args['workdir'], BUDGET_TRIAL_GIF % budget['level']), args['destinationGifOpt'] if args['optimize'] else args['destinationGif'])
+    return True
+
+def set_budget_level(args, index):
+    '''Set the settings of a level of the target size search to the job'''
+    
+    output = args['outputs'][0]
+    output.update(args['budget']['levels'][index])
+    output['filters'] = BASE_FILTERS.format(**output)
+    output['scale_filter'] = SCALE_FILTER.format(**output)
+    output['paletteuse'] = PALETTEUSE.format(**output)
+    args.update(output)
+    args['palettegen'] = PALETTEGEN.format(**args)
+    if args['palette_cache']:
+        args['palette_key'] = palette_key(args)
+    args['budget']['level'] = index
+
+def fit_budget(args, result, notify):
+    '''
+    Search the best settings that fit the GIF in 'max_bytes' (the first level whose estimate fits, with a binary search
+    after the job settings and the smallest ones), and set them to the job
+    
+    Raises:
+        SizeLimitError: if the GIF does not fit even with the smallest settings
+    '''
+    
+    budget = args['budget']
+    if budget is None:
+        ratio = budget_sample(args, result, notify)
+        budget = args['budget'] = {'levels': budget_levels(args), 'ratio': ratio, 'correction': 1.0, 'sizes': {}, 'first': 0, 'level': None, 'encodes': 0}
+    
+    def fits(index):
+        estimate = budget_estimate(args, index, result, notify)
+        return estimate is not None and estimate <= args['max_bytes']
+    
+    low, high = budget['first'], len(budget['levels']) - 1
+    if low > high or not fits(high):
+        raise SizeLimitError('The GIF does not fit in %d bytes, even with the smallest settings' % args['max_bytes'])
+    if not fits(low):
+        low += 1
+        while low < high:
+            middle = (low + high) // 2
+            if fits(middle):
+                high = middle
+            else:
+                low = middle + 1
+        low = high
+    set_budget_level(args, low)
+
+def check_budget(args, result, notify):
+    '''
+    Check the size of the created GIF against 'max_bytes': if it does not fit, the estimates are corrected by the error of
+    the last one, and smaller settings are set
+    
+    Returns:
+        bool: True if the GIF must be created again
+    
+    Raises:
+        SizeLimitError: if the GIF does not fit, and there are no smaller settings (or the encodes are over)
+    '''
+    
+    budget = args['budget']
+    budget['encodes'] += 1
+    size = os.path.getsize(args['destinationGifOpt'] if args['optimize'] else args['destinationGif'])
+    index = budget['level']
+    estimate = budget['sizes'][index] * budget['ratio']
+    result.budget = dict(budget['levels'][index], max_bytes=args['max_bytes'], estimate=int(estimate * budget['correction']),
+                         trials=len(budget['sizes']), encodes=budget['encodes'])
+    if size <= args['max_bytes']:
+        return False
+    
+    if budget['encodes'] >= BUDGET_MAX_ENCODES:
+        raise SizeLimitError('The GIF does not fit in %d bytes (%d bytes after %d encodes)' % (args['max_bytes'], size, budget['encodes']))
+    budget['correction'] = max(budget['correction'], size / estimate)
+    budget['first'] = index + 1
+    fit_budget(args, result, notify)
+    return True
+
+def gif_stages(args, result):
+    '''
+    Stages that create the GIF of a job (or its variants, but not its segments), shared by the runners: the palette cache
+    is checked here, and the stages to execute in order are returned, 'palette' (the palette pass, see palette_exec) or
+    the name of a GIF creation command (see gif_exec). The palette is then put in the cache by cache_palette().
+    '''
+    
+    if len(args['outputs']) > 1:
+        # Create all the variants in the same pass
+        args['variants_graph'], args['variants_outputs'] = variants_graph(args)
+        return ['gifcreate_variants']
+    if args['onestep']:
+        # Create GIF without palette
+        return ['gifcreate_onestep']
+    if args['palette_cache']:
+        cache = get_cache('palettes', args['cache_dir'], args['palette_cache_size'], args['palette_cache_entries'])
+        cached_palette = checkout_palette(cache, args)
+        result.palette_cache = 'hit' if cached_palette else 'miss'
+        if cached_palette:
+            return ['gifcreate']
+        if args['palette_pass']:
+            return ['palette', 'gifcreate']
+        # Save the palette while creating the GIF
+        return ['gifcreate_fused_save']
+    if not args['palette_pass']:
+        # Create palette and GIF in the same pass (the video is decoded only once)
+        return ['gifcreate_fused']
+    # Create GIF with palette
+    return ['palette', 'gifcreate']
+
+def cache_palette(args, result):
+    '''Put the palette created by the stages of gif_stages() in the palette cache, if it was missing'''
+    
+    if args['palette_cache'] and result.palette_cache == 'miss':
+        cache = get_cache('palettes', args['cache_dir'], args['palette_cache_size'], args['palette_cache_entries'])
+        cache.put(args['palette_key'], args['palette'], args['palette_ext'])
 
-''' Main '''
+def unoptimized_outputs(args):
+    '''Args of the outputs of a job still to optimize, the ones not optimized while created (nor written to stdout)'''
+    
+    return [dict(args, **output) for output in args['outputs'] if output['destinationGifOpt'] != PIPE_PATH and not output['optimized']]
 
-def vid2gif():
-    print('Video To GIF v%s\n' % __version__)
+def create_gif(args, result, notify):
+    if len(args['segment_times']) > 1:
+        # Encode the segments in parallel and join them
+        create_gif_segments(args, result, notify)
+        return
     
-    # If the OS is windows, set env vars for font config
-    if IS_WIN:
-        os.environ['FC_CONFIG_DIR']     = os.path.join(CURRENT_DIR, 'fonts')
-        os.environ['FONTCONFIG_PATH']   = os.path.join(CURRENT_DIR, 'fonts')
-        os.environ['FONTCONFIG_FILE']   = 'fonts.conf'
+    for stage in gif_stages(args, result):
+        if stage == 'palette':
+            palette_exec(args, result, notify)
+        else:
+            gif_exec(stage, args, result, notify)
+    cache_palette(args, result)
+
+def convert(job, notify=None, stdin=None, stdout=None, progress=None, cancel=None):
+    '''
+    Create a GIF as described by a job
+    
+    Args:
+        job (GifJob): The conversion to do
+        notify (callable): Optional, called with a short message when a stage starts
+        progress (callable): Optional, called with the stage name and its progress (frames, fps, speed, time, elapsed, eta, done)
+            while an FFmpeg stage runs, from another thread
+        stdin (file): Optional, the stream read if the source is '-' (Default: stdin)
+        stdout (file): Optional, the stream written if the destination is '-' (Default: stdout)
+        cancel (threading.Event): Optional, the event passed to cancel_commands() to cancel the conversion from another thread
+    
+    Returns:
+        Result: timings, output size and stage results of the conversion
+    
+    Raises:
+        MissingProgramsError: if a required program is not reachable
+        CommandError: if a stage fails (temp and dirty files are removed)
+        SizeLimitError: if the GIF does not fit in 'max_bytes' (it is removed)
+    '''
     
     # Get start time
     start_time = time.time()
     
-    # Parse and check args
-    args = get_args()
+    # Check if there are all programs
+    missing_programs = check_programs(job.as_dict())
+    if missing_programs:
+        raise MissingProgramsError(missing_programs)
     
-    # Format start cutting point cmd option
-    ss = ''
-    if args['start'] >= 0:
-        ss = '-ss %f' % args['start']
+    setup_fonts()
     
-    # Format end cutting point cmd option
-    t = ''
-    if args['end'] >= 0:
-        if args['start'] >= 0:
-            # If start cutting point is valid and greater than zero, convert end cutting point to gif duration (in seconds)
-            t = '-t %f' % (args['end'] - args['start'])
+    args = build_args(job, make_workdir(job.tmp_dir), stdin, stdout)
+    args['progress'] = progress
+    args['cancel'] = cancel
+    
+    # GIF creation
+    result = Result(job)
+    THREAD_BUDGET.enter()
+    try:
+        # A pipe can be read only once
+        if args['stdin'] is not None and (args['palette_pass'] or args['burn_track'] > -1 or args['segments'] != 1 or args['probe'] or args['max_bytes']):
+            spool_source(args, result, notify)
+        
+        # The size of the GIF is needed to fit it in 'max_bytes'
+        if args['probe'] or args['max_bytes']:
+            check_source(args, result, notify)
+        
+        # Cache keys depend on the original source, cutting and filters (replaced when a proxy is used)
+        if args['palette_cache']:
+            args['palette_key'] = palette_key(args)
+        
+        if args['keyframe_index']:
+            keyframe_cutting(args, result, notify)
+        
+        if args['proxy_cache']:
+            prepare_proxy(args, result, notify)
         else:
-            t = '-t %f' % args['end']
+            prepare_subtitles(args, result, notify)
+        
+        if args['max_bytes']:
+            fit_budget(args, result, notify)
+        
+        # The GIF is created again (with smaller settings) only if it does not fit in 'max_bytes'
+        while True:
+            # A trial GIF of the whole clip is already the GIF
+            if not reuse_budget_trial(args):
+                if args['segments'] != 1:
+                    args['segment_times'] = segment_times(args, result, notify)
+                
+                create_gif(args, result, notify)
+                
+                # GIF optimization
+                if args['optimize']:
+                    for output_args in unoptimized_outputs(args):
+                        optimize_exec(output_args, result, notify)
+                        
+                        # Remove old GIF
+                        if os.path.isfile(output_args['destinationGif']):
+                            os.remove(output_args['destinationGif'])
+            
+            if not args['max_bytes'] or not check_budget(args, result, notify):
+                break
+    except:
+        clean_files(args)
+        raise
+    finally:
+        THREAD_BUDGET.leave()
     
-    args['cutting'] = (ss + ' ' + t).strip()
+    # Delete temp files (palette and extracted subtitles)
+    remove_workdir(args['workdir'])
     
-    # Fix some params and insert util params
-    single_mode = args['mode']=='single'
-    args['diff_mode'] = 'rectangle' # This is the best 'diff_mode' offered, so is always set
-    args['palette'] = PALETTE_MKV if single_mode else PALETTE_PNG
-    args['new'] = 1 if single_mode else 0 # Take new palette for each output frame
-    args['subtitles_unescaped'] = SUB_EXTRACTED
-    args['subtitles'] = ffmpeg_escape(SUB_EXTRACTED)
-    args['charenc'] = ''.join(args['charenc'].upper().split()) # All uppercase and remove spaces
-    args['destinationGifOpt'] = ''
-    args['sub_filters'] = ''
+    result.size = os.path.getsize(job.destinationGif) if job.destinationGif != PIPE_PATH else None
+    result.variants = [{'destinationGif': v.destinationGif, 'size': os.path.getsize(v.destinationGif)} for v in job.variants]
+    result.elapsed = time.time() - start_time
+    return result
+
+def probe(sourceVideo, cache_dir=None):
+    '''
+    Read the info of a source video (duration, size, fps, streams and subtitle tracks), kept in the source info cache
     
-    # Filters (fps and resize)
-    args['filters'] = BASE_FILTERS.format(**args)
+    Args:
+        sourceVideo (str): The source video path
+        cache_dir (str): Optional, the directory of the persistent caches (Default: the user cache directory)
     
-    # Paletteuse
-    args['paletteuse'] = PALETTEUSE.format(**args)
+    Returns:
+        SourceInfo: the info of the source
     
-    # Edit 'destinationGif' and 'destinationGifOpt' if 'optimize' is enabled
-    if args['optimize']:
-        args['destinationGif'], args['destinationGifOpt'] = ('not_opt_'+args['destinationGif'], args['destinationGif'])
+    Raises:
+        InvalidJobError: if the source is not a readable file
+        CommandError: if ffprobe fails or it cannot be executed
+    '''
     
-    # Check if a subtitle option is enabled
-    sub_command = ''
-    if args['burn_track'] > -1:
-        sub_command = 'subextract' 
-    elif args['burn_file']:
-        sub_command = 'subcut'
+    try:
+        file_path_read(sourceVideo)
+    except argparse.ArgumentTypeError as e:
+        raise InvalidJobError(str(e))
     
-    # GIF creation
+    args = {'sourceVideo': sourceVideo, 'cache_dir': cache_dir, 'log': DEFAULTS['log'],
+            'workdir': make_workdir()}
     try:
-        # Prepare subtitles (if an option is enabled)
-        if sub_command:
-            print('Extracting subtitles...')
-            cmd_exec(sub_command, args)
-            
-            # Create subtitle filter string
-            args['sub_filters'] = SUBS_FILTER.format(**args)
-        
-        if args['onestep']:
-            # Create GIF without palette
-            print('Creating GIF...')
-            cmd_exec('gifcreate_onestep', args)
+        return read_source_info(args)[0]
+    finally:
+        remove_workdir(args['workdir'])
+
+def option_value(name, value):
+    '''Convert an option read as a string (e.g. from a CSV manifest) to the type expected by GifJob'''
+    
+    if name not in DEFAULTS or not isinstance(value, STRING_TYPES):
+        return value
+    if name == 'variants':
+        # Variant strings separated by ';'
+        try:
+            return [variant_string(v.strip()) for v in value.split(';') if v.strip()]
+        except argparse.ArgumentTypeError as e:
+            raise InvalidJobError(str(e))
+    if isinstance(DEFAULTS[name], bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if name in ('bayer_scale', 'gifsicle_level'):
+        try:
+            return int(value)
+        except ValueError:
+            raise InvalidJobError("'%s' is not a valid %s" % (value, name))
+    return value
+
+def read_manifest(path):
+    '''
+    Read a batch manifest, a JSON or a CSV file (chosen by the extension)
+    
+    A JSON manifest is a list of objects with the 'source', 'destination' and (optional) 'options' keys.
+    A CSV manifest has the 'source' and 'destination' columns, and a column for each other option (empty cells are ignored).
+    Options are named as the GifJob options, and relative paths are relative to the manifest directory.
+    
+    Args:
+        path (str): The manifest path
+    
+    Returns:
+        list: (source, destination, options) tuples
+    
+    Raises:
+        InvalidJobError: if the manifest is malformed
+    '''
+    
+    base_dir = os.path.dirname(os.path.abspath(path))
+    rows = []
+    try:
+        if path.lower().endswith('.csv'):
+            with open(path) as f:
+                for row in csv.DictReader(f):
+                    source = row.pop('source', None)
+                    destination = row.pop('destination', None)
+                    options = dict((k.strip(), v) for k, v in row.items() if k and v is not None and v.strip())
+                    rows.append((source, destination, options))
         else:
-            # Create GIF with palette
-            print('Creating Palette...')
-            cmd_exec('palettegen', args)
-            
-            print('Creating GIF...')
-            cmd_exec('gifcreate', args)
-            
-            # Delete palette file
-            if os.path.isfile(args['palette']):
-                os.remove(args['palette'])
-        
-        # Delete extracted subtitles
-        if os.path.isfile(args['subtitles_unescaped']):
-            os.remove(args['subtitles_unescaped'])
-        
-        # GIF optimization
-        if args['optimize']:
-            print('Optimize GIF...')
-            cmd_exec('gifsicle', args)
+            with open(path) as f:
+                for row in json.load(f):
+                    rows.append((row.get('source'), row.get('destination'), dict(row.get('options') or {})))
+    except (ValueError, AttributeError, TypeError) as e:
+        raise InvalidJobError("'%s' is not a valid manifest (%s)" % (path, e))
+    
+    # Purge values and resolve relative paths
+    jobs = []
+    for source, destination, options in rows:
+        if not source or not destination:
+            raise InvalidJobError("'%s' is not a valid manifest (a row misses 'source' or 'destination')" % path)
+        options = dict((k, option_value(k, v)) for k, v in options.items())
+        if options.get('burn_file'):
+            options['burn_file'] = os.path.join(base_dir, options['burn_file'])
+        for variant in options.get('variants') or []:
+            variant['destinationGif'] = os.path.join(base_dir, variant['destinationGif'])
+        jobs.append((os.path.join(base_dir, source), os.path.join(base_dir, destination), options))
+    
+    return jobs
+
+def convert_batch(rows, workers=None, notify=None):
+    '''
+    Convert many jobs with a bounded pool of concurrent conversions
+    
+    Args:
+        rows (list): (source, destination, options) tuples, as returned by read_manifest
+        workers (int): Max number of concurrent conversions (Default: number of CPUs)
+        notify (callable): Optional, called with the report of each job when it ends
+    
+    Returns:
+        list: a report (dict) for each job, in the same order of the rows
+    '''
+    
+    def run(item):
+        index, (source, destination, options) = item
+        report = {
+            'index'         : index,
+            'source'        : source,
+            'destination'   : destination,
+            'status'        : 'ok',
+            'error'         : None,
+            'elapsed'       : 0.0,
+            'size'          : 0,
+            'palette_cache' : None,
+            'proxy_cache'   : None,
+            'keyframe_index': None,
+            'subtitle_cache': None,
+            'stages'        : [],
+        }
+        start_time = time.time()
+        try:
+            result = convert(GifJob(source, destination, **options))
+            report['size'] = result.size
+            report['palette_cache'] = result.palette_cache
+            report['proxy_cache'] = result.proxy_cache
+            report['keyframe_index'] = result.keyframe_index
+            report['subtitle_cache'] = result.subtitle_cache
+            report['stages'] = [st.as_dict() for st in result.stages]
+        except InvalidJobError as e:
+            report['status'], report['error'] = 'invalid', str(e)
+        except (Video2GifError, OSError, IOError) as e:
+            report['status'], report['error'] = 'failed', str(e)
+        except Exception as e:
+            # Unexpected errors fail only their row, and not the whole batch
+            report['status'], report['error'] = 'failed', '%s: %s' % (type(e).__name__, e)
+        report['elapsed'] = time.time() - start_time
+        
+        if notify is not None:
+            notify(report)
+        return report
+    
+    workers = workers or cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        with THREAD_BUDGET.expecting(min(workers, len(rows))):
+            reports = pool.map(run, list(enumerate(rows)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return reports
+
+''' Server '''
+
+# Job options that a server client cannot set (server paths are set only with 'allow_paths')
+SERVER_FORBIDDEN_OPTIONS = ['destinationGif', 'cache_dir', 'tmp_dir', 'variants']
+SERVER_PATH_OPTIONS = ['sourceVideo', 'burn_file']
+
+class ServerJob(object):
+    '''A job queued in the conversion server'''
+    
+    def __init__(self, job_id, job, upload=None):
+        self.id = job_id
+        self.job = job
+        self.upload = upload
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.progress = None # Last progress of the running FFmpeg stage
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+    
+    def as_dict(self):
+        return {
+            'id'        : self.id,
+            'status'    : self.status,
+            'error'     : self.error,
+            'result'    : self.result,
+            'progress'  : self.progress,
+            'created'   : self.created,
+            'started'   : self.started,
+            'finished'  : self.finished,
+        }
+
+class ConversionService(object):
+    '''
+    Bounded queue of conversions, executed by a pool of worker threads
+    
+    Args:
+        workers (int): Number of concurrent conversions
+        queue_size (int): Max number of queued (not running) conversions
+        work_dir (str): Directory of the uploaded sources and of the created GIFs
+        keep (int): Number of finished jobs kept (with their GIF), the oldest ones are removed
+        allow_paths (bool): Accept server paths as source and subtitle file (otherwise only uploads are accepted)
+    '''
+    
+    def __init__(self, workers, queue_size, work_dir, keep, allow_paths=False):
+        self.workers = workers
+        self.work_dir = work_dir
+        self.keep = keep
+        self.allow_paths = allow_paths
+        self.queue = queue.Queue(queue_size)
+        self.jobs = {}
+        self.finished = []
+        self.running = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+        self._threads = []
+    
+    def start(self):
+        # The workers split the thread budget among them, until stopped
+        THREAD_BUDGET.expect(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='%s-worker-%d' % (__title__, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    
+    def stop(self):
+        '''Stop accepting jobs, wait the running ones and stop the workers (queued jobs are discarded)'''
+        
+        self.stopping = True
+        try:
+            while True:
+                self._discard(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        for t in self._threads:
+            self.queue.put(None)
+        for t in self._threads:
+            t.join()
+        THREAD_BUDGET.unexpect(self.workers)
+    
+    def submit(self, options, upload=None):
+        '''
+        Queue a conversion
+        
+        Args:
+            options (dict): The job options (GifJob ones)
+            upload (str): Optional, the path of the uploaded source (removed when the job ends)
+        
+        Returns:
+            ServerJob: the queued job
+        
+        Raises:
+            InvalidJobError: if an option is not valid, or it cannot be set by a client
+            QueueFullError: if the queue is full
+        '''
+        
+        forbidden = SERVER_FORBIDDEN_OPTIONS + ([] if self.allow_paths else SERVER_PATH_OPTIONS)
+        options = dict(options)
+        for name in forbidden:
+            if name in options:
+                raise InvalidJobError("Option '%s' cannot be set" % name)
+        if upload is not None:
+            options['sourceVideo'] = upload
+        if 'sourceVideo' not in options:
+            raise InvalidJobError('Missing source, upload it or set sourceVideo')
+        
+        # Check the job before queueing it
+        job_id = uuid.uuid4().hex
+        destination = os.path.join(self.work_dir, job_id + '.gif')
+        server_job = ServerJob(job_id, GifJob(options.pop('sourceVideo'), destination, **options), upload)
+        
+        with self._lock:
+            self.jobs[server_job.id] = server_job
+        try:
+            self.queue.put_nowait(server_job)
+        except queue.Full:
+            with self._lock:
+                del self.jobs[server_job.id]
+            raise QueueFullError('The conversion queue is full')
+        
+        return server_job
+    
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+    
+    def remove(self, job_id):
+        '''Remove a finished job and its GIF, return False if the job is missing or not finished'''
+        
+        with self._lock:
+            server_job = self.jobs.get(job_id)
+            if server_job is None or server_job.finished is None:
+                return False
+            self.jobs.pop(job_id, None)
+            if job_id in self.finished:
+                self.finished.remove(job_id)
+        self._discard(server_job)
+        return True
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'workers'   : self.workers,
+                'running'   : self.running,
+                'queued'    : self.queue.qsize(),
+                'capacity'  : self.queue.maxsize,
+                'finished'  : len(self.finished),
+                'stopping'  : self.stopping,
+            }
+    
+    def _discard(self, server_job):
+        for path in (server_job.upload, server_job.job.destinationGif):
+            if path and os.path.isfile(path):
+                os.remove(path)
+    
+    def _work(self):
+        while True:
+            server_job = self.queue.get()
+            if server_job is None:
+                break
             
-            # Remove old GIF
-            if os.path.isfile(args['destinationGif']):
-                os.remove(args['destinationGif'])
+            with self._lock:
+                self.running += 1
+            server_job.status = 'running'
+            server_job.started = time.time()
+            try:
+                result = convert(server_job.job, progress=lambda stage, info: setattr(server_job, 'progress', dict(info, stage=stage)))
+                server_job.result = dict((k, v) for k, v in result.as_dict().items() if k not in ('sourceVideo', 'destinationGif'))
+                server_job.status = 'done'
+            except (Video2GifError, OSError, IOError) as e:
+                server_job.status, server_job.error = 'failed', str(e)
+            except Exception as e:
+                # An unexpected error fails the job only, the worker keeps serving the queue
+                LOGGER.error('Job %s failed:\n%s' % (server_job.id, traceback.format_exc()))
+                server_job.status, server_job.error = 'failed', '%s: %s' % (type(e).__name__, e)
+            finally:
+                # Only the last finished jobs are kept (a job is finished and listed at once, so remove() finds both)
+                old_jobs = []
+                with self._lock:
+                    self.running -= 1
+                    server_job.finished = time.time()
+                    self.finished.append(server_job.id)
+                    while len(self.finished) > self.keep:
+                        old_job = self.jobs.pop(self.finished.pop(0), None)
+                        if old_job is not None:
+                            old_jobs.append(old_job)
+                
+                # The upload and the files of the old jobs are no more needed
+                try:
+                    if server_job.upload and os.path.isfile(server_job.upload):
+                        os.remove(server_job.upload)
+                    for old_job in old_jobs:
+                        self._discard(old_job)
+                except OSError:
+                    LOGGER.warning('Cleanup after job %s failed:\n%s' % (server_job.id, traceback.format_exc()))
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP API of the conversion server
+    
+    - POST /jobs: queue a conversion, the body is the source video (options in the query string) or,
+      if the content type is 'application/json', an object with the options
+    - GET /jobs/ID: job status
+    - GET /jobs/ID/result: the created GIF
+    - DELETE /jobs/ID: remove a finished job
+    - GET /health: workers and queue status
+    '''
+    
+    server_version = '%s/%s' % (__title__, __version__)
+    
+    def log_message(self, format, *args):
+        LOGGER.info('%s - %s' % (self.address_string(), format % args))
+    
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_error_json(self, code, message, headers=None):
+        self.send_json(code, {'error': message}, headers)
+    
+    def route(self):
+        # Return the path parts, e.g. ['jobs', 'ID', 'result']
+        return [p for p in urlparse(self.path).path.split('/') if p]
+    
+    def do_GET(self):
+        service = self.server.service
+        parts = self.route()
+        if parts == ['health']:
+            return self.send_json(200, service.stats())
         
-    except (OSError, IOError) as e:
-        clean_files(args)
-        traceback.print_exc(file=sys.stdout)
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or (len(parts) == 3 and parts[2] != 'result'):
+            return self.send_error_json(404, 'Not found')
+        server_job = service.get(parts[1])
+        if server_job is None:
+            return self.send_error_json(404, 'Job not found')
+        if len(parts) == 2:
+            return self.send_json(200, server_job.as_dict())
+        
+        # Result download
+        if server_job.status != 'done':
+            return self.send_error_json(409, "Job is '%s'" % server_job.status)
+        try:
+            f = open(server_job.job.destinationGif, 'rb')
+        except (OSError, IOError):
+            return self.send_error_json(410, 'Result removed')
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/gif')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1024**2)
+    
+    def do_DELETE(self):
+        parts = self.route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return self.send_error_json(404, 'Not found')
+        if not self.server.service.remove(parts[1]):
+            return self.send_error_json(409, 'Job not found or not finished')
+        self.send_json(200, {'id': parts[1], 'status': 'removed'})
+    
+    def do_POST(self):
+        service = self.server.service
+        if self.route() != ['jobs']:
+            return self.send_error_json(404, 'Not found')
+        if service.stopping:
+            return self.send_error_json(503, 'Server is stopping')
+        if self.headers.get('Content-Length') is None:
+            return self.send_error_json(411, 'Content-Length required')
+        length = int(self.headers.get('Content-Length'))
+        if length > self.server.max_upload:
+            return self.send_error_json(413, 'Source too large')
+        
+        # Fail fast if the queue is full, without reading the upload
+        if service.queue.full():
+            return self.send_error_json(429, 'The conversion queue is full', {'Retry-After': '1'})
+        
+        upload = None
+        try:
+            if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+                options = json.loads(self.rfile.read(length).decode('utf-8'))
+                if not isinstance(options, dict):
+                    raise ValueError('options must be an object')
+            else:
+                options = dict(parse_qsl(urlparse(self.path).query))
+                fd, upload = tempfile.mkstemp(prefix='upload_', dir=service.work_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    while length > 0:
+                        chunk = self.rfile.read(min(length, 1024**2))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        length -= len(chunk)
+            server_job = service.submit(options, upload)
+        except (ValueError, InvalidJobError, QueueFullError) as e:
+            if upload and os.path.isfile(upload):
+                os.remove(upload)
+            if isinstance(e, QueueFullError):
+                return self.send_error_json(429, str(e), {'Retry-After': '1'})
+            return self.send_error_json(400, str(e))
+        
+        self.send_json(202, server_job.as_dict(), {'Location': '/jobs/%s' % server_job.id})
+
+class ConversionServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server (a thread per connection) of a ConversionService'''
+    
+    daemon_threads = True
+    
+    def __init__(self, address, service, max_upload):
+        HTTPServer.__init__(self, address, ConversionRequestHandler)
+        self.service = service
+        self.max_upload = max_upload
+
+''' Main '''
+
+def vid2gif(argv=None):
+    # Get start time
+    start_time = time.time()
+    
+    # Parse and check args
+    args = get_args(argv)
+    
+    # If the GIF is written to stdout, messages are written to stderr
+    out = sys.stderr if args['destinationGif'] == PIPE_PATH else sys.stdout
+    def echo(message):
+        print(message, file=out)
+    
+    echo('Video To GIF v%s\n' % __version__)
+    
+    # Options of the command line only
+    show_progress = args.pop('show_progress')
+    summary = args.pop('summary')
+    
+    def progress(stage, info):
+        line = '  %d frames, %s fps, %s speed' % (info['frames'], '%.1f' % info['fps'] if info['fps'] is not None else '-',
+                                                   '%.2fx' % info['speed'] if info['speed'] is not None else '-')
+        if info['eta'] is not None:
+            line += ', ETA %s' % format_time(info['eta'])
+        out.write('\r%-60s' % line)
+        if info['done']:
+            out.write('\n')
+        out.flush()
+    
+    # GIF creation
+    exit_code = 0
+    try:
+        result = convert(GifJob(**args), notify=echo, progress=progress if show_progress else None)
+        if summary:
+            with open(summary, 'w') as f:
+                json.dump(result.as_dict(), f, indent=4)
+        if result.budget:
+            echo('Fitted in %d bytes with fps %d, size %s, dither %s and %d colors (%d trials, %d encodes)' % (
+                result.budget['max_bytes'], result.budget['fps'], result.budget['size'], result.budget['dither'],
+                result.budget['palette_colors'], result.budget['trials'], result.budget['encodes']))
+        if result.keyframe_index:
+            echo('Keyframe index %s' % result.keyframe_index)
+        if result.subtitle_cache:
+            echo('Subtitle cache %s' % result.subtitle_cache)
+        if result.proxy_cache:
+            echo('Proxy cache %s' % result.proxy_cache)
+        if result.palette_cache:
+            echo('Palette cache %s' % result.palette_cache)
+    except (MissingProgramsError, InvalidJobError, SizeLimitError) as e:
+        echo(str(e))
+        return 1
+    except StageTimeoutError as e:
+        echo(str(e))
+        exit_code = 1
+    except Video2GifError as e:
+        echo('An error occurred!')
+        LOGGER.debug(str(e))
+        exit_code = 1
+    except (OSError, IOError):
+        echo('An error occurred!')
+        traceback.print_exc(file=out)
+        exit_code = 1
     
     # Print time enlapsed
     time_elapsed = format_time( time.time() - start_time )
-    print('\nFinished - Time elapsed -> %s' % time_elapsed)
+    echo('\nFinished - Time elapsed -> %s' % time_elapsed)
+    
+    return exit_code
 
 
-if __name__ == "__main__":
-    global FNULL
+def vid2gif_batch(argv=None):
+    print('Video To GIF v%s - Batch\n' % __version__)
+    
+    # Get start time
+    start_time = time.time()
+    
+    # Parse and check args
+    args = get_batch_args(argv)
+    try:
+        rows = read_manifest(args['manifest'])
+    except (InvalidJobError, OSError, IOError) as e:
+        print(str(e))
+        return 1
+    
+    # Print the status of each job when it ends
+    def notify(report):
+        print('[%d/%d] %s %s -> %s' % (report['index']+1, len(rows), report['status'].upper(), report['destination'], format_time(report['elapsed'])))
+        if report['error']:
+            print('    %s' % report['error'])
+    
+    reports = convert_batch(rows, workers=args['jobs'], notify=notify)
+    
+    if args['report']:
+        with open(args['report'], 'w') as f:
+            json.dump(reports, f, indent=2)
+    
+    # Print summary and time enlapsed
+    failed = len([r for r in reports if r['status'] != 'ok'])
+    time_elapsed = format_time( time.time() - start_time )
+    for name, stats in sorted(cache_stats().items()):
+        print('Cache %s: %d hits, %d misses, %d evictions' % (name, stats['hits'], stats['misses'], stats['evictions']))
+    print('\nFinished - %d done, %d failed - Time elapsed -> %s' % (len(reports) - failed, failed, time_elapsed))
+    
+    return 1 if failed else 0
 
-    FNULL = open(os.devnull, 'w')
+def vid2gif_serve(argv=None):
+    print('Video To GIF v%s - Server\n' % __version__)
+    
+    # Parse and check args
+    args = get_serve_args(argv)
+    
+    # Log requests and errors
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(LOG_FORMAT)
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.addHandler(_log_handler)
+    
+    missing_programs = check_programs(dict(DEFAULTS))
+    if missing_programs:
+        print('Missing programs: %s' % ', '.join(missing_programs))
+        return 1
+    
+    work_dir = args['work_dir'] or tempfile.mkdtemp(prefix=TEMP_PREFIX + 'server_')
+    service = ConversionService(args['workers'], args['queue_size'], work_dir, args['keep'], args['allow_paths'])
     try:
-        vid2gif()
-        FNULL.close()
-    except:
-        FNULL.close()
+        server = ConversionServer((args['host'], args['port']), service, args['max_upload'])
+    except (OSError, IOError) as e:
+        print('Cannot listen on %s:%d (%s)' % (args['host'], args['port'], e))
+        return 1
+    
+    service.start()
+    print('Listening on http://%s:%d/ with %d workers (Ctrl+C to stop)' % (server.server_address[0], server.server_address[1], args['workers']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopping...')
+    finally:
+        server.server_close()
+        service.stop()
+        if not args['work_dir']:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    return 0
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    
+    exit_on_signals()
+    
+    # Sub commands are recognized by the first arg, otherwise it is a single conversion
+    if argv and argv[0] == 'batch':
+        return vid2gif_batch(argv[1:])
+    if argv and argv[0] == 'serve':
+        return vid2gif_serve(argv[1:])
+    return vid2gif(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+'''
+Asyncio runner of video2gif: the conversions are coroutines, so a single event loop (a single thread) drives many
+of them at the same time, and the FFmpeg commands are the only processes
+
+The stages are executed with asyncio subprocesses, a semaphore caps the commands running at the same time
+(shared by the jobs of the event loop) and a cancelled conversion kills its commands and removes its files.
+The jobs with features whose stages are not plain commands (stdin and stdout, segments, max_bytes, proxy and
+subtitle caches, keyframe index, probe, in process palette engines and optimizer, 'count:K' palette sample)
+are converted by video2gif.convert in a thread of the loop executor (cancelled with video2gif.cancel_commands).
+
+Requires Python 3.5 or upper.
+
+Usage:
+    import asyncio
+    from video2gif import GifJob
+    from video2gif_async import convert
+    
+    async def main(jobs):
+        return await asyncio.gather(*(convert(job) for job in jobs), return_exceptions=True)
+    
+    results = asyncio.get_event_loop().run_until_complete(main([GifJob('a.mp4', 'a.gif'), GifJob('b.mp4', 'b.gif')]))
+'''
+
+import asyncio, functools, os, sys, threading, time, weakref
+from asyncio.subprocess import PIPE
+from multiprocessing import cpu_count
+
+import video2gif
+from video2gif import (COMMANDS, STAGE_MESSAGES, LOG_DEBUG, PIPE_PATH, LOGGER, CommandError, StageTimeoutError,
+                       MissingProgramsError, SubprocessError, StageResult, Result)
+
+# Semaphore of the commands running at the same time, for each event loop
+_CHILDREN = weakref.WeakKeyDictionary()
+
+def default_children():
+    '''The semaphore shared by the jobs of the running event loop, with a slot for each CPU'''
+    
+    loop = asyncio.get_event_loop()
+    if loop not in _CHILDREN:
+        _CHILDREN[loop] = asyncio.Semaphore(cpu_count())
+    return _CHILDREN[loop]
+
+def native_job(job):
+    '''If the stages of a job are all executed in the event loop (or else the job is converted in a thread)'''
+    
+    return (job.sourceVideo != PIPE_PATH and job.destinationGif != PIPE_PATH and job.segments == 1 and not job.max_bytes and
+            not job.proxy_cache and not job.subtitle_cache and not job.keyframe_index and not job.probe and
+            job.palette_engine == 'ffmpeg' and not (job.optimize and job.optimizer == 'builtin') and
+            not (job.palette_sample or '').startswith('count:'))
+
+async def read_progress(stream, cmd_name, args, state, passthrough):
+    '''Read the '-progress' blocks written by FFmpeg on its stderr, as video2gif.progress_reader does'''
+    
+    start_time = time.time()
+    block = {}
+    while True:
+        raw_line = await stream.readline()
+        if not raw_line:
+            break
+        line = raw_line.decode('utf-8', 'replace').rstrip()
+        if not video2gif.progress_line(line, block, state, cmd_name, args, start_time) and passthrough:
+            print(line, file=sys.stderr)
+
+async def stage_threads(args):
+    '''Threads of an FFmpeg command of a stage from the thread budget, as video2gif.stage_threads does, waited without blocking the loop'''
+    
+    threads = video2gif.stage_threads(args, block=False)
+    while threads is None:
+        await asyncio.sleep(video2gif.THREAD_BUDGET_POLL)
+        threads = video2gif.stage_threads(args, block=False)
+    return threads
+
+async def release_threads(p):
+    '''Give back the threads of a command to the thread budget when it ends (also if it is killed)'''
+    
+    try:
+        await p.wait()
+    finally:
+        if p.budget_threads:
+            video2gif.THREAD_BUDGET.release(p.budget_threads)
+
+async def cmd_pipe(cmd_names, args, children, notify=None, stdout=None):
+    '''
+    Execute stage command lines connected by pipes (the stdout of each one is the stdin of the next one),
+    as video2gif.cmd_pipe does, taking a slot of 'children' while they run
+    
+    The commands are killed, with their process groups, if the stage times out or the task is cancelled.
+    
+    Returns:
+        list: a StageResult for each stage (without the CPU time)
+    
+    Raises:
+        CommandError: if a command fails or it cannot be executed (StageTimeoutError if the stage times out)
+    '''
+    
+    if notify is not None:
+        for cmd_name in cmd_names:
+            notify(STAGE_MESSAGES[cmd_name])
+    
+    debug = args['log'] in LOG_DEBUG
+    cmd_lines = [COMMANDS[cmd_name].format(**args) for cmd_name in cmd_names]
+    async with children:
+        with open(os.devnull, 'r+') as devnull:
+            if stdout is None:
+                stdout = sys.stderr if debug else devnull
+            
+            procs, readers = [], []
+            start_time = time.time()
+            stdin = read_end = None
+            try:
+                for i, (cmd_name, cmd_line) in enumerate(zip(cmd_names, cmd_lines)):
+                    if debug:
+                        LOGGER.debug('Exec command line:\n%s\n\n' % cmd_line)
+                    last = i == len(cmd_names) - 1
+                    argv = video2gif.program_argv(cmd_line)
+                    progress = os.path.splitext(os.path.basename(argv[0]))[0] == 'ffmpeg'
+                    threads, decoding = 0, None
+                    if progress:
+                        threads = await stage_threads(args)
+                        decoding = video2gif.thread_options(argv, args, threads)
+                        argv[1:1] = ['-progress', 'pipe:2', '-nostats']
+                    
+                    read_end, write_end = (None, stdout) if last else os.pipe()
+                    try:
+                        p = await asyncio.create_subprocess_exec(
+                            *argv,
+                            stdin=devnull if stdin is None else stdin,
+                            stdout=write_end,
+                            stderr=PIPE if progress else (None if debug else devnull),
+                            **video2gif.process_options(args)
+                        )
+                    except BaseException:
+                        if threads:
+                            video2gif.THREAD_BUDGET.release(threads)
+                        raise
+                    finally:
+                        # Only the next command keeps the pipe open, so the previous one gets an error if the next one ends
+                        if not last:
+                            os.close(write_end)
+                        if stdin is not None:
+                            os.close(stdin)
+                        stdin, read_end = read_end, None
+                    p.budget_threads, p.threads = threads, decoding
+                    procs.append(p)
+                    asyncio.ensure_future(release_threads(p))
+                    
+                    state = {}
+                    reader = asyncio.ensure_future(read_progress(p.stderr, cmd_name, args, state, debug)) if progress else None
+                    readers.append((reader, state))
+            except BaseException as e:
+                # Failed or cancelled while starting the commands, the ones already started are killed
+                if stdin is not None:
+                    os.close(stdin)
+                for p in procs:
+                    video2gif.kill_process(p)
+                for reader, state in readers:
+                    if reader is not None:
+                        reader.cancel()
+                if procs:
+                    await asyncio.shield(asyncio.gather(*[p.wait() for p in procs]))
+                if isinstance(e, (OSError, SubprocessError)):
+                    raise CommandError(cmd_name, cmd_line, reason=str(e))
+                raise
+            
+            timed_out = False
+            try:
+                try:
+                    await asyncio.wait_for(asyncio.gather(*[p.wait() for p in procs]), args['stage_timeout'])
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    for p in procs:
+                        video2gif.kill_process(p)
+                    await asyncio.gather(*[p.wait() for p in procs])
+                await asyncio.gather(*[reader for reader, state in readers if reader is not None])
+            except BaseException:
+                # Cancelled, the commands are killed and reaped by the event loop
+                for p in procs:
+                    video2gif.kill_process(p)
+                for reader, state in readers:
+                    if reader is not None:
+                        reader.cancel()
+                raise
+    
+    elapsed = time.time() - start_time
+    if debug:
+        print('\n', file=sys.stderr)
+    if timed_out:
+        raise StageTimeoutError(cmd_names[0], cmd_lines[0], args['stage_timeout'])
+    
+    results = [StageResult(cmd_name, cmd_line, p.returncode, elapsed, frames=state.get('frames'),
+                           fps=state.get('fps'), speed=state.get('speed'), threads=p.threads)
+               for cmd_name, cmd_line, p, (reader, state) in zip(cmd_names, cmd_lines, procs, readers)]
+    for stage in results:
+        if stage.returncode != 0:
+            raise CommandError(stage.name, stage.cmd_line, returncode=stage.returncode)
+    return results
+
+async def gif_exec(cmd_name, args, result, notify, children):
+    '''Execute a stage that creates the GIF, piped to gifsicle if 'optimize' is enabled (except for the variants)'''
+    
+    if args['optimize'] and cmd_name != 'gifcreate_variants':
+        with open(args['destinationGifOpt'], 'wb') as f:
+            result.stages.extend(await cmd_pipe([cmd_name, 'gifsicle_pipe'], dict(args, destinationGif='pipe:1'), children, notify, stdout=f))
+        args['outputs'][0]['optimized'] = True
+        return
+    result.stages.extend(await cmd_pipe([cmd_name], args, children, notify))
+
+async def palette_exec(args, result, notify, children):
+    video2gif.palette_samples(args, result, notify)
+    result.stages.extend(await cmd_pipe(['palettegen'], args, children, notify))
+
+async def prepare_subtitles(args, result, notify, children):
+    command = video2gif.subtitle_stage(args, result, notify)
+    if command is not None:
+        cmd_name, cmd_args = command
+        result.stages.extend(await cmd_pipe([cmd_name], cmd_args, children))
+
+async def create_gif(args, result, notify, children):
+    for stage in video2gif.gif_stages(args, result):
+        if stage == 'palette':
+            await palette_exec(args, result, notify, children)
+        else:
+            await gif_exec(stage, args, result, notify, children)
+    video2gif.cache_palette(args, result)
+
+async def convert(job, notify=None, progress=None, children=None):
+    '''
+    Create a GIF as described by a job, as video2gif.convert does, in the running event loop
+    
+    Args:
+        job (GifJob): The conversion to do
+        notify (callable): Optional, called with a short message when a stage starts
+        progress (callable): Optional, called with the stage name and its progress while an FFmpeg stage runs
+            (from the event loop, or from another thread if the job is not executed in the event loop)
+        children (asyncio.Semaphore): Optional, the slots of the stages running at the same time (each one is an FFmpeg
+            command, with gifsicle if piped; a job converted in a thread takes a single slot)
+            (Default: a slot for each CPU, shared by the jobs of the event loop, expected by the thread budget while
+            the job runs). The slots of a semaphore passed here should be expected by the caller, with
+            video2gif.THREAD_BUDGET.expecting()
+    
+    Returns:
+        Result: timings, output size and stage results of the conversion (the CPU time of the stages is not known)
+    
+    Raises:
+        MissingProgramsError: if a required program is not reachable
+        CommandError: if a stage fails (temp and dirty files are removed)
+        SizeLimitError: if the GIF does not fit in 'max_bytes' (it is removed)
+    '''
+    
+    if children is None:
+        # The slots of the default semaphore are expected only while its jobs run
+        with video2gif.THREAD_BUDGET.expecting(cpu_count()):
+            return await convert(job, notify, progress, default_children())
+    
+    if not native_job(job):
+        # A cancelled job gets its commands killed, and it fails in its thread at the next command
+        cancel = threading.Event()
+        async with children:
+            try:
+                return await asyncio.get_event_loop().run_in_executor(None, functools.partial(video2gif.convert, job, notify, progress=progress, cancel=cancel))
+            except asyncio.CancelledError:
+                video2gif.cancel_commands(cancel)
+                raise
+    
+    start_time = time.time()
+    missing_programs = video2gif.check_programs(job.as_dict())
+    if missing_programs:
+        raise MissingProgramsError(missing_programs)
+    
+    video2gif.setup_fonts()
+    
+    args = video2gif.build_args(job, video2gif.make_workdir(job.tmp_dir))
+    args['progress'] = progress
+    
+    result = Result(job)
+    video2gif.THREAD_BUDGET.enter()
+    try:
+        if args['palette_cache']:
+            args['palette_key'] = video2gif.palette_key(args)
+        
+        await prepare_subtitles(args, result, notify, children)
+        await create_gif(args, result, notify, children)
+        
+        if args['optimize']:
+            for output_args in video2gif.unoptimized_outputs(args):
+                result.stages.extend(await cmd_pipe(['gifsicle'], output_args, children, notify))
+                if os.path.isfile(output_args['destinationGif']):
+                    os.remove(output_args['destinationGif'])
+    except BaseException:
+        video2gif.clean_files(args)
+        raise
+    finally:
+        video2gif.THREAD_BUDGET.leave()
+    
+    video2gif.remove_workdir(args['workdir'])
+    
+    result.size = os.path.getsize(job.destinationGif)
+    result.variants = [{'destinationGif': v.destinationGif, 'size': os.path.getsize(v.destinationGif)} for v in job.variants]
+    result.elapsed = time.time() - start_time
+    return result
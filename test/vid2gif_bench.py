@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+'''
+Benchmark of the palette engines (and of the palette sampling options)
+
+Each engine creates the GIF of the same clip, and time elapsed (total and palette creation),
+GIF size and quality (PSNR against the lossless resized frames, in dB) are reported.
+
+Usage: python vid2gif_bench.py SOURCE [-a START] [-t END] [-s SIZE] [-f FPS] [-r RUNS] [--json REPORT]
+'''
+
+from __future__ import print_function
+import os, sys, re, argparse, json, shutil, subprocess, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import video2gif
+
+# Name and options of each benchmarked configuration
+CONFIGS = [
+    ('ffmpeg (fused)',          {}),
+    ('ffmpeg',                  {'twopass': True}),
+    ('ffmpeg (sampled)',        {'twopass': True, 'palette_downscale': 2, 'palette_frame_step': 3}),
+    ('ffmpeg (2 fps)',          {'palette_sample': 'fps:2'}),
+    ('ffmpeg (keyframes)',      {'palette_sample': 'keyframes'}),
+    ('ffmpeg (16 frames)',      {'palette_sample': 'count:16'}),
+    ('median_cut',              {'palette_engine': 'median_cut'}),
+    ('median_cut (sampled)',    {'palette_engine': 'median_cut', 'palette_downscale': 2, 'palette_frame_step': 3}),
+    ('median_cut (early stop)', {'palette_engine': 'median_cut', 'palette_early_stop': True}),
+    ('kmeans',                  {'palette_engine': 'kmeans'}),
+    ('kmeans (sampled)',        {'palette_engine': 'kmeans', 'palette_downscale': 2, 'palette_frame_step': 3}),
+    ('kmeans (early stop)',     {'palette_engine': 'kmeans', 'palette_early_stop': True}),
+]
+
+def reference(job, path):
+    '''Lossless video of the frames of the GIF, before the palette'''
+
+    args = video2gif.build_args(job, os.path.dirname(path))
+    cmd = 'ffmpeg -v error -y %s -i "%s" -vf "%s" -c:v ffv1 "%s"' % (args['cutting'], job.sourceVideo, args['filters'], path)
+    subprocess.check_call(video2gif.shlex.split(cmd))
+
+def psnr(reference_path, gif_path, fps):
+    '''Average PSNR of the GIF frames, matched by number (GIF delays are rounded to centiseconds)'''
+
+    graph = '[0]setpts=N/(%d*TB),format=rgb24[a];[1]setpts=N/(%d*TB),format=rgb24[b];[a][b]psnr' % (fps, fps)
+    p = subprocess.Popen(['ffmpeg', '-hide_banner', '-i', reference_path, '-i', gif_path, '-lavfi', graph, '-f', 'null', '-'], stderr=subprocess.PIPE)
+    output = p.communicate()[1].decode('utf-8', 'replace')
+    match = re.search(r'average:([0-9.]+|inf)', output)
+    return float(match.group(1)) if match else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the video2gif palette engines')
+    parser.add_argument('source', help='Source video path')
+    parser.add_argument('-a', '--at', default=None, dest='start', help='Clip start (Default: 0)')
+    parser.add_argument('-t', '--to', default=None, dest='end', help='Clip end (Default: end of the video)')
+    parser.add_argument('-s', '--size', default=video2gif.DEFAULTS['size'], help='GIF size (Default: %s)' % video2gif.DEFAULTS['size'])
+    parser.add_argument('-f', '--fps', default=video2gif.DEFAULTS['fps'], type=int, help='GIF fps (Default: %d)' % video2gif.DEFAULTS['fps'])
+    parser.add_argument('-r', '--runs', default=1, type=int, help='Runs of each configuration, the fastest one is reported (Default: 1)')
+    parser.add_argument('--json', default=None, dest='report', help='Write also a JSON report')
+    args = parser.parse_args(argv)
+
+    if video2gif.numpy is None:
+        print('NumPy is not installed, only the ffmpeg engine is benchmarked')
+
+    workdir = tempfile.mkdtemp(prefix='video2gif_bench_')
+    try:
+        options = {'start': args.start, 'end': args.end, 'size': args.size, 'fps': args.fps}
+        ref_path = os.path.join(workdir, 'reference.mkv')
+        reference(video2gif.GifJob(args.source, ref_path, **options), ref_path)
+
+        rows = []
+        print('%-24s %10s %10s %12s %10s' % ('Engine', 'Total (s)', 'Palette (s)', 'Size (KiB)', 'PSNR (dB)'))
+        for name, config in CONFIGS:
+            if config.get('palette_engine', 'ffmpeg') != 'ffmpeg' and video2gif.numpy is None:
+                continue
+
+            gif_path = os.path.join(workdir, 'out.gif')
+            best = None
+            for _ in range(max(args.runs, 1)):
+                job = video2gif.GifJob(args.source, gif_path, **dict(options, **config))
+                result = video2gif.convert(job)
+                if best is None or result.elapsed < best.elapsed:
+                    best = result
+
+            palette_time = sum(st.elapsed for st in best.stages if st.name.startswith('palettegen'))
+            row = {
+                'engine'    : name,
+                'options'   : config,
+                'elapsed'   : best.elapsed,
+                'palette'   : palette_time if palette_time else None,
+                'size'      : best.size,
+                'psnr'      : psnr(ref_path, gif_path, args.fps),
+            }
+            rows.append(row)
+            print('%-24s %10.2f %10s %12.1f %10s' % (
+                name, row['elapsed'], '%.2f' % palette_time if palette_time else '-',
+                row['size'] / 1024.0, '%.2f' % row['psnr'] if row['psnr'] is not None else '-'
+            ))
+
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(rows, f, indent=4)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
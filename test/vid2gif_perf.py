@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+'''
+Reproducible performance benchmark of video2gif
+
+The sources are synthetic (FFmpeg lavfi sources, also with the test subtitles burned), so no download is needed
+and two runs convert the same frames. Each source is converted by the command line with a sweep of the options,
+and time elapsed, CPU time and peak memory (of the whole process tree), GIF size and quality (PSNR against the
+lossless resized frames, in dB) are written to a JSON report. Two reports can be compared to find the regressions
+(the exit code is 1 if there are any).
+
+Usage:
+    python vid2gif_perf.py run REPORT [-d DURATION] [-r RUNS] [--sweep {single,matrix}] [--source NAME] [--sources-dir DIR]
+    python vid2gif_perf.py compare BASELINE REPORT [--time-threshold T] [--memory-threshold M] [--size-threshold S] [--psnr-threshold P]
+'''
+
+from __future__ import print_function
+import os, sys, argparse, itertools, json, platform, shutil, subprocess, tempfile, time
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(TEST_DIR, '..', 'src', 'video2gif.py')
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+import video2gif
+from vid2gif_bench import psnr
+
+# Name, lavfi graph and burned subtitle file of each source (the noise seed is fixed, to get the same frames)
+SOURCES = [
+    ('testsrc2',        'testsrc2=size=1280x720:rate=30',                                   None),
+    ('mandelbrot',      'mandelbrot=size=1280x720:rate=30',                                 None),
+    ('noise',           'testsrc2=size=1280x720:rate=30,noise=alls=40:allf=t+u:all_seed=1', None),
+    ('testsrc2_srt',    'testsrc2=size=1280x720:rate=30',                                   'test_sub.srt'),
+    ('testsrc2_ass',    'testsrc2=size=1280x720:rate=30',                                   'test_sub.ass'),
+]
+
+# Swept options, the first value of each one is the baseline (the video2gif default); 'optimize' is the optimizer used
+SWEEP = [
+    ('mode',        ['full', 'diff', 'single']),
+    ('dither',      ['bayer', 'none', 'floyd_steinberg', 'sierra2', 'sierra2_4a']),
+    ('size',        ['640:0', '320:0', '1280:0']),
+    ('fps',         [15, 10, 25]),
+    ('onestep',     [False, True]),
+    ('optimize',    [False, 'gifsicle', 'builtin']),
+]
+
+# Command line flag of each job option
+FLAGS = {
+    'mode'      : '--mode',
+    'dither'    : '--dither',
+    'size'      : '--size',
+    'fps'       : '--fps',
+    'onestep'   : '--onestep',
+    'optimize'  : '--optimizer',
+    'burn_file' : '--burn-sub-file',
+}
+
+# Metrics compared between two reports, and if a greater value is worse
+METRICS = [
+    ('elapsed', 'time',     True),
+    ('cpu',     'time',     True),
+    ('rss',     'memory',   True),
+    ('size',    'size',     True),
+    ('psnr',    'psnr',     False),
+]
+
+# Time differences under this value (in seconds) are noise
+TIME_FLOOR = 0.05
+
+def configurations(sweep):
+    '''Option sets of the sweep, 'single' changes one option at a time from the baseline, 'matrix' all the combinations'''
+
+    baseline = dict((name, values[0]) for name, values in SWEEP)
+    if sweep == 'matrix':
+        combinations = [dict(zip([name for name, _ in SWEEP], values)) for values in itertools.product(*[values for _, values in SWEEP])]
+    else:
+        combinations = [baseline] + [dict(baseline, **{name: value}) for name, values in SWEEP for value in values[1:]]
+
+    configs = []
+    for options in combinations:
+        changed = ['%s=%s' % (name, options[name]) for name, _ in SWEEP if options[name] != baseline[name]]
+        configs.append((','.join(changed) or 'baseline', options))
+    return configs
+
+def create_source(graph, duration, path):
+    '''Encode a lavfi source (H.264 if available, with a keyframe every 2 seconds)'''
+
+    codec = ['-c:v', 'libx264', '-preset', 'fast', '-crf', '18'] if 'libx264' in video2gif.program_info('ffmpeg')['encoders'] else ['-c:v', 'mpeg4', '-q:v', '2']
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', graph, '-t', str(duration)] + codec + ['-pix_fmt', 'yuv420p', '-g', '60', path]
+    subprocess.check_call(cmd)
+
+def reference(source, sub_file, options, path):
+    '''Lossless video of the frames of the GIF, before the palette (the subtitles are burned as video2gif does)'''
+
+    graph = 'fps=%s,scale=%s:flags=%s' % (options['fps'], video2gif.size_string(options['size']), video2gif.DEFAULTS['resize_mode'])
+    if sub_file:
+        graph = "subtitles='%s'," % os.path.basename(sub_file) + graph
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', source, '-vf', graph, '-c:v', 'ffv1', path]
+    subprocess.check_call(cmd, cwd=os.path.dirname(sub_file) if sub_file else None)
+
+def measure(cmd):
+    '''
+    Run a command (its output is discarded)
+
+    Returns:
+        tuple: time elapsed, CPU time (user and system) and peak resident memory (in KiB) of the command and of
+            its subprocesses, CPU time and memory are None if not available (e.g. on Windows)
+    '''
+
+    started = time.time()
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(cmd, stdout=devnull)
+    cpu, rss = None, None
+    if hasattr(os, 'wait4'):
+        status, usage = os.wait4(p.pid, 0)[1:]
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        cpu = usage.ru_utime + usage.ru_stime
+        rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    else:
+        p.wait()
+    elapsed = time.time() - started
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return elapsed, cpu, rss
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def run(args):
+    sources = [source for source in SOURCES if not args.sources or source[0] in args.sources]
+    configs = configurations(args.sweep)
+    workdir = tempfile.mkdtemp(prefix='video2gif_perf_')
+    try:
+        sources_dir = os.path.abspath(args.sources_dir or workdir)
+        if not os.path.isdir(sources_dir):
+            os.makedirs(sources_dir)
+
+        meta = {
+            'video2gif' : video2gif.__version__,
+            'ffmpeg'    : video2gif.program_info('ffmpeg')['version'],
+            'gifsicle'  : video2gif.program_info('gifsicle')['version'] if video2gif.find_program('gifsicle') else None,
+            'python'    : platform.python_version(),
+            'platform'  : platform.platform(),
+            'cpus'      : video2gif.cpu_count(),
+            'date'      : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'duration'  : args.duration,
+            'runs'      : args.runs,
+            'sweep'     : args.sweep,
+        }
+        report = {'meta': meta, 'results': []}
+
+        print('%-14s %-28s %9s %9s %10s %11s %9s' % ('Source', 'Options', 'Time (s)', 'CPU (s)', 'RSS (MiB)', 'Size (KiB)', 'PSNR (dB)'))
+        for source_name, graph, sub_name in sources:
+            # Sources are kept in the sources dir, and created again only if the duration changes
+            source = os.path.join(sources_dir, '%s_%ss.mp4' % (source_name.split('_')[0], args.duration))
+            if not os.path.isfile(source):
+                create_source(graph, args.duration, source)
+            sub_file = os.path.join(TEST_DIR, sub_name) if sub_name else None
+
+            references = {}
+            for name, options in configs:
+                ref_key = (options['size'], options['fps'])
+                if ref_key not in references:
+                    references[ref_key] = os.path.join(workdir, 'reference_%d.mkv' % len(references))
+                    reference(source, sub_file, options, references[ref_key])
+
+                gif_path = os.path.join(workdir, 'out.gif')
+                summary_path = os.path.join(workdir, 'summary.json')
+                cmd = [sys.executable, SCRIPT, source, gif_path, '--summary', summary_path]
+                for option, value in sorted(dict(options, burn_file=sub_file).items()):
+                    if value is True:
+                        cmd.append(FLAGS[option])
+                    elif option == 'optimize' and value:
+                        cmd += ['--gifsicle', FLAGS[option], value]
+                    elif value not in (False, None):
+                        cmd += [FLAGS[option], str(value)]
+
+                measures = [measure(cmd) for _ in range(max(args.runs, 1))]
+                with open(summary_path) as f:
+                    summary = json.load(f)
+                row = {
+                    'source'    : source_name,
+                    'name'      : name,
+                    'options'   : options,
+                    'elapsed'   : median([m[0] for m in measures]),
+                    'cpu'       : median([m[1] for m in measures]),
+                    'rss'       : max(m[2] for m in measures) if measures[0][2] is not None else None,
+                    'size'      : os.path.getsize(gif_path),
+                    'psnr'      : psnr(references[ref_key], gif_path, options['fps']),
+                    'stages'    : [(stage['name'], stage['elapsed']) for stage in summary['stages']],
+                }
+                report['results'].append(row)
+                print('%-14s %-28s %9.2f %9s %10s %11.1f %9s' % (
+                    source_name, name, row['elapsed'], '%.2f' % row['cpu'] if row['cpu'] is not None else '-',
+                    '%.1f' % (row['rss'] / 1024.0) if row['rss'] is not None else '-', row['size'] / 1024.0,
+                    '%.2f' % row['psnr'] if row['psnr'] is not None else '-'
+                ))
+
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.report) as f:
+        report = json.load(f)
+
+    # Results are comparable only on the same machine and sources
+    for key in ('platform', 'cpus', 'duration', 'ffmpeg'):
+        if baseline['meta'].get(key) != report['meta'].get(key):
+            print('Note: different %s (%s -> %s)' % (key, baseline['meta'].get(key), report['meta'].get(key)))
+
+    thresholds = {'time': args.time_threshold, 'memory': args.memory_threshold, 'size': args.size_threshold, 'psnr': args.psnr_threshold}
+    old_rows = dict(((row['source'], row['name']), row) for row in baseline['results'])
+    regressions, improvements = 0, 0
+    print('%-14s %-28s %-8s %12s %12s %9s' % ('Source', 'Options', 'Metric', 'Baseline', 'Report', 'Change'))
+    for row in report['results']:
+        old = old_rows.pop((row['source'], row['name']), None)
+        if old is None:
+            print('%-14s %-28s not in the baseline' % (row['source'], row['name']))
+            continue
+
+        for metric, kind, greater_is_worse in METRICS:
+            before, after = old.get(metric), row.get(metric)
+            if before is None or after is None:
+                continue
+
+            # PSNR changes are absolute (dB), the other ones relative
+            if kind == 'psnr':
+                change = after - before
+            else:
+                if kind == 'time' and abs(after - before) < TIME_FLOOR:
+                    continue
+                change = (after - before) / float(before) if before else 0
+            if abs(change) <= thresholds[kind]:
+                continue
+
+            worse = (change > 0) == greater_is_worse
+            if worse:
+                regressions += 1
+            else:
+                improvements += 1
+            print('%-14s %-28s %-8s %12.2f %12.2f %9s %s' % (
+                row['source'], row['name'], metric, before, after,
+                '%+.2f' % change if kind == 'psnr' else '%+.1f%%' % (change * 100), 'REGRESSION' if worse else 'improved'
+            ))
+    for source, name in sorted(old_rows):
+        print('%-14s %-28s not in the report' % (source, name))
+
+    print('\n%d regressions, %d improvements' % (regressions, improvements))
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reproducible performance benchmark of video2gif')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Convert the synthetic sources and write a JSON report')
+    run_parser.add_argument('report', help='JSON report path')
+    run_parser.add_argument('-d', '--duration', default=6, type=int, help='Duration of the sources, in seconds (Default: 6)')
+    run_parser.add_argument('-r', '--runs', default=1, type=int, help='Runs of each conversion, the median time is reported (Default: 1)')
+    run_parser.add_argument('--sweep', default='single', choices=['single', 'matrix'], help='"single" changes one option at a time from the defaults, "matrix" tries all the combinations (Default: single)')
+    run_parser.add_argument('--source', default=[], action='append', dest='sources', choices=[source[0] for source in SOURCES], help='Convert only this source (can be used more times)')
+    run_parser.add_argument('--sources-dir', default=None, help='Keep the created sources in this directory, to reuse them in the next runs')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON reports, exit code is 1 if there are regressions')
+    compare_parser.add_argument('baseline', help='Baseline JSON report path')
+    compare_parser.add_argument('report', help='JSON report path')
+    compare_parser.add_argument('--time-threshold', default=0.1, type=float, help='Max relative increase of time and CPU time (Default: 0.1)')
+    compare_parser.add_argument('--memory-threshold', default=0.1, type=float, help='Max relative increase of peak memory (Default: 0.1)')
+    compare_parser.add_argument('--size-threshold', default=0.02, type=float, help='Max relative increase of GIF size (Default: 0.02)')
+    compare_parser.add_argument('--psnr-threshold', default=0.2, type=float, help='Max decrease of PSNR, in dB (Default: 0.2)')
+
+    args = parser.parse_args(argv)
+    return run(args) if args.command == 'run' else compare(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,35 @@ SET log_mkv_nosub=log_mkv_nosub.txt
 SET log_mkv_srt=log_mkv_srt.txt
 SET log_mkv_ass=log_mkv_ass.txt
 
+SET out_mp4_segments=out_mp4_segments.gif
+SET out_mkv_segments_ass=out_mkv_segments_ass.gif
+SET log_mp4_segments=log_mp4_segments.txt
+SET log_mkv_segments_ass=log_mkv_segments_ass.txt
+
+SET out_mp4_builtin=out_mp4_builtin.gif
+SET out_mkv_builtin_srt=out_mkv_builtin_srt.gif
+SET log_mp4_builtin=log_mp4_builtin.txt
+SET log_mkv_builtin_srt=log_mkv_builtin_srt.txt
+
+SET cache_dir=cache
+SET out_mkv_cache_srt=out_mkv_cache_srt.gif
+SET out_mkv_cache_ass=out_mkv_cache_ass.gif
+SET log_mkv_cache_srt=log_mkv_cache_srt.txt
+SET log_mkv_cache_ass=log_mkv_cache_ass.txt
+
+SET out_pipe=out_pipe.gif
+SET log_pipe=log_pipe.txt
+
+SET batch_manifest=batch_manifest.csv
+SET batch_report=batch_report.json
+SET out_batch_mp4=out_batch_mp4.gif
+SET out_batch_mkv=out_batch_mkv.gif
+SET log_batch=log_batch.txt
+
+IF NOT DEFINED SERVE_PORT SET serve_port=8090
+SET out_serve=out_serve.gif
+SET log_serve=log_serve.txt
+
 
 REM ----- MP4 TESTS -----
 
@@ -57,4 +86,90 @@ echo.
 echo #### MKV ASS ####
 python -B ..\src\video2gif.py "%in_mkv%" "%out_mkv_ass%" -l verbose -a %start% -t %end% -m diff --burn-sub-track 0 2> %log_mkv_ass%
 
+
+REM ----- SEGMENTS TESTS -----
+
+echo.
+echo #### MP4 Segments ####
+python -B ..\src\video2gif.py "%in_mp4%" "%out_mp4_segments%" -l verbose -a %start% -t %end% -m diff --segments 2 2> %log_mp4_segments%
+
+echo.
+echo #### MKV ASS Segments ####
+python -B ..\src\video2gif.py "%in_mkv%" "%out_mkv_segments_ass%" -l verbose -a %start% -t %end% -m diff --segments 2 --burn-sub-track 0 2> %log_mkv_segments_ass%
+
+
+REM ----- OPTIMIZER TESTS -----
+
+echo.
+echo #### MP4 Builtin Optimizer ####
+python -B ..\src\video2gif.py "%in_mp4%" "%out_mp4_builtin%" -l verbose -a %start% -t %end% -m diff -g --optimizer builtin 2> %log_mp4_builtin%
+
+echo.
+echo #### MKV SRT Builtin Optimizer ####
+python -B ..\src\video2gif.py "%in_mkv%" "%out_mkv_builtin_srt%" -l verbose -a %start% -t %end% -m diff -g --optimizer builtin --burn-sub-track 1 2> %log_mkv_builtin_srt%
+
+
+REM ----- SUBTITLE CACHE TESTS -----
+
+echo.
+echo #### MKV SRT Subtitle Cache ####
+python -B ..\src\video2gif.py "%in_mkv%" "%out_mkv_cache_srt%" -l verbose -a %start% -t %end% -m diff --burn-sub-track 1 --subtitle-cache --cache-dir %cache_dir% 2> %log_mkv_cache_srt%
+
+echo.
+echo #### MKV ASS Subtitle Cache ####
+python -B ..\src\video2gif.py "%in_mkv%" "%out_mkv_cache_ass%" -l verbose -a %start% -t %end% -m diff --burn-sub-track 0 --subtitle-cache --cache-dir %cache_dir% 2> %log_mkv_cache_ass%
+
+
+REM ----- PIPE TESTS -----
+
+echo.
+echo #### MKV Stdin Stdout ####
+python -B ..\src\video2gif.py - - -l verbose -a %start% -t %end% -m diff --burn-sub-track 0 < "%in_mkv%" > "%out_pipe%" 2> %log_pipe%
+
+
+REM ----- BATCH TESTS -----
+
+echo.
+echo #### Batch ####
+(
+echo source,destination,start,end,mode,burn_track
+echo %in_mp4%,%out_batch_mp4%,%start%,%end%,diff,
+echo %in_mkv%,%out_batch_mkv%,%start%,%end%,diff,0
+) > %batch_manifest%
+python -B ..\src\video2gif.py batch %batch_manifest% -r %batch_report% 2> %log_batch%
+python -B -c "import sys, json; failed = [r['destination'] for r in json.load(open('%batch_report%')) if r['status'] != 'ok']; sys.exit('Batch jobs failed: %%s' %% ', '.join(failed) if failed else 0)" || exit /b 1
+
+echo.
+echo #### Batch Thread Budget ####
+python -B -c "import sys; sys.path.insert(0, '../src'); import video2gif; video2gif.convert_batch(video2gif.read_manifest('%batch_manifest%'), workers=2); budget = video2gif.THREAD_BUDGET; sys.exit(0 if budget.jobs == 1 and budget.acquire('throughput') == budget.cpus else 'The thread budget is not back to full after the batch')" 2>> %log_batch% || exit /b 1
+
+
+REM ----- SERVE TESTS -----
+
+echo.
+echo #### Serve ####
+start "video2gif serve" cmd /c "python -B ..\src\video2gif.py serve -p %serve_port% -w 2 2> %log_serve%"
+SET serve_wait=0
+:serve_start
+timeout /t 1 /nobreak > nul
+SET /a serve_wait+=1
+curl -sf -o nul "http://127.0.0.1:%serve_port%/health" || if %serve_wait% lss 30 goto serve_start
+for /f %%i in ('curl -s -X POST --data-binary @"%in_mp4%" "http://127.0.0.1:%serve_port%/jobs?start=%start%&end=%end%&mode=diff" ^| python -c "import sys, json; print(json.load(sys.stdin)['id'])"') do SET serve_job=%%i
+SET serve_wait=0
+:serve_wait
+timeout /t 1 /nobreak > nul
+SET /a serve_wait+=1
+SET serve_status=
+for /f %%s in ('curl -s "http://127.0.0.1:%serve_port%/jobs/%serve_job%" ^| python -c "import sys, json; print(json.load(sys.stdin)['status'])"') do SET serve_status=%%s
+if "%serve_status%"=="queued" if %serve_wait% lss 60 goto serve_wait
+if "%serve_status%"=="running" if %serve_wait% lss 60 goto serve_wait
+curl -sf -o "%out_serve%" "http://127.0.0.1:%serve_port%/jobs/%serve_job%/result"
+curl -s "http://127.0.0.1:%serve_port%/jobs/%serve_job%"
+echo.
+taskkill /f /t /fi "WINDOWTITLE eq video2gif serve*" > nul
+if not "%serve_status%"=="done" (
+echo Serve job %serve_job% not done: %serve_status%
+exit /b 1
+)
+
 pause
@@ -28,6 +28,35 @@ log_mkv_nosub=log_mkv_nosub.txt
 log_mkv_srt=log_mkv_srt.txt
 log_mkv_ass=log_mkv_ass.txt
 
+out_mp4_segments=out_mp4_segments.gif
+out_mkv_segments_ass=out_mkv_segments_ass.gif
+log_mp4_segments=log_mp4_segments.txt
+log_mkv_segments_ass=log_mkv_segments_ass.txt
+
+out_mp4_builtin=out_mp4_builtin.gif
+out_mkv_builtin_srt=out_mkv_builtin_srt.gif
+log_mp4_builtin=log_mp4_builtin.txt
+log_mkv_builtin_srt=log_mkv_builtin_srt.txt
+
+cache_dir=cache
+out_mkv_cache_srt=out_mkv_cache_srt.gif
+out_mkv_cache_ass=out_mkv_cache_ass.gif
+log_mkv_cache_srt=log_mkv_cache_srt.txt
+log_mkv_cache_ass=log_mkv_cache_ass.txt
+
+out_pipe=out_pipe.gif
+log_pipe=log_pipe.txt
+
+batch_manifest=batch_manifest.csv
+batch_report=batch_report.json
+out_batch_mp4=out_batch_mp4.gif
+out_batch_mkv=out_batch_mkv.gif
+log_batch=log_batch.txt
+
+serve_port=${SERVE_PORT:-8090}
+out_serve=out_serve.gif
+log_serve=log_serve.txt
+
 
 # ----- MP4 TESTS -----
 
@@ -51,3 +80,65 @@ python -B ../src/video2gif.py "$in_mkv" "$out_mkv_srt" -l verbose -a $start -t $
 
 printf '\n#### MKV ASS ####\n'
 python -B ../src/video2gif.py "$in_mkv" "$out_mkv_ass" -l verbose -a $start -t $end -m diff --burn-sub-track 0 2> $log_mkv_ass
+
+
+# ----- SEGMENTS TESTS -----
+
+printf '\n#### MP4 Segments ####\n'
+python -B ../src/video2gif.py "$in_mp4" "$out_mp4_segments" -l verbose -a $start -t $end -m diff --segments 2 2> $log_mp4_segments
+
+printf '\n#### MKV ASS Segments ####\n'
+python -B ../src/video2gif.py "$in_mkv" "$out_mkv_segments_ass" -l verbose -a $start -t $end -m diff --segments 2 --burn-sub-track 0 2> $log_mkv_segments_ass
+
+
+# ----- OPTIMIZER TESTS -----
+
+printf '\n#### MP4 Builtin Optimizer ####\n'
+python -B ../src/video2gif.py "$in_mp4" "$out_mp4_builtin" -l verbose -a $start -t $end -m diff -g --optimizer builtin 2> $log_mp4_builtin
+
+printf '\n#### MKV SRT Builtin Optimizer ####\n'
+python -B ../src/video2gif.py "$in_mkv" "$out_mkv_builtin_srt" -l verbose -a $start -t $end -m diff -g --optimizer builtin --burn-sub-track 1 2> $log_mkv_builtin_srt
+
+
+# ----- SUBTITLE CACHE TESTS -----
+
+printf '\n#### MKV SRT Subtitle Cache ####\n'
+python -B ../src/video2gif.py "$in_mkv" "$out_mkv_cache_srt" -l verbose -a $start -t $end -m diff --burn-sub-track 1 --subtitle-cache --cache-dir $cache_dir 2> $log_mkv_cache_srt
+
+printf '\n#### MKV ASS Subtitle Cache ####\n'
+python -B ../src/video2gif.py "$in_mkv" "$out_mkv_cache_ass" -l verbose -a $start -t $end -m diff --burn-sub-track 0 --subtitle-cache --cache-dir $cache_dir 2> $log_mkv_cache_ass
+
+
+# ----- PIPE TESTS -----
+
+printf '\n#### MKV Stdin Stdout ####\n'
+python -B ../src/video2gif.py - - -l verbose -a $start -t $end -m diff --burn-sub-track 0 < "$in_mkv" > "$out_pipe" 2> $log_pipe
+
+
+# ----- BATCH TESTS -----
+
+printf '\n#### Batch ####\n'
+printf 'source,destination,start,end,mode,burn_track\n%s,%s,%s,%s,diff,\n%s,%s,%s,%s,diff,0\n' "$in_mp4" "$out_batch_mp4" $start $end "$in_mkv" "$out_batch_mkv" $start $end > $batch_manifest
+python -B ../src/video2gif.py batch $batch_manifest -r $batch_report 2> $log_batch
+python -B -c "import sys, json; failed = [r['destination'] for r in json.load(open('$batch_report')) if r['status'] != 'ok']; sys.exit('Batch jobs failed: %s' % ', '.join(failed) if failed else 0)" || exit 1
+
+printf '\n#### Batch Thread Budget ####\n'
+python -B -c "import sys; sys.path.insert(0, '../src'); import video2gif; video2gif.convert_batch(video2gif.read_manifest('$batch_manifest'), workers=2); budget = video2gif.THREAD_BUDGET; sys.exit(0 if budget.jobs == 1 and budget.acquire('throughput') == budget.cpus else 'The thread budget is not back to full after the batch')" 2>> $log_batch || exit 1
+
+
+# ----- SERVE TESTS -----
+
+printf '\n#### Serve ####\n'
+python -B ../src/video2gif.py serve -p $serve_port -w 2 2> $log_serve &
+serve_pid=$!
+for i in $(seq 30); do curl -sf -o /dev/null "http://127.0.0.1:$serve_port/health" && break; sleep 1; done
+serve_job=$(curl -s -X POST --data-binary @"$in_mp4" "http://127.0.0.1:$serve_port/jobs?start=$start&end=$end&mode=diff" | python -c "import sys, json; print(json.load(sys.stdin)['id'])")
+for i in $(seq 60); do
+    serve_status=$(curl -s "http://127.0.0.1:$serve_port/jobs/$serve_job" | python -c "import sys, json; print(json.load(sys.stdin)['status'])")
+    [ "$serve_status" = queued ] || [ "$serve_status" = running ] || break
+    sleep 1
+done
+curl -sf -o "$out_serve" "http://127.0.0.1:$serve_port/jobs/$serve_job/result"
+curl -s "http://127.0.0.1:$serve_port/jobs/$serve_job"; echo
+kill $serve_pid; wait $serve_pid
+[ "$serve_status" = done ] || { echo "Serve job $serve_job not done: $serve_status"; exit 1; }